@@ -1,6 +1,6 @@
 __version__ = '0.13.3.dev3'
 
-from .util import TraceMode, PriorInflation, InferenceEngine, InferenceNetwork, Optimizer, LearningRateScheduler, ObserveEmbedding, set_verbosity, set_random_seed, set_device
-from .state import sample, observe, tag
-from .address_dictionary import AddressDictionary
+from .util import TraceMode, PriorInflation, InferenceEngine, TracePruning, TraceRecording, TraceRetention, Resampling, InferenceNetwork, Optimizer, LearningRateScheduler, ObserveEmbedding, set_verbosity, set_random_seed, set_device
+from .state import sample, observe, tag, set_address_cache, address_cache_stats, register_inflation_rule, set_inflation_cache, inflation_cache_stats
+from .address_dictionary import AddressDictionary, AddressTable
 from .model import Model, RemoteModel
@@ -1,3 +1,4 @@
+import threading
 from functools import lru_cache
 
 from .concurrency import ConcurrentShelf
@@ -34,3 +35,56 @@ class AddressDictionary():
     def id_to_address(self, id):
         id_key = '__id__' + id
         return self._shelf[id_key]
+
+    def save_address_table(self, address_table):
+        self._shelf.lock()
+        self._shelf['__address_table'] = address_table.addresses()
+        self._shelf.unlock()
+
+    def load_address_table(self, address_table):
+        # Loading into an empty table (e.g., at the start of a process) reproduces the integer ids of the saved table
+        if '__address_table' in self._shelf:
+            for address in self._shelf['__address_table']:
+                address_table.id(address)
+
+
+class AddressTable():
+    # Interns addresses: each distinct address_base or address is stored once and gets a small integer id
+    # Ids are specific to a process, traces are saved with address strings
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._addresses = []
+        self._instance_ids = {}
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def id(self, address):
+        ret = self._ids.get(address)
+        if ret is None:
+            with self._lock:
+                ret = self._ids.get(address)
+                if ret is None:
+                    ret = len(self._addresses)
+                    self._addresses.append(address)
+                    self._ids[address] = ret
+        return ret
+
+    def address(self, id):
+        return self._addresses[id]
+
+    def addresses(self):
+        return list(self._addresses)
+
+    def instance_id(self, address_base_id, instance):
+        # Id of the address of an instance of an address_base, without building the address string after the first time
+        key = (address_base_id, instance)
+        ret = self._instance_ids.get(key)
+        if ret is None:
+            ret = self.id(self._addresses[address_base_id] + '__' + str(instance))
+            self._instance_ids[key] = ret
+        return ret
+
+
+address_table = AddressTable()
@@ -2,6 +2,11 @@ from collections.abc import Mapping
 import shelve
 import random
 import time
+import os
+import mmap
+import pickle
+import struct
+import array
 
 
 class ConcurrentShelf(Mapping):
@@ -92,3 +97,172 @@ class ConcurrentShelf(Mapping):
                 shelf.close()
                 raise e
             return value
+
+
+class RecordLog():
+    # Append-only file store of records (pickled values) with a float64 weight per record, and a dictionary of metadata
+    # Files: <file_name>.records holds the length-prefixed records, <file_name>.weights the weights, <file_name>.index the offset of each record and <file_name>.meta the pickled metadata
+    # A record is committed by its index entry, which is written after the record and its weight: after a crash, trailing uncommitted data is ignored by readers and truncated by the next writer
+    # Readers see the records committed by the writer up to the last sync, refresh maps the records committed since the reader was opened
+    _extensions = ('.records', '.weights', '.index', '.meta')
+
+    def __init__(self, file_name, read_only=False):
+        self._file_name = file_name
+        self._read_only = read_only
+        self._meta = {}
+        self._meta_changed = False
+        self._pending_index = bytearray()
+        if os.path.exists(file_name + '.meta'):
+            with open(file_name + '.meta', 'rb') as file:
+                self._meta = pickle.load(file)
+        if read_only:
+            if not RecordLog.exists(file_name):
+                raise ValueError('File not found: {}'.format(file_name))
+            self._records_file = open(file_name + '.records', 'rb')
+            self._weights_file = open(file_name + '.weights', 'rb')
+            self._index_file = open(file_name + '.index', 'rb')
+        else:
+            for extension in ('.records', '.weights', '.index'):
+                if not os.path.exists(file_name + extension):
+                    open(file_name + extension, 'wb').close()
+            self._records_file = open(file_name + '.records', 'r+b')
+            self._weights_file = open(file_name + '.weights', 'r+b')
+            self._index_file = open(file_name + '.index', 'r+b')
+            self._recover()
+            self._records_file.seek(0, os.SEEK_END)
+            self._weights_file.seek(0, os.SEEK_END)
+            self._index_file.seek(0, os.SEEK_END)
+        self._records_end = os.fstat(self._records_file.fileno()).st_size
+        self._length = os.fstat(self._index_file.fileno()).st_size // 8
+        self._synced_length = self._length
+        self._records_map = None
+        self._index_map = None
+        self._mapped_length = 0
+        self._closed = False
+
+    @staticmethod
+    def exists(file_name):
+        return os.path.exists(file_name + '.index')
+
+    def _recover(self):
+        # Truncates data not committed by an index entry, e.g., after a crash of the writer
+        length = min(os.fstat(self._index_file.fileno()).st_size, os.fstat(self._weights_file.fileno()).st_size) // 8
+        records_size = os.fstat(self._records_file.fileno()).st_size
+        records_end = 0
+        while length > 0:
+            self._index_file.seek((length - 1) * 8)
+            offset, = struct.unpack('<Q', self._index_file.read(8))
+            self._records_file.seek(offset)
+            header = self._records_file.read(8)
+            if len(header) == 8 and offset + 8 + struct.unpack('<Q', header)[0] <= records_size:
+                records_end = offset + 8 + struct.unpack('<Q', header)[0]
+                break
+            length -= 1
+        self._index_file.truncate(length * 8)
+        self._weights_file.truncate(length * 8)
+        self._records_file.truncate(records_end)
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, key):
+        return key in self._meta
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.get_record(key)
+        return self._meta[key]
+
+    def __setitem__(self, key, value):
+        if self._read_only:
+            raise RuntimeError('RecordLog is read-only.')
+        self._meta[key] = value
+        self._meta_changed = True
+
+    def append(self, value, weight):
+        if self._read_only:
+            raise RuntimeError('RecordLog is read-only.')
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._records_file.write(struct.pack('<Q', len(data)))
+        self._records_file.write(data)
+        self._weights_file.write(struct.pack('<d', weight))
+        self._pending_index += struct.pack('<Q', self._records_end)
+        self._records_end += 8 + len(data)
+        self._length += 1
+
+    def _map(self):
+        if self._records_map is not None:
+            self._records_map.close()
+            self._index_map.close()
+            self._records_map = None
+            self._index_map = None
+        self._mapped_length = 0
+        if self._synced_length > 0:
+            self._records_map = mmap.mmap(self._records_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_map = mmap.mmap(self._index_file.fileno(), self._synced_length * 8, access=mmap.ACCESS_READ)
+            self._mapped_length = self._synced_length
+
+    def refresh(self):
+        # Makes the records committed since opening, and the metadata written with them, visible to a reader
+        if self._read_only:
+            self._synced_length = os.fstat(self._index_file.fileno()).st_size // 8
+            self._length = self._synced_length
+            if os.path.exists(self._file_name + '.meta'):
+                with open(self._file_name + '.meta', 'rb') as file:
+                    self._meta = pickle.load(file)
+
+    def get_record(self, index):
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError('Record index out of range: {}'.format(index))
+        if index >= self._synced_length:
+            self.sync()
+        if index >= self._mapped_length:
+            self._map()
+        offset, = struct.unpack_from('<Q', self._index_map, index * 8)
+        length, = struct.unpack_from('<Q', self._records_map, offset)
+        return pickle.loads(self._records_map[offset + 8:offset + 8 + length])
+
+    def weights(self):
+        # The weights of all records, as an array of float64
+        self._weights_file.flush()
+        weights = array.array('d')
+        with open(self._file_name + '.weights', 'rb') as file:
+            weights.fromfile(file, self._length)
+        return weights
+
+    def sync(self, durable=False):
+        if self._read_only:
+            return
+        # Records, weights and metadata (e.g., what records refer to) are written before the index entries that commit the records, with durable=True they are also written to disk
+        for file in (self._records_file, self._weights_file):
+            file.flush()
+            if durable:
+                os.fsync(file.fileno())
+        if self._meta_changed:
+            meta_file_name = self._file_name + '.meta'
+            with open(meta_file_name + '.tmp', 'wb') as file:
+                pickle.dump(self._meta, file, protocol=pickle.HIGHEST_PROTOCOL)
+                if durable:
+                    file.flush()
+                    os.fsync(file.fileno())
+            os.replace(meta_file_name + '.tmp', meta_file_name)
+            self._meta_changed = False
+        self._index_file.write(self._pending_index)
+        self._index_file.flush()
+        if durable:
+            os.fsync(self._index_file.fileno())
+        self._pending_index = bytearray()
+        self._synced_length = self._length
+
+    def close(self):
+        if self._closed:
+            return
+        self.sync(durable=True)
+        if self._records_map is not None:
+            self._records_map.close()
+            self._index_map.close()
+        for file in (self._records_file, self._weights_file, self._index_file):
+            file.close()
+        self._closed = True
@@ -79,18 +79,18 @@ def _trace_stats(trace_dist, use_address_base=True, reuse_ids_from_address_stats
     for i in range(trace_dist.length):
         trace = trace_dist._get_value(i)
         trace_weight = float(trace_dist._get_weight(i))
-        trace_str = ''.join([variable.address_base if use_address_base else variable.address for variable in trace.variables])
-        if trace_str not in traces:
-            if trace_str in trace_ids:
-                trace_id = trace_ids[trace_str]
+        trace_fingerprint = trace.fingerprint_base if use_address_base else trace.fingerprint
+        if trace_fingerprint not in traces:
+            if trace_fingerprint in trace_ids:
+                trace_id = trace_ids[trace_fingerprint]
             else:
                 trace_id = 'T' + str(len(trace_ids) + 1)
-                trace_ids[trace_str] = trace_id
+                trace_ids[trace_fingerprint] = trace_id
             address_id_sequence = ['START'] + [addresses[variable.address_base if use_address_base else variable.address]['address_id'] for variable in trace.variables] + ['END']
-            traces[trace_str] = {'count': 1, 'weight': trace_weight, 'trace_id': trace_id, 'trace': trace, 'address_id_sequence': address_id_sequence}
+            traces[trace_fingerprint] = {'count': 1, 'weight': trace_weight, 'trace_id': trace_id, 'trace': trace, 'address_id_sequence': address_id_sequence}
         else:
-            traces[trace_str]['count'] += 1
-            traces[trace_str]['weight'] += trace_weight
+            traces[trace_fingerprint]['count'] += 1
+            traces[trace_fingerprint]['weight'] += trace_weight
     traces = OrderedDict(sorted(traces.items(), key=lambda v: v[1]['count'], reverse=True))
     address_ids = [i for i in range(len(addresses))]
     address_weights = []
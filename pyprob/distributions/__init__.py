@@ -1,6 +1,6 @@
 from .distribution import Distribution
 from .categorical import Categorical
-from .empirical import Empirical
+from .empirical import Empirical, EmpiricalStorage
 from .normal import Normal
 from .multivariate_normal import MultivariateNormal
 from .log_normal import LogNormal
@@ -16,6 +16,9 @@ class Beta(Distribution):
     def __repr__(self):
         return 'Beta(concentration1:{}, concentration0:{}, low:{}, high:{})'.format(self.concentration1, self.concentration0, self.low, self.high)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.concentration1, self._torch_dist.concentration0, self._low, self._high)
+
     @property
     def concentration1(self):
         return self._torch_dist.concentration1
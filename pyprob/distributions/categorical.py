@@ -23,6 +23,9 @@ class Categorical(Distribution):
     def __repr__(self):
         return 'Categorical(num_categories: {}, probs:{})'.format(self.num_categories, self.probs)
 
+    def _constructor_parameters(self):
+        return (self._probs,)
+
     @property
     def num_categories(self):
         return self._num_categories
@@ -11,6 +11,10 @@ class Distribution():
         self._event_shape = event_shape
         self._torch_dist = torch_dist
 
+    def _constructor_parameters(self):
+        # Arguments of the constructor rebuilding the distribution (e.g., in a PackedTrace), None if the distribution is not rebuilt from them
+        return None
+
     @property
     def batch_shape(self):
         if self._torch_dist is not None:
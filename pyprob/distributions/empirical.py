@@ -15,6 +15,8 @@ from termcolor import colored
 
 from . import Distribution
 from .. import util
+from ..trace import Trace, TraceSkeletons, PackedTraceRecord
+from ..concurrency import RecordLog
 
 
 class EmpiricalType(enum.Enum):
@@ -24,25 +26,117 @@ class EmpiricalType(enum.Enum):
     CONCAT_FILE = 4
 
 
+class EmpiricalStorage(enum.Enum):
+    SHELVE = 0  # Values pickled in a shelf, the weights added since the last sync written as a chunk at each sync
+    RECORD_LOG = 1  # Values appended to a RecordLog with their weights, see concurrency.RecordLog
+
+
+class _Float64Array():
+    # Contiguous float64 array with amortized constant time appends, values is a view (not a copy) of the filled part
+    def __init__(self, values=None, capacity=16):
+        if values is None:
+            values = np.empty(0, dtype=np.float64)
+        else:
+            values = np.asarray(values, dtype=np.float64).reshape(-1)
+        self._length = len(values)
+        self._array = np.empty(max(capacity, self._length), dtype=np.float64)
+        self._array[:self._length] = values
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.values.tolist())
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def append(self, value):
+        if self._length == len(self._array):
+            array = np.empty(2 * len(self._array), dtype=np.float64)
+            array[:self._length] = self._array[:self._length]
+            self._array = array
+        self._array[self._length] = value
+        self._length += 1
+
+    @property
+    def values(self):
+        return self._array[:self._length]
+
+    def __getstate__(self):
+        return (self.values.copy(),)
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+
+
+class _ConcatFloat64Array():
+    # Read-only concatenation of _Float64Arrays, values concatenates them on first access only
+    def __init__(self, arrays):
+        self._arrays = arrays
+        self._cum_lengths = np.cumsum([len(array) for array in arrays])
+        self._values = None
+
+    def __len__(self):
+        return int(self._cum_lengths[-1]) if len(self._arrays) > 0 else 0
+
+    def __iter__(self):
+        return (value for array in self._arrays for value in array)
+
+    def __getitem__(self, index):
+        if self._values is None and isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            i = int(np.searchsorted(self._cum_lengths, index, side='right'))
+            return self._arrays[i][index - (int(self._cum_lengths[i - 1]) if i > 0 else 0)]
+        return self.values[index]
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.concatenate([array.values for array in self._arrays]) if len(self._arrays) > 0 else np.empty(0, dtype=np.float64)
+        return self._values
+
+    def __reduce__(self):
+        return (_Float64Array, (self.values,))
+
+
 class Empirical(Distribution):
-    def __init__(self, values=None, log_weights=None, weights=None, file_name=None, file_read_only=False, file_sync_timeout=25, file_writeback=False, concat_empiricals=None, concat_empirical_file_names=None, name='Empirical'):
+    # Number of values mapped and reduced at once by expectation
+    _expectation_chunk_size = 4096
+
+    def __init__(self, values=None, log_weights=None, weights=None, file_name=None, file_read_only=False, file_sync_timeout=25, file_writeback=False, concat_empiricals=None, concat_empirical_file_names=None, name='Empirical', pack_traces=False, file_storage=EmpiricalStorage.SHELVE, streaming_statistics=False):
         super().__init__(name)
         self._finalized = False
         self._read_only = file_read_only
+        if file_name is not None and RecordLog.exists(file_name):
+            file_storage = EmpiricalStorage.RECORD_LOG
         if self._read_only:
-            if not os.path.exists(file_name):
+            if not os.path.exists(file_name) and file_storage != EmpiricalStorage.RECORD_LOG:
                 raise ValueError('File not found: {}'.format(file_name))
             shelf_flag = 'r'
         else:
             shelf_flag = 'c'
         self._file_name = file_name
+        self._file_storage = file_storage
         self._closed = False
-        self._categorical = None
-        self._log_weights = []
+        # Log weights are kept in a float64 array, the Categorical, uniform weights check and effective sample size are computed from it on first use
+        self._log_weights = _Float64Array()
+        # With SHELVE storage, the number of weights and chunks of weights written by finalize
+        self._file_log_weights_saved = 0
+        self._file_log_weights_chunks = 0
+        self._categorical_cache = None
+        self._uniform_weights_cache = None
+        # Statistics updated at each add, used instead of a pass over the values when they cover all values
+        # The log-weight statistics are always kept, the moments and quantile sketch of numeric values with streaming_statistics
+        self._log_weight_statistics = util.LogWeightStatistics()
+        self._running_moments = util.WeightedRunningMoments(dtype=torch.float64) if streaming_statistics else None
+        self._quantile_sketch = util.WeightedQuantileSketch() if streaming_statistics else None
         self._length = 0
-        self._uniform_weights = False
         self._type = None
         self._metadata = OrderedDict()
+        # With pack_traces, traces are stored as PackedTraces sharing the skeletons of traces with the same structure
+        self._trace_skeletons = TraceSkeletons() if pack_traces else None
         if concat_empiricals is not None or concat_empirical_file_names is not None:
             if concat_empiricals is not None:
                 if type(concat_empiricals) == list:
@@ -63,11 +157,12 @@ class Empirical(Distribution):
                     raise TypeError('Expecting concat_empirical_file_names to be a list of file names.')
             self._concat_cum_sizes = np.cumsum([emp.length for emp in self._concat_empiricals])
             self._length = self._concat_cum_sizes[-1]
-            self._log_weights = torch.cat([util.to_tensor(emp._log_weights) for emp in self._concat_empiricals])
-            self._categorical = torch.distributions.Categorical(logits=util.to_tensor(self._log_weights, dtype=torch.float64))
-            weights = self._categorical.probs
-            self._effective_sample_size = 1. / weights.pow(2).sum()
-            name = 'Concatenated empirical, length: {:,}, ESS: {:,.2f}'.format(self._length, self._effective_sample_size)
+            self._concat_log_weights()
+            if self._log_weight_statistics.length == self._length:
+                effective_sample_size = self._log_weight_statistics.effective_sample_size
+            else:
+                effective_sample_size = float(self._compute_effective_sample_size())
+            name = 'Concatenated empirical, length: {:,}, ESS: {:,.2f}'.format(self._length, effective_sample_size)
             # self._metadata.append('Begin concatenate empiricals ({})'.format(len(self._concat_empiricals)))
             # for i, emp in enumerate(self._concat_empiricals):
             #     self._metadata.append('Begin source empirical ({}/{})'.format(i+1, len(self._concat_empiricals)))
@@ -97,15 +192,17 @@ class Empirical(Distribution):
                 self._type = EmpiricalType.MEMORY
                 self._values = []
             else:
-                self._shelf = shelve.open(self._file_name, flag=shelf_flag, writeback=file_writeback)
+                if file_storage == EmpiricalStorage.RECORD_LOG:
+                    self._shelf = RecordLog(self._file_name, read_only=self._read_only)
+                else:
+                    self._shelf = shelve.open(self._file_name, flag=shelf_flag, writeback=file_writeback)
                 if 'concat_empirical_file_names' in self._shelf:
                     self._type = EmpiricalType.CONCAT_FILE
                     concat_empirical_file_names = self._shelf['concat_empirical_file_names']
                     self._concat_empiricals = [Empirical(file_name=f, file_read_only=True) for f in concat_empirical_file_names]
                     self._concat_cum_sizes = np.cumsum([emp.length for emp in self._concat_empiricals])
                     self._length = self._concat_cum_sizes[-1]
-                    self._log_weights = torch.cat([util.to_tensor(emp._log_weights) for emp in self._concat_empiricals])
-                    self._categorical = torch.distributions.Categorical(logits=util.to_tensor(self._log_weights, dtype=torch.float64))
+                    self._concat_log_weights()
                     self.name = self._shelf['name']
                     if 'metadata' in self._shelf:
                         self._metadata = self._shelf['metadata']
@@ -117,12 +214,36 @@ class Empirical(Distribution):
                         self.name = self._shelf['name']
                     if 'metadata' in self._shelf:
                         self._metadata = self._shelf['metadata']
-                    if 'log_weights' in self._shelf:
-                        self._log_weights = self._shelf['log_weights']
+                    if '__trace_skeletons' in self._shelf:
+                        self._trace_skeletons = self._shelf['__trace_skeletons']
+                    if '__streaming_statistics' in self._shelf:
+                        self._log_weight_statistics, self._running_moments, self._quantile_sketch = self._shelf['__streaming_statistics']
+                    if file_storage == EmpiricalStorage.RECORD_LOG:
+                        self._log_weights = _Float64Array(np.frombuffer(self._shelf.weights(), dtype=np.float64))
+                        self._file_last_key = len(self._log_weights) - 1
+                        self._length = len(self._log_weights)
+                    elif 'log_weights_chunks' in self._shelf:
+                        # Saved by finalize in chunks, each with the weights added since the previous finalize
+                        self._file_log_weights_chunks = self._shelf['log_weights_chunks']
+                        self._log_weights = _Float64Array(np.concatenate([self._shelf['log_weights_{}'.format(i)] for i in range(self._file_log_weights_chunks)]))
+                        self._file_log_weights_saved = len(self._log_weights)
+                        self._file_last_key = self._shelf['last_key']
+                        self._length = len(self._log_weights)
+                    elif 'log_weights' in self._shelf:
+                        log_weights = self._shelf['log_weights']
+                        if isinstance(log_weights, list):
+                            # Saved as a list of tensors
+                            log_weights = [float(log_weight) for log_weight in log_weights]
+                        self._log_weights = _Float64Array(log_weights)
                         self._file_last_key = self._shelf['last_key']
                         self._length = len(self._log_weights)
                     else:
                         self._file_last_key = -1
+                    if self._log_weight_statistics.length != len(self._log_weights):
+                        # Saved without the statistics, or with records recovered after them
+                        self._log_weight_statistics = util.LogWeightStatistics()
+                        for log_weight in self._log_weights:
+                            self._log_weight_statistics.add(log_weight)
                     self._file_sync_timeout = file_sync_timeout
                     self._file_sync_countdown = self._file_sync_timeout
                     self.finalize()
@@ -132,6 +253,7 @@ class Empirical(Distribution):
         self._min = None
         self._max = None
         self._effective_sample_size = None
+        self._stacked_values_cache = None
         self.add_metadata(name=self.name)
         if values is not None:
             if len(values) > 0:
@@ -176,14 +298,14 @@ class Empirical(Distribution):
             if file_name is None:
                 status = 'Copy Empirical(file_name: {}) to Empirical(memory)'.format(self._file_name)
                 print(status)
-                ret = Empirical(values=self.get_values(), log_weights=self._log_weights, name=self.name)
+                ret = Empirical(values=self.get_values(), log_weights=self._log_weights, name=self.name, pack_traces=self._trace_skeletons is not None)
                 ret._metadata = copy.deepcopy(self._metadata)
                 ret.add_metadata(op='copy', source='Empirical(file_name: {})'.format(self._file_name), target='Empirical(memory)')
                 return ret
             else:
                 status = 'Copy Empirical(file_name: {}) to Empirical(file_name: {})'.format(self._file_name, file_name)
                 print(status)
-                ret = Empirical(file_name=file_name, name=self.name)
+                ret = Empirical(file_name=file_name, name=self.name, pack_traces=self._trace_skeletons is not None, file_storage=self._file_storage)
                 for i in range(self._length):
                     ret.add(value=self._get_value(i), log_weight=self._log_weights[i])
                 ret.finalize()
@@ -201,29 +323,67 @@ class Empirical(Distribution):
             else:
                 status = 'Copy Empirical(memory) to Empirical(file_name: {})'.format(file_name)
                 print(status)
-                ret = Empirical(values=self._values, log_weights=self._log_weights, file_name=file_name, name=self.name)
+                ret = Empirical(values=self._values, log_weights=self._log_weights, file_name=file_name, name=self.name, pack_traces=self._trace_skeletons is not None)
                 ret._metadata = copy.deepcopy(self._metadata)
                 ret.add_metadata(op='copy', source='Empirical(memory)', target='Empirical(file_name: {})'.format(file_name))
                 return ret
         else:
             raise NotImplementedError('Not implemented for type: {}'.format(str(self._type)))
 
+    def _concat_log_weights(self):
+        # The weights of the concatenated empiricals are not copied, their statistics are combined
+        self._log_weights = _ConcatFloat64Array([emp._log_weights for emp in self._concat_empiricals])
+        if all(emp._log_weight_statistics.length == emp.length for emp in self._concat_empiricals):
+            for emp in self._concat_empiricals:
+                self._log_weight_statistics.update(emp._log_weight_statistics)
+
     def finalize(self):
         self._length = len(self._log_weights)
-        self._categorical = torch.distributions.Categorical(logits=util.to_tensor(self._log_weights, dtype=torch.float64))
-        self.add_metadata(op='finalize', length=self._length)
-        if self._length > 0:
-            self._uniform_weights = torch.eq(self._categorical.logits, self._categorical.logits[0]).all()
+        self._categorical_cache = None
+        self._uniform_weights_cache = None
+        # Finalizing again (e.g., at each sync of a file) updates the last finalize entry instead of adding one
+        last_metadata = list(self._metadata.values())[-1] if len(self._metadata) > 0 else None
+        if last_metadata is not None and last_metadata.get('op') == 'finalize':
+            last_metadata['length'] = self._length
         else:
-            self._uniform_weights = False
+            self.add_metadata(op='finalize', length=self._length)
         if self._type == EmpiricalType.FILE and not self._read_only:
             self._shelf['name'] = self.name
             self._shelf['metadata'] = self._metadata
-            self._shelf['log_weights'] = self._log_weights
-            self._shelf['last_key'] = self._file_last_key
+            if self._file_storage == EmpiricalStorage.SHELVE:
+                # Only the weights added since the last finalize are written, as a new chunk
+                if len(self._log_weights) > self._file_log_weights_saved:
+                    self._shelf['log_weights_{}'.format(self._file_log_weights_chunks)] = self._log_weights.values[self._file_log_weights_saved:].copy()
+                    self._file_log_weights_chunks += 1
+                    self._file_log_weights_saved = len(self._log_weights)
+                    self._shelf['log_weights_chunks'] = self._file_log_weights_chunks
+                self._shelf['last_key'] = self._file_last_key
+            if self._trace_skeletons is not None:
+                self._shelf['__trace_skeletons'] = self._trace_skeletons
+            self._shelf['__streaming_statistics'] = (self._log_weight_statistics, self._running_moments, self._quantile_sketch)
             self._shelf.sync()
         self._finalized = True
 
+    @property
+    def _categorical(self):
+        if self._categorical_cache is None:
+            self._categorical_cache = torch.distributions.Categorical(logits=torch.from_numpy(self._log_weights.values))
+        return self._categorical_cache
+
+    @property
+    def _uniform_weights(self):
+        if self._uniform_weights_cache is None:
+            log_weights = self._log_weights.values
+            self._uniform_weights_cache = bool(len(log_weights) > 0 and (log_weights == log_weights[0]).all())
+        return self._uniform_weights_cache
+
+    def _compute_effective_sample_size(self):
+        log_weights = self._log_weights.values
+        if len(log_weights) == 0:
+            return torch.tensor(0., dtype=torch.float64)
+        weights = np.exp(log_weights - log_weights.max())
+        return torch.tensor(weights.sum()**2 / (weights**2).sum(), dtype=torch.float64)
+
     def _check_finalized(self):
         if not self._finalized:
             raise RuntimeError('Empirical not finalized. Call finalize first.')
@@ -238,23 +398,86 @@ class Empirical(Distribution):
         self._min = None
         self._max = None
         self._effective_sample_size = None
+        self._stacked_values_cache = None
+        self._categorical_cache = None
+        self._uniform_weights_cache = None
         if log_weight is not None:
-            self._log_weights.append(util.to_tensor(log_weight))
+            self._log_weights.append(float(log_weight))
         elif weight is not None:
-            self._log_weights.append(torch.log(util.to_tensor(weight)))
+            self._log_weights.append(float(torch.log(util.to_tensor(weight))))
         else:
-            self._log_weights.append(util.to_tensor(0.))
-
+            self._log_weights.append(0.)
+        self._add_streaming_statistics(value, self._log_weights[-1])
+
+        if self._trace_skeletons is not None and isinstance(value, Trace):
+            num_trace_skeletons = len(self._trace_skeletons)
+            value = self._trace_skeletons.pack(value)
+            if self._type == EmpiricalType.FILE and self._file_storage == EmpiricalStorage.RECORD_LOG and len(self._trace_skeletons) > num_trace_skeletons:
+                # A new skeleton is written into the metadata of the RecordLog with the first record using it, at the next sync
+                self._shelf['__trace_skeletons'] = self._trace_skeletons
         if self._type == EmpiricalType.FILE:
             self._file_last_key += 1
-            self._shelf[str(self._file_last_key)] = value
+            if self._trace_skeletons is not None and isinstance(value, Trace):
+                value = value.record
             self._file_sync_countdown -= 1
-            if self._file_sync_countdown == 0:
-                self.finalize()
-                self._file_sync_countdown = self._file_sync_timeout
+            if self._file_storage == EmpiricalStorage.RECORD_LOG:
+                # The weights are in the RecordLog, a sync only commits the records added since the last one
+                self._shelf.append(value, float(self._log_weights[-1]))
+                if self._file_sync_countdown == 0:
+                    self._shelf.sync()
+                    self._file_sync_countdown = self._file_sync_timeout
+            else:
+                self._shelf[str(self._file_last_key)] = value
+                if self._file_sync_countdown == 0:
+                    self.finalize()
+                    self._file_sync_countdown = self._file_sync_timeout
         else:
             self._values.append(value)
 
+    def _add_streaming_statistics(self, value, log_weight):
+        self._log_weight_statistics.add(log_weight)
+        if self._running_moments is None and self._quantile_sketch is None:
+            return
+        if log_weight == -math.inf or math.isnan(log_weight):
+            # Counted, without reading values with zero weight
+            if self._running_moments is not None:
+                self._running_moments.add(None, log_weight)
+            if self._quantile_sketch is not None:
+                self._quantile_sketch.add(None, log_weight)
+            return
+        try:
+            value = util.to_tensor(value, dtype=torch.float64)
+        except (TypeError, ValueError, RuntimeError):
+            value = None
+        if value is None or value.requires_grad:
+            # Non-numeric values, or values the mean and variance need to stay differentiable with respect to
+            self._running_moments = None
+            self._quantile_sketch = None
+            return
+        if self._running_moments is not None:
+            try:
+                self._running_moments.add(value, log_weight)
+            except ValueError:
+                # Values of different shapes
+                self._running_moments = None
+        if self._quantile_sketch is not None:
+            if value.numel() == 1:
+                self._quantile_sketch.add(float(value), log_weight)
+            else:
+                self._quantile_sketch = None
+
+    def _streaming_moments(self):
+        moments = self._running_moments
+        if moments is not None and moments.length == self._length and self._log_weight_statistics.log_sum_weights > -math.inf:
+            return moments
+        return None
+
+    def _streaming_quantile_sketch(self):
+        sketch = self._quantile_sketch
+        if sketch is not None and sketch.length == self._length and self._length > 0:
+            return sketch
+        return None
+
     def add_sequence(self, values, log_weights=None, weights=None):
         if self._read_only:
             raise RuntimeError('Empirical is read-only.')
@@ -281,7 +504,7 @@ class Empirical(Distribution):
         elif self._type == EmpiricalType.FILE:
             if index < 0:
                 index = self._length + index
-            return self._shelf[str(index)]
+            return self._unpack(self._shelf[index if self._file_storage == EmpiricalStorage.RECORD_LOG else str(index)])
         else:  # CONCAT_MEMORY or CONCAT_FILE
             emp_index = self._concat_cum_sizes.searchsorted(index, 'right')
             if emp_index > 0:
@@ -299,10 +522,15 @@ class Empirical(Distribution):
         if self._type == EmpiricalType.MEMORY:
             return self._values
         elif self._type == EmpiricalType.FILE:
-            return [self._shelf[str(i)] for i in range(self._length)]
+            return [self._get_value(i) for i in range(self._length)]
         else:
             raise NotImplementedError('Not implemented for type: {}'.format(str(self._type)))
 
+    def _unpack(self, value):
+        if isinstance(value, PackedTraceRecord):
+            return self._trace_skeletons.unpack(value)
+        return value
+
     def sample(self, min_index=None, max_index=None):
         self._check_finalized()
         if self._uniform_weights:
@@ -335,21 +563,69 @@ class Empirical(Distribution):
         else:
             return self._get_value(index)
 
+    def _iter_values(self, indices=None):
+        if indices is not None:
+            return (self._get_value(int(i)) for i in indices)
+        if self._type == EmpiricalType.MEMORY:
+            return iter(self._values)
+        return (self._get_value(i) for i in range(self._length))
+
+    def _support(self):
+        # Indices of the values with nonzero weight, None when all weights are nonzero
+        # Values with zero weight (e.g., traces pruned with TracePruning.ZERO_WEIGHT, with result None) are left out of the statistics
+        nonzero = self._log_weights.values > -math.inf
+        if nonzero.all():
+            return None
+        return np.flatnonzero(nonzero)
+
+    def _support_probs(self):
+        probs = self._categorical.probs
+        indices = self._support()
+        if indices is not None:
+            probs = probs[torch.from_numpy(indices)]
+        return probs
+
+    @staticmethod
+    def _stack(values):
+        # Stacks numeric values of the same shape into one float64 tensor, returns None for other values
+        try:
+            return torch.stack([util.to_tensor(value, dtype=torch.float64) for value in values])
+        except (TypeError, ValueError, RuntimeError):
+            return None
+
+    def _stacked_values(self):
+        # The values stacked by _stack, kept for the statistics computed from them until the next add
+        if self._stacked_values_cache is None:
+            stacked = self._stack(self._iter_values(self._support())) if self._length > 0 else None
+            self._stacked_values_cache = False if stacked is None else stacked
+        return None if self._stacked_values_cache is False else self._stacked_values_cache
+
+    def _weighted_sum(self, stacked):
+        probs = self._support_probs().to(device=stacked.device)
+        return (probs.view((-1,) + (1,) * (stacked.dim() - 1)) * stacked).sum(0)
+
     def expectation(self, func):
         self._check_finalized()
+        # Values are mapped by func and reduced in chunks of _expectation_chunk_size, the numeric values of a chunk at once and other values one by one
+        indices = self._support()
+        if indices is None:
+            indices = np.arange(self._length)
+        probs = self._support_probs()
         ret = 0.
-        if self._type == EmpiricalType.MEMORY:
-            if self._uniform_weights:
-                ret = sum(map(func, self._values)) / self._length
+        values_sum = None
+        for start in range(0, len(indices), self._expectation_chunk_size):
+            values = [func(value) for value in self._iter_values(indices[start:start + self._expectation_chunk_size])]
+            chunk_probs = probs[start:start + len(values)]
+            stacked = self._stack(values)
+            if stacked is not None:
+                ret = ret + (chunk_probs.to(device=stacked.device).view((-1,) + (1,) * (stacked.dim() - 1)) * stacked).sum(0)
+            elif self._uniform_weights:
+                values_sum = sum(values) if values_sum is None else values_sum + sum(values)
             else:
-                for i in range(self._length):
-                    ret += util.to_tensor(func(self._values[i]), dtype=torch.float64) * self._categorical.probs[i]
-        elif self._type == EmpiricalType.FILE:
-            for i in range(self._length):
-                ret += util.to_tensor(func(self._shelf[str(i)]), dtype=torch.float64) * self._categorical.probs[i]
-        else:  # CONCAT_MEMORY or CONCAT_FILE
-            for i in range(self._length):
-                ret += util.to_tensor(func(self._get_value(i)), dtype=torch.float64) * self._categorical.probs[i]
+                for i in range(len(values)):
+                    ret = ret + util.to_tensor(values[i], dtype=torch.float64) * chunk_probs[i]
+        if values_sum is not None:
+            ret = ret + values_sum / self._length
         return util.to_tensor(ret)
 
     def map(self, func, *args, **kwargs):
@@ -378,25 +654,40 @@ class Empirical(Distribution):
         ret.add_metadata(op='filter', length=len(self), length_after=len(filtered_values), func=util.get_source(func))
         return ret
 
-    def resample(self, num_samples, map_func=None, min_index=None, max_index=None, *args, **kwargs):
+    def resample_indices(self, num_samples, resampling=util.Resampling.MULTINOMIAL, min_index=None, max_index=None):
+        # Indices in ascending order, drawn without reading any values
+        self._check_finalized()
+        if min_index is None:
+            min_index = 0
+        if max_index is None:
+            max_index = self.length
+        log_weights = self._log_weights.values[min_index:max_index]
+        if len(log_weights) == 0:
+            raise ValueError('Empirical is empty')
+        weights = np.exp(log_weights - log_weights.max())
+        return min_index + util.resample_indices(weights, num_samples, resampling)
+
+    def resample(self, num_samples, map_func=None, min_index=None, max_index=None, resampling=util.Resampling.MULTINOMIAL, *args, **kwargs):
         self._check_finalized()
-        # TODO: improve this with a better resampling algorithm
         if map_func is None:
             map_func = lambda x: x
         if min_index is None:
             min_index = 0
         if max_index is None:
             max_index = self.length
+        indices, counts = np.unique(self.resample_indices(num_samples, resampling, min_index, max_index), return_counts=True)
+        # Each selected value is read and mapped once, in index order
         values = []
-        status = 'Resample, num_samples: {}, min_index: {}, max_index: {}'.format(num_samples, min_index, max_index)
-        util.progress_bar_init(status, num_samples, 'Samples')
-        for i in range(num_samples):
+        status = 'Resample, num_samples: {}, resampling: {}, min_index: {}, max_index: {}'.format(num_samples, resampling, min_index, max_index)
+        util.progress_bar_init(status, len(indices), 'Values')
+        for i in range(len(indices)):
             util.progress_bar_update(i)
-            values.append(map_func(self.sample(min_index=None, max_index=None)))
+            value = map_func(self._get_value(int(indices[i])))
+            values.extend([value] * int(counts[i]))
         util.progress_bar_end()
         ret = Empirical(values=values, name=self.name, *args, **kwargs)
         ret._metadata = copy.deepcopy(self._metadata)
-        ret.add_metadata(op='resample', length=len(self), num_samples=int(num_samples), min_index=int(min_index), max_index=int(max_index))
+        ret.add_metadata(op='resample', length=len(self), num_samples=int(num_samples), resampling=str(resampling), min_index=int(min_index), max_index=int(max_index))
         return ret
 
     def thin(self, num_samples, map_func=None, min_index=None, max_index=None, *args, **kwargs):
@@ -426,14 +717,33 @@ class Empirical(Distribution):
     @property
     def mean(self):
         if self._mean is None:
-            self._mean = self.expectation(lambda x: x)
+            self._check_finalized()
+            moments = self._streaming_moments()
+            if moments is not None:
+                self._mean = util.to_tensor(moments.mean)
+                return self._mean
+            stacked = self._stacked_values()
+            if stacked is None:
+                self._mean = self.expectation(lambda x: x)
+            else:
+                self._mean = util.to_tensor(self._weighted_sum(stacked))
         return self._mean
 
     @property
     def variance(self):
         if self._variance is None:
-            mean = self.mean
-            self._variance = self.expectation(lambda x: (x - mean)**2)
+            self._check_finalized()
+            moments = self._streaming_moments()
+            if moments is not None:
+                self._variance = util.to_tensor(moments.variance)
+                return self._variance
+            stacked = self._stacked_values()
+            if stacked is None:
+                mean = self.mean
+                self._variance = self.expectation(lambda x: (x - mean)**2)
+            else:
+                # Centered on the float64 mean of the stacked values, read once for both mean and variance
+                self._variance = util.to_tensor(self._weighted_sum((stacked - self._weighted_sum(stacked))**2))
         return self._variance
 
     @property
@@ -454,8 +764,7 @@ class Empirical(Distribution):
                 util.progress_bar_end()
                 self._mode = sorted(counts.items(), key=lambda x: x[1], reverse=True)[0][0]
             else:
-                _, max_index = util.to_tensor(self._log_weights).max(-1)
-                self._mode = self._get_value(int(max_index))
+                self._mode = self._get_value(int(np.argmax(self._log_weights.values)))
         return self._mode
 
     def arg_max(self, map_func):
@@ -490,8 +799,10 @@ class Empirical(Distribution):
     def effective_sample_size(self):
         self._check_finalized()
         if self._effective_sample_size is None:
-            weights = self._categorical.probs
-            self._effective_sample_size = 1. / weights.pow(2).sum()
+            if self._log_weight_statistics.length == self._length:
+                self._effective_sample_size = torch.tensor(self._log_weight_statistics.effective_sample_size, dtype=torch.float64)
+            else:
+                self._effective_sample_size = self._compute_effective_sample_size()
             # log_weights = self._categorical.logits
             # self._effective_sample_size = torch.exp(2. * torch.logsumexp(log_weights, dim=0) - torch.logsumexp(2. * log_weights, dim=0))
         return self._effective_sample_size
@@ -504,8 +815,18 @@ class Empirical(Distribution):
         return ret
 
     def _find_min_max(self):
+        sketch = self._streaming_quantile_sketch()
+        if sketch is not None:
+            self._min = sketch.min
+            self._max = sketch.max
+            return
+        stacked = self._stacked_values()
+        if stacked is not None and stacked.dim() == 1:
+            self._min = float(stacked.min())
+            self._max = float(stacked.max())
+            return
         try:
-            sorted_values = sorted(map(float, self.get_values()))
+            sorted_values = sorted(map(float, self._iter_values(self._support())))
             self._min = sorted_values[0]
             self._max = sorted_values[-1]
         except:
@@ -523,6 +844,22 @@ class Empirical(Distribution):
             self._find_min_max()
         return self._max
 
+    def quantile(self, q):
+        self._check_finalized()
+        if not 0. <= q <= 1.:
+            raise ValueError('Expecting q in [0, 1], received: {}'.format(q))
+        # Approximate with the streaming quantile sketch, otherwise exact from the sorted values
+        sketch = self._streaming_quantile_sketch()
+        if sketch is not None:
+            return sketch.quantile(q)
+        stacked = self._stacked_values()
+        if stacked is None or stacked.dim() != 1:
+            raise RuntimeError('Cannot compute quantiles of values in this Empirical. Make sure the distribution is over values that are scalar or castable to scalar, e.g., a PyTorch tensor of one element.')
+        sorted_values, indices = stacked.sort()
+        cumulative_weights = np.cumsum(util.to_numpy(self._support_probs())[util.to_numpy(indices)])
+        index = min(int(np.searchsorted(cumulative_weights, q * cumulative_weights[-1])), len(sorted_values) - 1)
+        return float(sorted_values[index])
+
     def combine_duplicates(self, *args, **kwargs):
         self._check_finalized()
         if self._type == EmpiricalType.MEMORY:
@@ -535,7 +872,7 @@ class Empirical(Distribution):
                     for key, value in distribution.items():
                         if torch.equal(util.to_tensor(key), util.to_tensor(self._values[i])):
                             # Differentiability warning: values[i] is discarded here. If we need to differentiate through all values, the gradients of values[i] and key should be tied here.
-                            distribution[key] = torch.logsumexp(torch.stack((value, self._log_weights[i])), dim=0)
+                            distribution[key] = torch.logsumexp(torch.stack((util.to_tensor(value), util.to_tensor(self._log_weights[i]))), dim=0)
                             found = True
                     if not found:
                         distribution[self._values[i]] = self._log_weights[i]
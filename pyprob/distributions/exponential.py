@@ -12,6 +12,9 @@ class Exponential(Distribution):
     def __repr__(self):
         return 'Exponential(rate:{})'.format(self.rate)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.rate,)
+
     def cdf(self, value):
         return self._torch_dist.cdf(value)
 
@@ -13,6 +13,9 @@ class Gamma(Distribution):
     def __repr__(self):
         return 'Gamma(concentration:{}, rate:{})'.format(self.concentration, self.rate)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.concentration, self._torch_dist.rate)
+
     def cdf(self, value):
         return self._torch_dist.cdf(value)
 
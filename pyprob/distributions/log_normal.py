@@ -13,6 +13,9 @@ class LogNormal(Distribution):
     def __repr__(self):
         return 'LogNormal(mean:{}, stddev:{})'.format(self.loc, self.scale)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.loc, self._torch_dist.scale)
+
     def cdf(self, value):
         return self._torch_dist.cdf(value)
 
@@ -13,6 +13,9 @@ class Normal(Distribution):
     def __repr__(self):
         return 'Normal(mean:{}, stddev:{})'.format(self.mean, self.stddev)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.loc, self._torch_dist.scale)
+
     def cdf(self, value):
         return self._torch_dist.cdf(value)
 
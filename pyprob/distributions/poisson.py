@@ -12,6 +12,9 @@ class Poisson(Distribution):
     def __repr__(self):
         return 'Poisson(rate: {})'.format(self.rate)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.rate,)
+
     @property
     def rate(self):
         return self._torch_dist.mean
@@ -36,6 +36,9 @@ class TruncatedNormal(Distribution):
     def __repr__(self):
         return 'TruncatedNormal(mean_non_truncated:{}, stddev_non_truncated:{}, low:{}, high:{})'.format(self._mean_non_truncated, self._stddev_non_truncated, self._low, self._high)
 
+    def _constructor_parameters(self):
+        return (self._mean_non_truncated, self._stddev_non_truncated, self._low, self._high)
+
     def log_prob(self, value, sum=False):
         value = util.to_tensor(value)
         # TODO: With the following handling of low and high bounds, the derivative is not correct for a value outside the truncation domain
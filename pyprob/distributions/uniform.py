@@ -13,6 +13,9 @@ class Uniform(Distribution):
     def __repr__(self):
         return 'Uniform(low: {}, high: {})'.format(self.low, self.high)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.low, self._torch_dist.high)
+
     @property
     def low(self):
         return self._torch_dist.low
@@ -13,6 +13,9 @@ class Weibull(Distribution):
     def __repr__(self):
         return 'Weibull(scale:{},concentration:{})'.format(self.scale, self.concentration)
 
+    def _constructor_parameters(self):
+        return (self._torch_dist.scale, self._torch_dist.concentration)
+
     def cdf(self, value):
         return self._torch_dist.cdf(value)
 
@@ -6,15 +6,116 @@ import math
 import random
 from termcolor import colored
 
-from .distributions import Empirical
-from . import util, state, TraceMode, PriorInflation, InferenceEngine, InferenceNetwork, Optimizer, LearningRateScheduler, AddressDictionary
+from .distributions import Empirical, EmpiricalStorage
+from .trace import Trace, TraceColumns, TraceHash
+from . import util, state, TraceMode, PriorInflation, InferenceEngine, TracePruning, TraceRecording, TraceRetention, Resampling, InferenceNetwork, Optimizer, LearningRateScheduler, AddressDictionary
 from .nn import InferenceNetwork as InferenceNetworkBase
 from .nn import OnlineDataset, OfflineDataset, InferenceNetworkFeedForward, InferenceNetworkLSTM
 from .remote import ModelServer
 
 
+# The model and arguments of the traces being generated by a process pool, inherited by the worker processes when they are forked (so that they, including map_func, do not need to be pickled)
+_traces_worker_model = None
+_traces_worker_args = None
+_traces_worker_kwargs = None
+
+
+def _traces_worker(args):
+    seed, num_traces = args
+    util.set_random_seed(seed)
+    torch.set_num_threads(1)
+    # Traces are hashed and packed in the parent process
+    _traces_worker_model.use_trace_hash = False
+    _traces_worker_model.pack_traces = False
+    traces = _traces_worker_model._traces(num_traces, *_traces_worker_args, **_traces_worker_kwargs)
+    num_traces_pruned = sum(metadata['num_traces_pruned'] for metadata in traces.metadata.values() if metadata.get('op') == 'trace_pruning')
+    return traces.get_values(), [float(log_weight) for log_weight in traces._log_weights], num_traces_pruned
+
+
+def _metropolis_hastings_chain_worker(args):
+    seed, chain = args
+    util.set_random_seed(seed)
+    torch.set_num_threads(1)
+    kwargs = dict(_traces_worker_kwargs)
+    if isinstance(kwargs.get('initial_trace'), list):
+        kwargs['initial_trace'] = kwargs['initial_trace'][chain]
+    if kwargs['file_name'] is None:
+        # Traces are hashed in the parent process
+        _traces_worker_model.use_trace_hash = False
+    else:
+        kwargs['file_name'] = '{}_chain_{}'.format(kwargs['file_name'], chain)
+    posterior = _traces_worker_model._metropolis_hastings_chain(*_traces_worker_args, **kwargs)
+    if kwargs['file_name'] is None:
+        return posterior.get_values(), [float(log_weight) for log_weight in posterior._log_weights], posterior.name, posterior.metadata
+    else:
+        posterior.close()
+        return kwargs['file_name']
+
+
+class PosteriorStream():
+    # Iterator over (value, log_weight) pairs of posterior samples as they are produced, with running estimates of the posterior
+    def __init__(self, generator, num_traces=None, map_func=None, no_grad=False):
+        self._generator = generator
+        self._num_traces = num_traces
+        if map_func is None:
+            map_func = lambda trace: trace
+        self._map_func = map_func
+        self._no_grad = no_grad
+        self._log_weight_statistics = util.LogWeightStatistics()
+        self._moments = util.WeightedRunningMoments()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed or (self._num_traces is not None and self.length >= self._num_traces):
+            self.close()
+            raise StopIteration
+        if self._no_grad:
+            with torch.no_grad():
+                trace = next(self._generator)
+        else:
+            trace = next(self._generator)
+        log_weight = trace.log_importance_weight
+        value = self._map_func(trace)
+        self._log_weight_statistics.add(log_weight)
+        if torch.is_tensor(value) or isinstance(value, (int, float)):
+            self._moments.add(value, log_weight)
+        return value, log_weight
+
+    def close(self):
+        if not self._closed:
+            self._generator.close()
+            self._closed = True
+
+    @property
+    def length(self):
+        return self._log_weight_statistics.length
+
+    @property
+    def effective_sample_size(self):
+        return self._log_weight_statistics.effective_sample_size
+
+    @property
+    def log_evidence(self):
+        return self._log_weight_statistics.log_evidence
+
+    @property
+    def mean(self):
+        return self._moments.mean
+
+    @property
+    def variance(self):
+        return self._moments.variance
+
+    @property
+    def stddev(self):
+        return self._moments.stddev
+
+
 class Model():
-    def __init__(self, name='Unnamed pyprob model', address_dict_file_name=None, use_trace_hash=None):
+    def __init__(self, name='Unnamed pyprob model', address_dict_file_name=None, use_trace_hash=None, use_static_addresses=False, trace_hash_file_name=None, trace_hash_codec='zlib', pack_traces=False, empirical_file_storage=EmpiricalStorage.SHELVE):
         super().__init__()
         self.name = name
         self._inference_network = None
@@ -23,10 +124,40 @@ class Model():
         else:
             self._address_dictionary = AddressDictionary(address_dict_file_name)
         self.use_trace_hash = use_trace_hash
+        self._trace_hash_file_name = trace_hash_file_name
+        self._trace_hash_codec = trace_hash_codec
+        self._num_trace_hashes = 0
+        if use_trace_hash and pack_traces:
+            raise ValueError('Expecting at most one of use_trace_hash and pack_traces.')
+        # With pack_traces, the Empiricals of traces store them as PackedTraces sharing the skeletons of traces with the same structure
+        self.pack_traces = pack_traces
+        # Storage of the file-backed Empiricals of traces (with file_name), see distributions.EmpiricalStorage
+        self.empirical_file_storage = empirical_file_storage
+        self.use_static_addresses = use_static_addresses
+        self._static_addresses = None
 
     def forward(self):
         raise NotImplementedError()
 
+    def _new_trace_hash(self):
+        # With use_trace_hash, each Empirical of traces gets its own TraceHash, which lives as long as the HashedTrace handles into it
+        if not self.use_trace_hash:
+            return None
+        if self._trace_hash_file_name is None:
+            file_name = None
+        else:
+            self._num_trace_hashes += 1
+            file_name = '{}_{}_{}'.format(self._trace_hash_file_name, os.getpid(), self._num_trace_hashes)
+        return TraceHash(file_name=file_name, codec=self._trace_hash_codec)
+
+    def _stored_value(self, value, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, trace_hash=None):
+        # Applies the trace retention policy and, with a trace_hash, keeps traces compressed in it and stored as HashedTrace handles
+        if isinstance(value, Trace):
+            value = value.retain(trace_retention, trace_retention_addresses)
+            if trace_hash is not None:
+                value = trace_hash.add(value)
+        return value
+
     def _trace_generator(self,
                          trace_mode=TraceMode.PRIOR,
                          prior_inflation=PriorInflation.DISABLED,
@@ -35,16 +166,36 @@ class Model():
                          observe=None,
                          metropolis_hastings_trace=None,
                          likelihood_importance=1.,
-                         file_name=None,
-                         file_sync_timeout=100,
+                         batch_size=None,
+                         trace_pruning_threshold=None,
+                         trace_recording=TraceRecording.FULL,
                          *args,
                          **kwargs):
-        state._init_traces(func=self.forward, trace_mode=trace_mode, prior_inflation=prior_inflation, inference_engine=inference_engine, inference_network=inference_network, observe=observe, metropolis_hastings_trace=metropolis_hastings_trace, address_dictionary=self._address_dictionary, likelihood_importance=likelihood_importance)
+        if self.use_static_addresses and self._static_addresses is None:
+            self._static_addresses = state._compile_static_addresses(self.forward)
+        trace_state = state._init_traces(func=self.forward, trace_mode=trace_mode, prior_inflation=prior_inflation, inference_engine=inference_engine, inference_network=inference_network, observe=observe, metropolis_hastings_trace=metropolis_hastings_trace, address_dictionary=self._address_dictionary, likelihood_importance=likelihood_importance, static_addresses=self._static_addresses if self.use_static_addresses else None, batch_size=batch_size, trace_recording=trace_recording)
+        if trace_pruning_threshold is not None:
+            state._set_trace_pruning_threshold(trace_state, trace_pruning_threshold)
         while True:
-            state._begin_trace(file_name=file_name, file_sync_timeout=file_sync_timeout)
-            result = self.forward(*args, **kwargs)
-            trace = state._end_trace(result)
-            yield trace
+            # The generator can be resumed from a different context than the one it was created in, or interleaved with other generators in the same context
+            state._set_trace_state(trace_state)
+            state._begin_trace()
+            try:
+                result = self.forward(*args, **kwargs)
+            except state._InterruptTrace:
+                if not trace_state.current_trace_pruned:
+                    raise
+                result = None
+            if batch_size is None:
+                trace = state._end_trace(result)
+                # A Metropolis Hastings chain sends its current trace, which the next trace will be proposed from
+                metropolis_hastings_trace = yield trace
+                if metropolis_hastings_trace is not None:
+                    state._set_metropolis_hastings_trace(trace_state, metropolis_hastings_trace)
+            else:
+                traces = state._end_trace(result)
+                for trace in traces:
+                    yield trace
 
     def _traces(self,
                 num_traces=10,
@@ -58,127 +209,388 @@ class Model():
                 file_name=None,
                 likelihood_importance=1.,
                 file_sync_timeout=1000,
+                batch_size=None,
+                num_workers=None,
+                target_effective_sample_size=None,
+                time_budget_sec=None,
+                trace_pruning=TracePruning.DISABLED,
+                trace_pruning_threshold=20.,
+                trace_recording=TraceRecording.FULL,
+                trace_retention=TraceRetention.ALL,
+                trace_retention_addresses=None,
                 *args, **kwargs):
+        if trace_pruning != TracePruning.DISABLED and batch_size is not None:
+            raise ValueError('Trace pruning is not supported with particle-batched execution (batch_size).')
+        adaptive = (target_effective_sample_size is not None) or (time_budget_sec is not None)
+        if num_traces is None and not adaptive:
+            raise ValueError('Expecting num_traces, target_effective_sample_size, or time_budget_sec.')
+        if num_workers is not None and num_workers > 1:
+            if adaptive:
+                raise ValueError('target_effective_sample_size and time_budget_sec are not supported with parallel trace generation (num_workers).')
+            traces_kwargs = dict(trace_mode=trace_mode, prior_inflation=prior_inflation, inference_engine=inference_engine, inference_network=inference_network, map_func=map_func, silent=True, observe=observe, likelihood_importance=likelihood_importance, batch_size=batch_size, trace_pruning=trace_pruning, trace_pruning_threshold=trace_pruning_threshold, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, **kwargs)
+            return self._traces_parallel(num_traces=num_traces, num_workers=num_workers, silent=silent, file_name=file_name, file_sync_timeout=file_sync_timeout, traces_args=args, traces_kwargs=traces_kwargs)
         generator = self._trace_generator(trace_mode=trace_mode,
                                           prior_inflation=prior_inflation,
                                           inference_engine=inference_engine,
                                           inference_network=inference_network,
                                           observe=observe,
                                           likelihood_importance=likelihood_importance,
-                                          file_name="{}.traces".format(file_name) if self.use_trace_hash else None,
-                                          file_sync_timeout=file_sync_timeout,
+                                          batch_size=batch_size,
+                                          trace_pruning_threshold=trace_pruning_threshold if (trace_pruning != TracePruning.DISABLED and trace_mode == TraceMode.POSTERIOR) else None,
+                                          trace_recording=trace_recording,
                                           *args, **kwargs)
-        traces = Empirical(file_name=file_name, file_sync_timeout=file_sync_timeout)
+        traces = Empirical(file_name=file_name, file_sync_timeout=file_sync_timeout, pack_traces=self.pack_traces, file_storage=self.empirical_file_storage)
+        trace_hash = self._new_trace_hash()
         if map_func is None:
             map_func = lambda trace: trace
+        num_traces_pruned = 0
         time_start = time.time()
         if (util._verbosity > 1) and not silent:
-            len_str_num_traces = len(str(num_traces))
-            print('Time spent  | Time remain.| Progress             | {} | Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
+            if num_traces is None:
+                print('Time spent  | Trace       | ESS         | Traces/sec')
+            else:
+                len_str_num_traces = len(str(num_traces))
+                print('Time spent  | Time remain.| Progress             | {} | Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
             prev_duration = 0
-        for i in range(num_traces):
+        i = 0
+        while num_traces is None or i < num_traces:
             if (util._verbosity > 1) and not silent:
                 duration = time.time() - time_start
-                if (duration - prev_duration > util._print_refresh_rate) or (i == num_traces - 1):
+                if (duration - prev_duration > util._print_refresh_rate) or (i == 0) or (i == num_traces - 1 if num_traces is not None else False):
                     prev_duration = duration
-                    traces_per_second = (i + 1) / duration
-                    print('{} | {} | {} | {}/{} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), util.days_hours_mins_secs_str((num_traces - i) / traces_per_second), util.progress_bar(i+1, num_traces), str(i+1).rjust(len_str_num_traces), num_traces, traces_per_second), end='\r')
+                    traces_per_second = (i + 1) / max(duration, 1e-6)
+                    if num_traces is None:
+                        print('{} | {} | {} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), '{:,}'.format(i + 1).ljust(11), '{:,.2f}'.format(traces._log_weight_statistics.effective_sample_size).ljust(11), traces_per_second), end='\r')
+                    else:
+                        print('{} | {} | {} | {}/{} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), util.days_hours_mins_secs_str((num_traces - i) / traces_per_second), util.progress_bar(i+1, num_traces), str(i+1).rjust(len_str_num_traces), num_traces, traces_per_second), end='\r')
                     sys.stdout.flush()
             trace = next(generator)
+            i += 1
             if trace_mode == TraceMode.PRIOR:
                 log_weight = 1.
             else:
                 log_weight = trace.log_importance_weight
-            traces.add(map_func(trace), log_weight)
+            pruned = state._get_trace_state().current_trace_pruned
+            if pruned:
+                num_traces_pruned += 1
+                log_weight = -math.inf
+            if not (pruned and trace_pruning == TracePruning.DISCARD):
+                traces.add(self._stored_value(map_func(trace), trace_retention, trace_retention_addresses, trace_hash), log_weight)
+            if (target_effective_sample_size is not None) and (traces._log_weight_statistics.effective_sample_size >= target_effective_sample_size):
+                break
+            if (time_budget_sec is not None) and (time.time() - time_start >= time_budget_sec):
+                break
         if (util._verbosity > 1) and not silent:
             print()
         traces.finalize()
+        if trace_pruning != TracePruning.DISABLED:
+            traces.add_metadata(op='trace_pruning', trace_pruning=str(trace_pruning), trace_pruning_threshold=trace_pruning_threshold, num_traces=i, num_traces_pruned=num_traces_pruned)
+        return traces
+
+    def _traces_parallel(self, num_traces, num_workers, silent, file_name, file_sync_timeout, traces_args, traces_kwargs):
+        global _traces_worker_model
+        global _traces_worker_args
+        global _traces_worker_kwargs
+        _traces_worker_model = self
+        _traces_worker_args = traces_args
+        _traces_worker_kwargs = traces_kwargs
+        # Several chunks per worker for balancing the load and reporting progress, each chunk with its own random seed
+        num_chunks = max(1, min(num_traces, num_workers * 4))
+        chunk_sizes = [num_traces // num_chunks + (1 if i < num_traces % num_chunks else 0) for i in range(num_chunks)]
+        seed = random.randint(0, 2**31 - 1 - num_chunks)
+        chunks = [(seed + i, chunk_sizes[i]) for i in range(num_chunks)]
+
+        traces = Empirical(file_name=file_name, file_sync_timeout=file_sync_timeout, pack_traces=self.pack_traces, file_storage=self.empirical_file_storage)
+        trace_hash = self._new_trace_hash()
+        time_start = time.time()
+        if (util._verbosity > 1) and not silent:
+            len_str_num_traces = len(str(num_traces))
+            print('Time spent  | Time remain.| Progress             | {} | Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
+        i = 0
+        num_traces_pruned = 0
+        try:
+            with torch.multiprocessing.get_context('fork').Pool(processes=num_workers) as pool:
+                for values, log_weights, chunk_num_traces_pruned in pool.imap(_traces_worker, chunks):
+                    for value, log_weight in zip(values, log_weights):
+                        traces.add(self._stored_value(value, trace_hash=trace_hash), log_weight)
+                    i += len(values)
+                    num_traces_pruned += chunk_num_traces_pruned
+                    if (util._verbosity > 1) and not silent:
+                        duration = time.time() - time_start
+                        traces_per_second = i / duration
+                        print('{} | {} | {} | {}/{} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), util.days_hours_mins_secs_str((num_traces - i) / traces_per_second), util.progress_bar(i, num_traces), str(i).rjust(len_str_num_traces), num_traces, traces_per_second), end='\r')
+                        sys.stdout.flush()
+        finally:
+            _traces_worker_model = None
+            _traces_worker_args = None
+            _traces_worker_kwargs = None
+        if (util._verbosity > 1) and not silent:
+            print()
+        traces.finalize()
+        trace_pruning = traces_kwargs['trace_pruning']
+        if trace_pruning != TracePruning.DISABLED:
+            # Each worker prunes its traces against the partial log importance weights of its own traces
+            traces.add_metadata(op='trace_pruning', trace_pruning=str(trace_pruning), trace_pruning_threshold=traces_kwargs['trace_pruning_threshold'], num_traces=num_traces, num_traces_pruned=num_traces_pruned)
         return traces
 
     def get_trace(self, *args, **kwargs):
         return next(self._trace_generator(*args, **kwargs))
 
-    def prior_traces(self, num_traces=10, prior_inflation=PriorInflation.DISABLED, map_func=None, file_name=None, likelihood_importance=1., *args, **kwargs):
-        prior = self._traces(num_traces=num_traces, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, map_func=map_func, file_name=file_name, likelihood_importance=likelihood_importance, *args, **kwargs)
+    def prior_traces(self, num_traces=10, prior_inflation=PriorInflation.DISABLED, map_func=None, file_name=None, likelihood_importance=1., batch_size=None, num_workers=None, trace_recording=TraceRecording.FULL, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        prior = self._traces(num_traces=num_traces, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, map_func=map_func, file_name=file_name, likelihood_importance=likelihood_importance, batch_size=batch_size, num_workers=num_workers, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
         prior.rename('Prior, traces: {:,}'.format(prior.length))
-        prior.add_metadata(op='prior', num_traces=num_traces, prior_inflation=str(prior_inflation), likelihood_importance=likelihood_importance)
+        prior.add_metadata(op='prior', num_traces=num_traces, prior_inflation=str(prior_inflation), likelihood_importance=likelihood_importance, batch_size=batch_size, num_workers=num_workers)
         return prior
 
-    def prior_distribution(self, num_traces=10, prior_inflation=PriorInflation.DISABLED, map_func=lambda trace: trace.result, file_name=None, likelihood_importance=1., *args, **kwargs):
-        return self.prior_traces(num_traces=num_traces, prior_inflation=prior_inflation, map_func=map_func, file_name=file_name, likelihood_importance=likelihood_importance, *args, **kwargs)
+    def prior_distribution(self, num_traces=10, prior_inflation=PriorInflation.DISABLED, map_func=lambda trace: trace.result, file_name=None, likelihood_importance=1., batch_size=None, num_workers=None, trace_recording=TraceRecording.FULL, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        return self.prior_traces(num_traces=num_traces, prior_inflation=prior_inflation, map_func=map_func, file_name=file_name, likelihood_importance=likelihood_importance, batch_size=batch_size, num_workers=num_workers, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
 
-    def posterior_traces(self, num_traces=10, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, initial_trace=None, map_func=None, observe=None, file_name=None, thinning_steps=None, likelihood_importance=1., *args, **kwargs):
+    def posterior_traces(self, num_traces=10, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, initial_trace=None, map_func=None, observe=None, file_name=None, thinning_steps=None, likelihood_importance=1., batch_size=None, num_workers=None, num_chains=None, combine_chains=True, target_effective_sample_size=None, time_budget_sec=None, resample_threshold=0.5, resampling=Resampling.MULTINOMIAL, trace_pruning=TracePruning.DISABLED, trace_pruning_threshold=20., trace_recording=TraceRecording.FULL, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        if batch_size is not None and inference_engine != InferenceEngine.IMPORTANCE_SAMPLING:
+            raise ValueError('Particle-batched execution (batch_size) is only supported with inference engine IMPORTANCE_SAMPLING.')
+        if num_chains is not None and num_chains > 1 and inference_engine not in [InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS]:
+            raise ValueError('Multiple chains (num_chains) are only supported with inference engines LIGHTWEIGHT_METROPOLIS_HASTINGS and RANDOM_WALK_METROPOLIS_HASTINGS.')
+        if num_workers is not None and num_workers > 1 and inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
+            raise ValueError('Parallel trace generation (num_workers) is not supported with inference engine SEQUENTIAL_MONTE_CARLO.')
+        if num_workers is not None and num_workers > 1 and (num_chains is None or num_chains == 1) and inference_engine in [InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS]:
+            # A single chain is sequential, the chains of num_chains > 1 are run in num_workers processes
+            raise ValueError('Parallel trace generation (num_workers) with Metropolis Hastings inference engines requires multiple chains (num_chains).')
+        if trace_pruning != TracePruning.DISABLED and inference_engine not in [InferenceEngine.IMPORTANCE_SAMPLING, InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK]:
+            raise ValueError('Trace pruning is only supported with inference engines IMPORTANCE_SAMPLING and IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK.')
+        if (target_effective_sample_size is not None or time_budget_sec is not None) and inference_engine not in [InferenceEngine.IMPORTANCE_SAMPLING, InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK]:
+            raise ValueError('target_effective_sample_size and time_budget_sec are only supported with inference engines IMPORTANCE_SAMPLING and IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK.')
+        if trace_recording != TraceRecording.FULL and inference_engine not in [InferenceEngine.IMPORTANCE_SAMPLING, InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK]:
+            raise ValueError('Trace recording other than FULL is only supported with inference engines IMPORTANCE_SAMPLING and IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK.')
         if inference_engine == InferenceEngine.IMPORTANCE_SAMPLING:
-            posterior = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=None, map_func=map_func, observe=observe, file_name=file_name, likelihood_importance=likelihood_importance, *args, **kwargs)
+            posterior = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=None, map_func=map_func, observe=observe, file_name=file_name, likelihood_importance=likelihood_importance, batch_size=batch_size, num_workers=num_workers, target_effective_sample_size=target_effective_sample_size, time_budget_sec=time_budget_sec, trace_pruning=trace_pruning, trace_pruning_threshold=trace_pruning_threshold, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
             posterior.rename('Posterior, IS, traces: {:,}, ESS: {:,.2f}'.format(posterior.length, posterior.effective_sample_size))
-            posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), effective_sample_size=posterior.effective_sample_size, likelihood_importance=likelihood_importance)
+            posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), effective_sample_size=posterior.effective_sample_size, likelihood_importance=likelihood_importance, batch_size=batch_size, num_workers=num_workers, target_effective_sample_size=target_effective_sample_size, time_budget_sec=time_budget_sec)
         elif inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
             if self._inference_network is None:
                 raise RuntimeError('Cannot run inference engine IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK because no inference network for this model is available. Use learn_inference_network or load_inference_network first.')
             with torch.no_grad():
-                posterior = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=self._inference_network, map_func=map_func, observe=observe, file_name=file_name, likelihood_importance=likelihood_importance, *args, **kwargs)
+                posterior = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=self._inference_network, map_func=map_func, observe=observe, file_name=file_name, likelihood_importance=likelihood_importance, num_workers=num_workers, target_effective_sample_size=target_effective_sample_size, time_budget_sec=time_budget_sec, trace_pruning=trace_pruning, trace_pruning_threshold=trace_pruning_threshold, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
             posterior.rename('Posterior, IC, traces: {:,}, train. traces: {:,}, ESS: {:,.2f}'.format(posterior.length, self._inference_network._total_train_traces, posterior.effective_sample_size))
-            posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), effective_sample_size=posterior.effective_sample_size, likelihood_importance=likelihood_importance, train_traces=self._inference_network._total_train_traces)
+            posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), effective_sample_size=posterior.effective_sample_size, likelihood_importance=likelihood_importance, train_traces=self._inference_network._total_train_traces, num_workers=num_workers, target_effective_sample_size=target_effective_sample_size, time_budget_sec=time_budget_sec)
+        elif inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
+            posterior = self._sequential_monte_carlo(num_traces=num_traces, map_func=map_func, observe=observe, file_name=file_name, likelihood_importance=likelihood_importance, resample_threshold=resample_threshold, resampling=resampling, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
         else:  # inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS
-            posterior = Empirical(file_name=file_name)
-            if map_func is None:
-                map_func = lambda trace: trace
-            if initial_trace is None:
-                current_trace = next(self._trace_generator(trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, observe=observe, *args, **kwargs))
+            if num_chains is None or num_chains == 1:
+                posterior = self._metropolis_hastings_chain(num_traces=num_traces, inference_engine=inference_engine, initial_trace=initial_trace, map_func=map_func, observe=observe, file_name=file_name, thinning_steps=thinning_steps, likelihood_importance=likelihood_importance, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
             else:
-                current_trace = initial_trace
+                posterior = self._metropolis_hastings_chains(num_chains=num_chains, combine_chains=combine_chains, num_workers=num_workers, num_traces=num_traces, inference_engine=inference_engine, initial_trace=initial_trace, map_func=map_func, observe=observe, file_name=file_name, thinning_steps=thinning_steps, likelihood_importance=likelihood_importance, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
+        return posterior
 
-            time_start = time.time()
-            traces_accepted = 0
-            samples_reused = 0
-            samples_all = 0
-            if thinning_steps is None:
-                thinning_steps = 1
+    def _sequential_monte_carlo(self, num_traces=10, map_func=None, observe=None, file_name=None, likelihood_importance=1., resample_threshold=0.5, resampling=Resampling.MULTINOMIAL, silent=False, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        # Each particle is advanced to its next observe by re-executing Model.forward from the beginning, replaying the values the particle sampled so far
+        if map_func is None:
+            map_func = lambda trace: trace
+        if self.use_static_addresses and self._static_addresses is None:
+            self._static_addresses = state._compile_static_addresses(self.forward)
+        trace_state = state._init_traces(func=self.forward, trace_mode=TraceMode.POSTERIOR, inference_engine=InferenceEngine.SEQUENTIAL_MONTE_CARLO, observe=observe, address_dictionary=self._address_dictionary, likelihood_importance=likelihood_importance, static_addresses=self._static_addresses if self.use_static_addresses else None)
+        num_particles = num_traces
+        replays = [None] * num_particles
+        traces = [None] * num_particles
+        log_weights = [0.] * num_particles
+        finished = [False] * num_particles
+        num_resamplings = 0
+        time_start = time.time()
+        if (util._verbosity > 1) and not silent:
+            print('Time spent  | Observe     | ESS         | Resamplings')
+        observe_stop = 0
+        while not all(finished):
+            observe_stop += 1
+            for i in range(num_particles):
+                if finished[i]:
+                    continue
+                state._set_trace_state(trace_state)
+                state._set_sequential_monte_carlo_particle(trace_state, replays[i], observe_stop)
+                state._begin_trace()
+                try:
+                    result = self.forward(*args, **kwargs)
+                    finished[i] = True
+                except state._InterruptTrace:
+                    result = None
+                trace = state._end_trace(result)
+                if not finished[i]:
+                    # The weight of the observe the particle stopped at
+                    log_weights[i] += trace.variables_observed[-1].log_importance_weight
+                traces[i] = trace
+                replays[i] = {variable.address: variable.value for variable in trace.variables if not variable.observed}
+            log_weights_tensor = util.to_tensor(log_weights, dtype=torch.float64)
+            weights = torch.softmax(log_weights_tensor, dim=0)
+            effective_sample_size = float(1. / weights.pow(2).sum())
+            if (util._verbosity > 1) and not silent:
+                print('{} | {} | {} | {:,}       '.format(util.days_hours_mins_secs_str(time.time() - time_start), '{:,}'.format(observe_stop).ljust(11), '{:,.2f}'.format(effective_sample_size).ljust(11), num_resamplings), end='\r')
+                sys.stdout.flush()
+            if (not all(finished)) and (effective_sample_size < resample_threshold * num_particles):
+                indices = util.resample_indices(weights, num_particles, resampling).tolist()
+                replays = [replays[j] for j in indices]
+                traces = [traces[j] for j in indices]
+                finished = [finished[j] for j in indices]
+                log_weight = float(torch.logsumexp(log_weights_tensor, dim=0)) - math.log(num_particles)
+                log_weights = [log_weight] * num_particles
+                num_resamplings += 1
+        if (util._verbosity > 1) and not silent:
+            print()
+        state._set_sequential_monte_carlo_particle(trace_state, None, None)
 
-            if util._verbosity > 1:
-                len_str_num_traces = len(str(num_traces))
-                print('Time spent  | Time remain.| Progress             | {} | Accepted|Smp reuse| Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
-                prev_duration = 0
-            for i in range(num_traces):
-                if util._verbosity > 1:
-                    duration = time.time() - time_start
-                    if (duration - prev_duration > util._print_refresh_rate) or (i == num_traces - 1):
-                        prev_duration = duration
-                        traces_per_second = (i + 1) / duration
-                        print('{} | {} | {} | {}/{} | {} | {} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), util.days_hours_mins_secs_str((num_traces - i) / traces_per_second), util.progress_bar(i+1, num_traces), str(i+1).rjust(len_str_num_traces), num_traces, '{:,.2f}%'.format(100 * (traces_accepted / (i + 1))).rjust(7), '{:,.2f}%'.format(100 * samples_reused / max(1, samples_all)).rjust(7), traces_per_second), end='\r')
-                        sys.stdout.flush()
-                candidate_trace = next(self._trace_generator(trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, metropolis_hastings_trace=current_trace, observe=observe, *args, **kwargs))
-                log_acceptance_ratio = math.log(current_trace.length_controlled) - math.log(candidate_trace.length_controlled) + candidate_trace.log_prob_observed - current_trace.log_prob_observed
-                for variable in candidate_trace.variables_controlled:
-                    if variable.reused:
-                        log_acceptance_ratio += torch.sum(variable.log_prob)
-                        log_acceptance_ratio -= torch.sum(current_trace.variables_dict_address[variable.address].log_prob)
-                        samples_reused += 1
-                samples_all += candidate_trace.length_controlled
-
-                if state._metropolis_hastings_site_transition_log_prob is None:
-                    print(colored('Warning: trace did not hit the Metropolis Hastings site, ensure that the model is deterministic except pyprob.sample calls', 'red', attrs=['bold']))
+        posterior = Empirical(file_name=file_name, pack_traces=self.pack_traces, file_storage=self.empirical_file_storage)
+        trace_hash = self._new_trace_hash()
+        # Particles share traces after resampling, each trace is stored once
+        values = {}
+        for i in range(num_particles):
+            if id(traces[i]) not in values:
+                values[id(traces[i])] = self._stored_value(map_func(traces[i]), trace_retention, trace_retention_addresses, trace_hash)
+            posterior.add(values[id(traces[i])], log_weights[i])
+        posterior.finalize()
+        posterior.rename('Posterior, SMC, particles: {:,}, resamplings: {:,}, ESS: {:,.2f}'.format(posterior.length, num_resamplings, posterior.effective_sample_size))
+        posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(InferenceEngine.SEQUENTIAL_MONTE_CARLO), effective_sample_size=posterior.effective_sample_size, likelihood_importance=likelihood_importance, resample_threshold=resample_threshold, resampling=str(resampling), num_resamplings=num_resamplings, num_observes=observe_stop)
+        return posterior
+
+    def _metropolis_hastings_chain(self, num_traces=10, inference_engine=InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, initial_trace=None, map_func=None, observe=None, file_name=None, thinning_steps=None, likelihood_importance=1., silent=False, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        posterior = Empirical(file_name=file_name, pack_traces=self.pack_traces, file_storage=self.empirical_file_storage)
+        trace_hash = self._new_trace_hash()
+        if map_func is None:
+            map_func = lambda trace: trace
+        generator = self._trace_generator(trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, metropolis_hastings_trace=initial_trace, observe=observe, *args, **kwargs)
+        if initial_trace is None:
+            current_trace = next(generator)
+        else:
+            current_trace = initial_trace
+
+        current_columns = None
+        stored_trace = None
+        stored_value = None
+        time_start = time.time()
+        traces_accepted = 0
+        samples_reused = 0
+        samples_all = 0
+        if thinning_steps is None:
+            thinning_steps = 1
+
+        if (util._verbosity > 1) and not silent:
+            len_str_num_traces = len(str(num_traces))
+            print('Time spent  | Time remain.| Progress             | {} | Accepted|Smp reuse| Traces/sec'.format('Trace'.ljust(len_str_num_traces * 2 + 1)))
+            prev_duration = 0
+        for i in range(num_traces):
+            if (util._verbosity > 1) and not silent:
+                duration = time.time() - time_start
+                if (duration - prev_duration > util._print_refresh_rate) or (i == num_traces - 1):
+                    prev_duration = duration
+                    traces_per_second = (i + 1) / duration
+                    print('{} | {} | {} | {}/{} | {} | {} | {:,.2f}       '.format(util.days_hours_mins_secs_str(duration), util.days_hours_mins_secs_str((num_traces - i) / traces_per_second), util.progress_bar(i+1, num_traces), str(i+1).rjust(len_str_num_traces), num_traces, '{:,.2f}%'.format(100 * (traces_accepted / (i + 1))).rjust(7), '{:,.2f}%'.format(100 * samples_reused / max(1, samples_all)).rjust(7), traces_per_second), end='\r')
+                    sys.stdout.flush()
+            if i == 0 and initial_trace is not None:
+                candidate_trace = next(generator)
+            else:
+                candidate_trace = generator.send(current_trace)
+            log_acceptance_ratio = math.log(current_trace.length_controlled) - math.log(candidate_trace.length_controlled) + candidate_trace.log_prob_observed - current_trace.log_prob_observed
+            # The columns are kept here for the current trace, and not cached on the traces, which can be stored in the posterior
+            candidate_columns = TraceColumns(candidate_trace.variables_controlled)
+            reused = candidate_columns.mask('reused')
+            num_reused = int(reused.sum())
+            if num_reused > 0:
+                if current_columns is None:
+                    current_columns = TraceColumns(current_trace.variables_controlled)
+                reused_addresses = [candidate_columns.addresses[i] for i in reused.nonzero().view(-1).tolist()]
+                current_indices = [current_columns.address_indices.get(address) for address in reused_addresses]
+                log_acceptance_ratio += torch.sum(candidate_columns.log_probs[reused])
+                if None in current_indices:
+                    log_acceptance_ratio -= sum([torch.sum(current_trace.variables_dict_address[address].log_prob) for address in reused_addresses])
                 else:
-                    log_acceptance_ratio += torch.sum(state._metropolis_hastings_site_transition_log_prob)
-
-                # print(log_acceptance_ratio)
-                if math.log(random.random()) < float(log_acceptance_ratio):
-                    traces_accepted += 1
-                    current_trace = candidate_trace
-                # do thinning
-                if i % thinning_steps == 0:
-                    posterior.add(map_func(current_trace))
-
-            if util._verbosity > 1:
-                print()
-
-            posterior.finalize()
-            posterior.rename('Posterior, {}, traces: {:,}{}, accepted: {:,.2f}%, sample reuse: {:,.2f}%'.format('LMH' if inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS else 'RMH', posterior.length, '' if thinning_steps == 1 else ' (thinning steps: {:,})'.format(thinning_steps), 100 * (traces_accepted / num_traces), 100 * samples_reused / samples_all))
-            posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), likelihood_importance=likelihood_importance, thinning_steps=thinning_steps, num_traces_accepted=traces_accepted, num_samples_reuised=samples_reused, num_samples=samples_all)
+                    log_acceptance_ratio -= torch.sum(current_columns.log_probs[current_indices])
+                samples_reused += num_reused
+            samples_all += candidate_trace.length_controlled
+
+            metropolis_hastings_site_transition_log_prob = state._get_trace_state().metropolis_hastings_site_transition_log_prob
+            if metropolis_hastings_site_transition_log_prob is None:
+                print(colored('Warning: trace did not hit the Metropolis Hastings site, ensure that the model is deterministic except pyprob.sample calls', 'red', attrs=['bold']))
+            else:
+                log_acceptance_ratio += torch.sum(metropolis_hastings_site_transition_log_prob)
+
+            # print(log_acceptance_ratio)
+            if math.log(random.random()) < float(log_acceptance_ratio):
+                traces_accepted += 1
+                current_trace = candidate_trace
+                current_columns = candidate_columns
+            # do thinning
+            if i % thinning_steps == 0:
+                # The current trace is stored once for all the steps it is kept for
+                if stored_trace is not current_trace:
+                    stored_trace = current_trace
+                    stored_value = self._stored_value(map_func(current_trace), trace_retention, trace_retention_addresses, trace_hash)
+                posterior.add(stored_value)
+
+        if (util._verbosity > 1) and not silent:
+            print()
+
+        posterior.finalize()
+        posterior.rename('Posterior, {}, traces: {:,}{}, accepted: {:,.2f}%, sample reuse: {:,.2f}%'.format('LMH' if inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS else 'RMH', posterior.length, '' if thinning_steps == 1 else ' (thinning steps: {:,})'.format(thinning_steps), 100 * (traces_accepted / num_traces), 100 * samples_reused / samples_all))
+        posterior.add_metadata(op='posterior', num_traces=num_traces, inference_engine=str(inference_engine), likelihood_importance=likelihood_importance, thinning_steps=thinning_steps, num_traces_accepted=traces_accepted, num_samples_reuised=samples_reused, num_samples=samples_all)
         return posterior
 
-    def posterior_distribution(self, num_traces=10, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, initial_trace=None, map_func=lambda trace: trace.result, observe=None, file_name=None, thinning_steps=None, *args, **kwargs):
-        return self.posterior_traces(num_traces=num_traces, inference_engine=inference_engine, initial_trace=initial_trace, map_func=map_func, observe=observe, file_name=file_name, thinning_steps=thinning_steps, *args, **kwargs)
+    def _metropolis_hastings_chains(self, num_chains, combine_chains=True, num_workers=None, num_traces=10, file_name=None, silent=False, *args, **kwargs):
+        global _traces_worker_model
+        global _traces_worker_args
+        global _traces_worker_kwargs
+        _traces_worker_model = self
+        _traces_worker_args = args
+        _traces_worker_kwargs = dict(num_traces=num_traces, file_name=file_name, silent=True, **kwargs)
+        if num_workers is None:
+            num_workers = num_chains
+        seed = random.randint(0, 2**31 - 1 - num_chains)
+        chains = [(seed + i, i) for i in range(num_chains)]
+        if (util._verbosity > 1) and not silent:
+            print('Running {:,} Metropolis Hastings chains of {:,} traces in {:,} worker processes...'.format(num_chains, num_traces, min(num_workers, num_chains)))
+        try:
+            with torch.multiprocessing.get_context('fork').Pool(processes=min(num_workers, num_chains)) as pool:
+                results = pool.map(_metropolis_hastings_chain_worker, chains)
+        finally:
+            _traces_worker_model = None
+            _traces_worker_args = None
+            _traces_worker_kwargs = None
+        if file_name is None:
+            posteriors = []
+            trace_hash = self._new_trace_hash()
+            for values, log_weights, name, metadata in results:
+                # The trace retention policy is applied in the workers, the traces are hashed here as in a single chain
+                stored_values = {}
+                for value in values:
+                    if id(value) not in stored_values:
+                        stored_values[id(value)] = self._stored_value(value, trace_hash=trace_hash)
+                values = [stored_values[id(value)] for value in values]
+                posterior = Empirical(values=values, log_weights=log_weights, name=name, pack_traces=self.pack_traces)
+                posterior._metadata = metadata
+                posteriors.append(posterior)
+            if combine_chains:
+                posterior = Empirical(concat_empiricals=posteriors)
+        else:
+            if combine_chains:
+                posterior = Empirical(concat_empirical_file_names=results, file_name=file_name)
+            else:
+                posteriors = [Empirical(file_name=chain_file_name, file_read_only=True) for chain_file_name in results]
+        if combine_chains:
+            posterior.rename('Posterior, {}, chains: {:,}, traces: {:,}'.format('LMH' if kwargs['inference_engine'] == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS else 'RMH', num_chains, posterior.length))
+            posterior.add_metadata(op='posterior', num_chains=num_chains, num_traces=num_traces, inference_engine=str(kwargs['inference_engine']))
+            return posterior
+        else:
+            return posteriors
+
+    def posterior_distribution(self, num_traces=10, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, initial_trace=None, map_func=lambda trace: trace.result, observe=None, file_name=None, thinning_steps=None, batch_size=None, num_workers=None, num_chains=None, combine_chains=True, target_effective_sample_size=None, time_budget_sec=None, resample_threshold=0.5, resampling=Resampling.MULTINOMIAL, trace_pruning=TracePruning.DISABLED, trace_pruning_threshold=20., trace_recording=TraceRecording.FULL, trace_retention=TraceRetention.ALL, trace_retention_addresses=None, *args, **kwargs):
+        return self.posterior_traces(num_traces=num_traces, inference_engine=inference_engine, initial_trace=initial_trace, map_func=map_func, observe=observe, file_name=file_name, thinning_steps=thinning_steps, batch_size=batch_size, num_workers=num_workers, num_chains=num_chains, combine_chains=combine_chains, target_effective_sample_size=target_effective_sample_size, time_budget_sec=time_budget_sec, resample_threshold=resample_threshold, resampling=resampling, trace_pruning=trace_pruning, trace_pruning_threshold=trace_pruning_threshold, trace_recording=trace_recording, trace_retention=trace_retention, trace_retention_addresses=trace_retention_addresses, *args, **kwargs)
+
+    def posterior_stream(self, num_traces=None, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, map_func=lambda trace: trace.result, observe=None, likelihood_importance=1., *args, **kwargs):
+        if inference_engine == InferenceEngine.IMPORTANCE_SAMPLING:
+            inference_network = None
+        elif inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+            if self._inference_network is None:
+                raise RuntimeError('Cannot run inference engine IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK because no inference network for this model is available. Use learn_inference_network or load_inference_network first.')
+            inference_network = self._inference_network
+        else:
+            raise ValueError('Posterior streams are only supported with inference engines IMPORTANCE_SAMPLING and IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK.')
+        generator = self._trace_generator(trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=inference_network, observe=observe, likelihood_importance=likelihood_importance, *args, **kwargs)
+        return PosteriorStream(generator, num_traces=num_traces, map_func=map_func, no_grad=inference_network is not None)
 
     def reset_inference_network(self):
         self._inference_network = None
@@ -224,12 +636,12 @@ class Model():
         # The following is due to a temporary hack related with https://github.com/pytorch/pytorch/issues/9981 and can be deprecated by using dill as pickler with torch > 0.4.1
         self._inference_network._model = self
 
-    def save_dataset(self, dataset_dir, num_traces, num_traces_per_file, prior_inflation=PriorInflation.DISABLED, *args, **kwargs):
+    def save_dataset(self, dataset_dir, num_traces, num_traces_per_file, prior_inflation=PriorInflation.DISABLED, pack_traces=False, *args, **kwargs):
         if not os.path.exists(dataset_dir):
             print('Directory does not exist, creating: {}'.format(dataset_dir))
             os.makedirs(dataset_dir)
         dataset = OnlineDataset(self, None, prior_inflation=prior_inflation)
-        dataset.save_dataset(dataset_dir=dataset_dir, num_traces=num_traces, num_traces_per_file=num_traces_per_file, *args, **kwargs)
+        dataset.save_dataset(dataset_dir=dataset_dir, num_traces=num_traces, num_traces_per_file=num_traces_per_file, pack_traces=pack_traces, *args, **kwargs)
 
 
 class RemoteModel(Model):
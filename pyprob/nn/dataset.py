@@ -13,8 +13,9 @@ from collections import Counter, OrderedDict
 import random
 
 from .. import util
-from ..util import TraceMode, PriorInflation
+from ..util import TraceMode, PriorInflation, TraceRecording
 from ..concurrency import ConcurrentShelf
+from ..trace import TraceSkeletons, PackedTraceRecord
 
 
 class Batch():
@@ -28,7 +29,7 @@ class Batch():
             if tl == 0:
                 raise ValueError('Trace of length zero.')
             total_length_controlled += tl
-            trace_hash = ''.join([variable.address for variable in trace.variables_controlled])
+            trace_hash = (tl, trace.type_id)
             if trace_hash not in sub_batches:
                 sub_batches[trace_hash] = []
             sub_batches[trace_hash].append(trace)
@@ -58,7 +59,7 @@ class OnlineDataset(Dataset):
         return self._length
 
     def __getitem__(self, idx):
-        return next(self._model._trace_generator(trace_mode=TraceMode.PRIOR_FOR_INFERENCE_NETWORK, prior_inflation=self._prior_inflation))
+        return next(self._model._trace_generator(trace_mode=TraceMode.PRIOR_FOR_INFERENCE_NETWORK, prior_inflation=self._prior_inflation, trace_recording=TraceRecording.INFERENCE_NETWORK))
 
     @staticmethod
     def _prune_trace(trace):
@@ -120,7 +121,7 @@ class OnlineDataset(Dataset):
                 del(variable.reused)
                 del(variable.tagged)
 
-    def save_dataset(self, dataset_dir, num_traces, num_traces_per_file, *args, **kwargs):
+    def save_dataset(self, dataset_dir, num_traces, num_traces_per_file, pack_traces=False, *args, **kwargs):
         num_files = math.ceil(num_traces / num_traces_per_file)
         util.progress_bar_init('Saving offline dataset, traces:{}, traces per file:{}, files:{}'.format(num_traces, num_traces_per_file, num_files), num_traces, 'Traces')
         i = 0
@@ -128,11 +129,17 @@ class OnlineDataset(Dataset):
             i += num_traces_per_file
             file_name = os.path.join(dataset_dir, 'pyprob_traces_{}_{}'.format(num_traces_per_file, str(uuid.uuid4())))
             shelf = shelve.open(file_name, flag='c')
+            # With pack_traces, each file stores the skeletons of its traces once and the traces as PackedTraceRecords
+            trace_skeletons = TraceSkeletons() if pack_traces else None
             for j in range(num_traces_per_file):
-                trace = next(self._model._trace_generator(trace_mode=TraceMode.PRIOR, prior_inflation=self._prior_inflation, *args, **kwargs))
+                trace = next(self._model._trace_generator(trace_mode=TraceMode.PRIOR, prior_inflation=self._prior_inflation, trace_recording=TraceRecording.INFERENCE_NETWORK, *args, **kwargs))
                 self._prune_trace(trace)
+                if trace_skeletons is not None:
+                    trace = trace_skeletons.pack(trace).record
                 shelf[str(j)] = trace
                 shelf['__length'] = j + 1
+            if trace_skeletons is not None:
+                shelf['__trace_skeletons'] = trace_skeletons
             shelf.close()
             util.progress_bar_update(i)
         util.progress_bar_end()
@@ -147,6 +154,7 @@ class OfflineDatasetFile(Dataset):
         self._closed = False
         shelf = self._open()
         self._length = shelf['__length']
+        self._trace_skeletons = shelf['__trace_skeletons'] if '__trace_skeletons' in shelf else None
 
     def _open(self):
         # idea from https://www.kunxi.org/2014/05/lru-cache-in-python
@@ -170,7 +178,10 @@ class OfflineDatasetFile(Dataset):
 
     def __getitem__(self, idx):
         shelf = self._open()
-        return shelf[str(idx)]
+        trace = shelf[str(idx)]
+        if isinstance(trace, PackedTraceRecord):
+            trace = self._trace_skeletons.unpack(trace)
+        return trace
 
 
 class OfflineDataset(ConcatDataset):
@@ -235,8 +246,7 @@ class OfflineDataset(ConcatDataset):
 
     @staticmethod
     def _trace_hash(trace):
-        h = hash(''.join([variable.address for variable in trace.variables_controlled])) + sys.maxsize + 1
-        return float('{}.{}'.format(trace.length_controlled, h))
+        return float('{}.{}'.format(trace.length_controlled, trace.type_id))
 
     def _compute_hashes(self):
         hashes = torch.zeros(len(self))
@@ -250,7 +260,7 @@ class OfflineDataset(ConcatDataset):
         print('Sorting done')
         return hashes.cpu().numpy(), sorted_indices.cpu().numpy()
 
-    def save_sorted(self, sorted_dataset_dir, num_traces_per_file=None, num_files=None, begin_file_index=None, end_file_index=None):
+    def save_sorted(self, sorted_dataset_dir, num_traces_per_file=None, num_files=None, begin_file_index=None, end_file_index=None, pack_traces=False):
         if num_traces_per_file is not None:
             if num_files is not None:
                 raise ValueError('Expecting either num_traces_per_file or num_files')
@@ -286,9 +296,15 @@ class OfflineDataset(ConcatDataset):
             print(file_name)
             shelf = ConcurrentShelf(file_name)
             shelf.lock(write=True)
+            trace_skeletons = TraceSkeletons() if pack_traces else None
             for new_i, old_i in enumerate(file_indices[i]):
-                shelf[str(new_i)] = self[old_i]
+                trace = self[old_i]
+                if trace_skeletons is not None:
+                    trace = trace_skeletons.pack(trace).record
+                shelf[str(new_i)] = trace
             shelf['__length'] = len(file_indices[i])
+            if trace_skeletons is not None:
+                shelf['__trace_skeletons'] = trace_skeletons
             shelf.unlock()
             util.progress_bar_update(j)
         util.progress_bar_end()
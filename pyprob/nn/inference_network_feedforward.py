@@ -5,6 +5,7 @@ from termcolor import colored
 from . import InferenceNetwork, ProposalNormalNormalMixture, ProposalUniformTruncatedNormalMixture, ProposalCategoricalCategorical, ProposalPoissonTruncatedNormalMixture
 from .. import util
 from ..distributions import Normal, Uniform, Categorical, Poisson
+from ..trace import TraceColumns
 
 
 class InferenceNetworkFeedForward(InferenceNetwork):
@@ -67,6 +68,8 @@ class InferenceNetworkFeedForward(InferenceNetwork):
         for sub_batch in batch.sub_batches:
             example_trace = sub_batch[0]
             observe_embedding = self._embed_observe(sub_batch)
+            example_columns = example_trace.columns
+            sub_batch_values = TraceColumns.stack([trace.columns for trace in sub_batch])
             sub_batch_loss = 0.
             for time_step in range(example_trace.length_controlled):
                 address = example_trace.variables_controlled[time_step].address
@@ -74,7 +77,7 @@ class InferenceNetworkFeedForward(InferenceNetwork):
                     print(colored('Address unknown by inference network: {}'.format(address), 'red', attrs=['bold']))
                     return False, 0
                 variables = [trace.variables_controlled[time_step] for trace in sub_batch]
-                values = torch.stack([v.value for v in variables])
+                values = example_columns.batch_value(sub_batch_values, time_step)
                 proposal_layer = self._layers_proposal[address]
                 proposal_layer._total_train_iterations += 1
                 proposal_distribution = proposal_layer.forward(observe_embedding, variables)
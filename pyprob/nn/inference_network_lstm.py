@@ -5,6 +5,7 @@ from termcolor import colored
 from . import InferenceNetwork, EmbeddingFeedForward, ProposalNormalNormalMixture, ProposalUniformTruncatedNormalMixture, ProposalCategoricalCategorical, ProposalPoissonTruncatedNormalMixture
 from .. import util
 from ..distributions import Normal, Uniform, Categorical, Poisson
+from ..trace import TraceColumns
 
 
 class InferenceNetworkLSTM(InferenceNetwork):
@@ -135,6 +136,8 @@ class InferenceNetworkLSTM(InferenceNetwork):
             example_trace = sub_batch[0]
             observe_embedding = self._embed_observe(sub_batch)
             sub_batch_length = len(sub_batch)
+            example_columns = example_trace.columns
+            sub_batch_values = TraceColumns.stack([trace.columns for trace in sub_batch])
             sub_batch_loss = 0.
             # print('sub_batch_length', sub_batch_length, 'example_trace_length_controlled', example_trace.length_controlled, '  ')
 
@@ -161,7 +164,7 @@ class InferenceNetworkLSTM(InferenceNetwork):
                         print(colored('Address unknown by inference network: {}'.format(prev_address), 'red', attrs=['bold']))
                         return False, 0
                     prev_distribution = prev_variable.distribution
-                    smp = util.to_tensor(torch.stack([trace.variables_controlled[time_step - 1].value.float() for trace in sub_batch]))
+                    smp = util.to_tensor(example_columns.batch_value(sub_batch_values, time_step - 1).float())
                     prev_sample_embedding = self._layers_sample_embedding[prev_address](smp)
                     prev_address_embedding = self._layers_address_embedding[prev_address]
                     prev_distribution_type_embedding = self._layers_distribution_type_embedding[prev_distribution.name]
@@ -189,7 +192,7 @@ class InferenceNetworkLSTM(InferenceNetwork):
                 address = variable.address
                 proposal_input = lstm_output[time_step]
                 variables = [trace.variables_controlled[time_step] for trace in sub_batch]
-                values = torch.stack([v.value for v in variables])
+                values = example_columns.batch_value(sub_batch_values, time_step)
                 proposal_layer = self._layers_proposal[address]
                 proposal_layer._total_train_iterations += 1
                 proposal_distribution = proposal_layer.forward(proposal_input, variables)
@@ -1,40 +1,143 @@
 import torch
 import sys
+import contextvars
+import dis
+import types
+import builtins
 import opcode
 import random
 import time
+import threading
 from termcolor import colored
 
 from .distributions import Normal, Categorical, Uniform, TruncatedNormal
-from .trace import Variable, Trace, TraceHash
-from . import util, TraceMode, PriorInflation, InferenceEngine
-
-_trace_mode = TraceMode.PRIOR
-_inference_engine = InferenceEngine.IMPORTANCE_SAMPLING
-_prior_inflation = PriorInflation.DISABLED
-_likelihood_importance = 1.
-_current_trace = None
-_current_trace_root_function_name = None
-_current_trace_inference_network = None
-_current_trace_inference_network_proposal_min_train_iterations = None
-_current_trace_previous_variable = None
-_current_trace_replaced_variable_proposal_distributions = {}
-_current_trace_observed_variables = None
-_current_trace_execution_start = None
-_metropolis_hastings_trace = None
-_metropolis_hastings_site_address = None
-_metropolis_hastings_site_transition_log_prob = 0
-_address_dictionary = None
+from .trace import Variable, Trace, LeanTrace
+from .address_dictionary import address_table
+from . import util, TraceMode, PriorInflation, InferenceEngine, TraceRecording
+
+class _TraceState():
+    # The state of the execution of traces, kept per context so that several traces can be executed concurrently in one process (e.g., in threads)
+    def __init__(self):
+        self.trace_mode = TraceMode.PRIOR
+        self.inference_engine = InferenceEngine.IMPORTANCE_SAMPLING
+        self.prior_inflation = PriorInflation.DISABLED
+        self.likelihood_importance = 1.
+        self.current_trace = None
+        self.current_trace_root_function_name = None
+        self.current_trace_inference_network = None
+        self.current_trace_inference_network_proposal_min_train_iterations = None
+        self.current_trace_previous_variable = None
+        self.current_trace_replaced_variable_proposal_distributions = {}
+        self.current_trace_observed_variables = None
+        self.current_trace_execution_start = None
+        self.metropolis_hastings_trace = None
+        self.metropolis_hastings_site_address = None
+        self.metropolis_hastings_site_transition_log_prob = 0
+        self.address_dictionary = None
+        self.static_addresses = None
+        self.batch_size = None
+        self.current_trace_num_observed = 0
+        self.sequential_monte_carlo_replay = None
+        self.sequential_monte_carlo_observe_stop = None
+        self.current_trace_log_importance_weight = 0.
+        self.current_trace_pruned = False
+        self.trace_pruning_threshold = None
+        self.trace_pruning_log_importance_weights_max = []
+        self.trace_recording = TraceRecording.FULL
+
+
+_trace_state = contextvars.ContextVar('pyprob_trace_state')
+
+
+class _InterruptTrace(Exception):
+    # Raised by pyprob.observe to stop the execution of Model.forward before the end of the trace
+    pass
+
+
+def _get_trace_state():
+    try:
+        return _trace_state.get()
+    except LookupError:
+        trace_state = _TraceState()
+        _trace_state.set(trace_state)
+        return trace_state
+
+
+def _set_trace_state(trace_state):
+    _trace_state.set(trace_state)
+
+
+# The cache hit and miss counters are updated under a lock, traces can be executed in several threads
+_cache_stats_lock = threading.Lock()
+_address_cache = {}
+_address_cache_enabled = True
+_address_cache_hits = 0
+_address_cache_misses = 0
+
+
+def set_address_cache(enabled=True):
+    global _address_cache_enabled
+    _address_cache_enabled = enabled
+    clear_address_cache()
+
+
+def clear_address_cache():
+    global _address_cache_hits
+    global _address_cache_misses
+    _address_cache.clear()
+    with _cache_stats_lock:
+        _address_cache_hits = 0
+        _address_cache_misses = 0
+
+
+def address_cache_stats():
+    return {'enabled': _address_cache_enabled, 'size': len(_address_cache), 'hits': _address_cache_hits, 'misses': _address_cache_misses}
 
 
 # _extract_address and _extract_target_of_assignment code by Tobias Kohn (kohnt@tobiaskohn.ch)
-def _extract_address(root_function_name):
+def _extract_address(root_function_name, static_addresses=None):
     # Retun an address in the format:
     # 'instruction pointer' __ 'qualified function name'
     frame = sys._getframe(2)
+    if static_addresses is not None:
+        entry = static_addresses.get((frame.f_code, frame.f_lasti))
+        if entry is not None:
+            # The precompiled address holds only if the calling frames are those of the chain of callers it was compiled for
+            address, callers = entry
+            f = frame.f_back
+            for code in callers:
+                if f is None or f.f_code is not code:
+                    break
+                f = f.f_back
+            else:
+                return address
+    if _address_cache_enabled:
+        # The address depends only on the code objects and instruction offsets of the frames walked below, which makes them a key for call sites seen before
+        global _address_cache_hits
+        global _address_cache_misses
+        key = [root_function_name]
+        f = frame
+        while f is not None:
+            code = f.f_code
+            n = code.co_name
+            if n.startswith('<') and not n == '<listcomp>':
+                break
+            key.append(code)
+            key.append(f.f_lasti)
+            if n == root_function_name:
+                break
+            f = f.f_back
+        key = tuple(key)
+        address = _address_cache.get(key)
+        if address is not None:
+            with _cache_stats_lock:
+                _address_cache_hits += 1
+            return address
+        with _cache_stats_lock:
+            _address_cache_misses += 1
     ip = frame.f_lasti
     names = []
-    var_name = _extract_target_of_assignment()
+    var_name, static = _extract_target_of_assignment(frame.f_code, ip, frame)
     if var_name is None:
         names.append('?')
     else:
@@ -47,126 +150,377 @@ def _extract_address(root_function_name):
         if n == root_function_name:
             break
         frame = frame.f_back
-    return '{}__{}'.format(ip, '__'.join(reversed(names)))
+    address = '{}__{}'.format(ip, '__'.join(reversed(names)))
+    if _address_cache_enabled and static:
+        _address_cache[key] = address
+    return address
 
 
-def _extract_target_of_assignment():
-    frame = sys._getframe(3)
-    code = frame.f_code
-    next_instruction = code.co_code[frame.f_lasti+2]
-    instruction_arg = code.co_code[frame.f_lasti+3]
+def _extract_target_of_assignment(code, lasti, frame=None):
+    # Returns the name of the variable the result of the call at lasti is assigned to, and whether this name is determined by the code alone.
+    # The name of a target subscripted with a local variable (e.g., x[i] = pyprob.sample(...)) depends on the value of that variable in the frame, and it is None when no frame is given.
+    next_instruction = code.co_code[lasti+2]
+    instruction_arg = code.co_code[lasti+3]
     instruction_name = opcode.opname[next_instruction]
     if instruction_name == 'STORE_FAST':
-        return code.co_varnames[instruction_arg]
+        return code.co_varnames[instruction_arg], True
     elif instruction_name in ['STORE_NAME', 'STORE_GLOBAL']:
-        return code.co_names[instruction_arg]
+        return code.co_names[instruction_arg], True
     elif instruction_name in ['LOAD_FAST', 'LOAD_NAME', 'LOAD_GLOBAL'] and \
-            opcode.opname[code.co_code[frame.f_lasti+4]] in ['LOAD_CONST', 'LOAD_FAST'] and \
-            opcode.opname[code.co_code[frame.f_lasti+6]] == 'STORE_SUBSCR':
+            opcode.opname[code.co_code[lasti+4]] in ['LOAD_CONST', 'LOAD_FAST'] and \
+            opcode.opname[code.co_code[lasti+6]] == 'STORE_SUBSCR':
         base_name = (code.co_varnames if instruction_name == 'LOAD_FAST' else code.co_names)[instruction_arg]
-        second_instruction = opcode.opname[code.co_code[frame.f_lasti+4]]
-        second_arg = code.co_code[frame.f_lasti+5]
+        second_instruction = opcode.opname[code.co_code[lasti+4]]
+        second_arg = code.co_code[lasti+5]
+        static = True
         if second_instruction == 'LOAD_CONST':
             value = code.co_consts[second_arg]
         elif second_instruction == 'LOAD_FAST':
+            static = False
+            if frame is None:
+                return None, static
             var_name = code.co_varnames[second_arg]
             value = frame.f_locals[var_name]
         else:
             value = None
         if type(value) is int:
             index_name = str(value)
-            return base_name + '[' + index_name + ']'
+            return base_name + '[' + index_name + ']', static
         else:
-            return None
+            return None, static
     elif instruction_name == 'RETURN_VALUE':
-        return 'return'
+        return 'return', True
     else:
+        return None, True
+
+
+_static_call_opnames = ['CALL_FUNCTION', 'CALL_FUNCTION_KW', 'CALL_FUNCTION_EX', 'CALL_METHOD', 'CALL']
+
+
+def _is_static_callee(value):
+    # Functions of this package (pyprob.sample etc.) are the call sites being addressed, they are not descended into
+    if not isinstance(value, types.FunctionType):
+        return False
+    module = getattr(value, '__module__', None) or ''
+    return not (module == __package__ or module.startswith(__package__ + '.'))
+
+
+def _static_callees(code, func_globals, self_object):
+    # Returns (code, globals, self) for the Python functions and nested code objects that can be called from code
+    callees = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            callees.append((const, func_globals, self_object))
+    self_name = code.co_varnames[0] if (self_object is not None and code.co_argcount > 0) else None
+    previous = None
+    previous_value = None
+    for instruction in dis.get_instructions(code):
+        value = None
+        if instruction.opname in ['LOAD_GLOBAL', 'LOAD_NAME']:
+            name = instruction.argval
+            value = func_globals.get(name, getattr(builtins, name, None))
+        elif instruction.opname in ['LOAD_ATTR', 'LOAD_METHOD'] and previous is not None:
+            if previous.opname == 'LOAD_FAST' and previous.argval == self_name:
+                value = getattr(type(self_object), instruction.argval, None)
+            elif isinstance(previous_value, types.ModuleType):
+                value = getattr(previous_value, instruction.argval, None)
+        if _is_static_callee(value):
+            callees.append((value.__code__, value.__globals__, self_object))
+        previous = instruction
+        previous_value = value
+    return callees
+
+
+def _compile_static_addresses(func):
+    # Returns a dictionary mapping (code, instruction offset) of every call site reachable from func to (address, codes of the calling frames), computing the addresses _extract_address would give these call sites at runtime
+    # The codes of the calling frames are those _extract_address walks through, innermost first, and an address is used at runtime only when the frames match them (e.g., not when a function is reached through a callable passed as an argument)
+    # Code reachable through more than one chain of callers (e.g., recursion or a function called from several places) is left out and its addresses are extracted at runtime
+    root_function_name = func.__code__.co_name
+    self_object = getattr(func, '__self__', None)
+    func = getattr(func, '__func__', func)
+    contexts = {}
+    ambiguous = set()
+    queue = [(func.__code__, func.__globals__, self_object, (root_function_name,), ())]
+    while len(queue) > 0:
+        code, func_globals, self_object, names, callers = queue.pop()
+        if code in ambiguous:
+            continue
+        if code in contexts:
+            if contexts[code] != (names, callers):
+                ambiguous.add(code)
+            continue
+        contexts[code] = (names, callers)
+        for callee_code, callee_globals, callee_self_object in _static_callees(code, func_globals, self_object):
+            n = callee_code.co_name
+            # The address of a call site depends on the calling frame only when _extract_address walks past the frame of the call site
+            if n.startswith('<') and not n == '<listcomp>':
+                queue.append((callee_code, callee_globals, callee_self_object, (), ()))
+            elif n == root_function_name:
+                queue.append((callee_code, callee_globals, callee_self_object, (n,), ()))
+            else:
+                queue.append((callee_code, callee_globals, callee_self_object, names + (n,), (code,) + callers))
+    # Callees of ambiguous code inherit the ambiguity
+    queue = list(ambiguous)
+    while len(queue) > 0:
+        code = queue.pop()
+        for callee_code, (_, callers) in contexts.items():
+            if code in callers and callee_code not in ambiguous:
+                ambiguous.add(callee_code)
+                queue.append(callee_code)
+
+    static_addresses = {}
+    for code, (names, callers) in contexts.items():
+        if code in ambiguous:
+            continue
+        instructions = list(dis.get_instructions(code))
+        for instruction, next_instruction in zip(instructions, instructions[1:]):
+            if instruction.opname not in _static_call_opnames:
+                continue
+            # The instruction pointer of a calling frame is at the last code unit of the call instruction, which includes any inline cache entries following it
+            ip = next_instruction.offset - 2
+            try:
+                var_name, static = _extract_target_of_assignment(code, ip)
+            except IndexError:
+                continue
+            if not static:
+                continue
+            if var_name is None:
+                var_name = '?'
+            address = '{}__{}'.format(ip, '__'.join(names + (var_name,)))
+            static_addresses[(code, ip)] = (address, callers)
+    return static_addresses
+
+
+def _address(address_base, instance):
+    # The address of an instance of an address_base is built once and then looked up in the address table
+    return address_table.address(address_table.instance_id(address_table.id(address_base), instance))
+
+
+# Prior inflation rules, by distribution type, with the inflated proposals cached per address
+_inflation_rules = {}
+_inflation_cache = {}
+_inflation_cache_enabled = True
+_inflation_cache_hits = 0
+_inflation_cache_misses = 0
+
+
+def register_inflation_rule(distribution_type, inflate, signature=None):
+    # inflate(distribution) returns the proposal used in place of a distribution of distribution_type with PriorInflation.ENABLED
+    # signature(distribution) returns a hashable signature of the parameters the proposal depends on, or None if the proposal cannot be reused, the proposal for an address being reused while the signature at the address is unchanged
+    _inflation_rules[distribution_type] = (inflate, signature)
+    clear_inflation_cache()
+
+
+def set_inflation_cache(enabled=True):
+    global _inflation_cache_enabled
+    _inflation_cache_enabled = enabled
+    clear_inflation_cache()
+
+
+def clear_inflation_cache():
+    global _inflation_cache_hits
+    global _inflation_cache_misses
+    _inflation_cache.clear()
+    with _cache_stats_lock:
+        _inflation_cache_hits = 0
+        _inflation_cache_misses = 0
+
+
+def inflation_cache_stats():
+    return {'enabled': _inflation_cache_enabled, 'size': len(_inflation_cache), 'hits': _inflation_cache_hits, 'misses': _inflation_cache_misses}
+
+
+def _scalar_parameters_signature(*parameters):
+    # Signature of scalar parameters, None for parameters with more than one element (e.g., batched)
+    if any(util.to_tensor(parameter).numel() != 1 for parameter in parameters):
         return None
+    return tuple(float(parameter) for parameter in parameters)
 
 
-def _inflate(distribution):
-    if _prior_inflation == PriorInflation.ENABLED:
-        if isinstance(distribution, Categorical):
-            return Categorical(util.to_tensor(torch.zeros(distribution.num_categories).fill_(1./distribution.num_categories)))
-        elif isinstance(distribution, Normal):
-            return Normal(distribution.mean, distribution.stddev * 3)
-    return None
+register_inflation_rule(Categorical, lambda distribution: Categorical(util.to_tensor(torch.zeros(distribution.num_categories).fill_(1./distribution.num_categories))), lambda distribution: distribution.num_categories)
+register_inflation_rule(Normal, lambda distribution: Normal(distribution.mean, distribution.stddev * 3), lambda distribution: _scalar_parameters_signature(distribution.mean, distribution.stddev))
+
+
+def _inflate(distribution, prior_inflation, address_base=None):
+    if prior_inflation != PriorInflation.ENABLED:
+        return None
+    rule = _inflation_rules.get(type(distribution))
+    if rule is None:
+        for distribution_type, r in _inflation_rules.items():
+            if isinstance(distribution, distribution_type):
+                rule = r
+                break
+        else:
+            return None
+    inflate, signature = rule
+    if not _inflation_cache_enabled or address_base is None or signature is None:
+        return inflate(distribution)
+    global _inflation_cache_hits
+    global _inflation_cache_misses
+    parameters_signature = signature(distribution)
+    if parameters_signature is None:
+        return inflate(distribution)
+    # One proposal is kept per address, for the last signature seen at the address
+    key = (address_base, type(distribution), parameters_signature)
+    entry = _inflation_cache.get(address_base)
+    if entry is not None and entry[0] == key:
+        with _cache_stats_lock:
+            _inflation_cache_hits += 1
+        return entry[1]
+    with _cache_stats_lock:
+        _inflation_cache_misses += 1
+    inflated_distribution = inflate(distribution)
+    _inflation_cache[address_base] = (key, inflated_distribution)
+    return inflated_distribution
+
+
+def _batch_sample(distribution, batch_size):
+    # Returns batch_size values sampled from distribution, with a leading batch dimension
+    # A distribution whose leading batch dimension is already batch_size (e.g., with parameters depending on earlier batched values) is sampled as it is
+    batch_shape = distribution.batch_shape
+    if len(batch_shape) > 0 and batch_shape[0] == batch_size:
+        return distribution.sample()
+    if distribution._torch_dist is not None:
+        return distribution._torch_dist.sample(torch.Size([batch_size]))
+    return torch.stack([util.to_tensor(distribution.sample()) for i in range(batch_size)])
+
+
+def _batch_log_prob(distribution, value, batch_size):
+    # Returns the log_prob of each of the batch_size particles, summing over all dimensions other than the leading batch dimension
+    log_prob = util.to_tensor(distribution.log_prob(value))
+    if log_prob.dim() > 0 and log_prob.size(0) == batch_size:
+        return log_prob.view(batch_size, -1).sum(1)
+    else:
+        # Shared by all particles
+        return torch.sum(log_prob).expand(batch_size)
+
+
+def _sample_batch(trace_state, distribution, address_base, instance, control, replace, name):
+    batch_size = trace_state.batch_size
+    address = _address(address_base, instance)
+    if name in trace_state.current_trace_observed_variables:
+        value = trace_state.current_trace_observed_variables[name]
+        log_prob = trace_state.likelihood_importance * _batch_log_prob(distribution, value, batch_size)
+        return Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, log_importance_weight=log_prob, observed=True, name=name)
+    inflated_distribution = _inflate(distribution, trace_state.prior_inflation, address_base)
+    if inflated_distribution is None:
+        value = _batch_sample(distribution, batch_size)
+        log_prob = _batch_log_prob(distribution, value, batch_size)
+        log_importance_weight = None
+    else:
+        value = _batch_sample(inflated_distribution, batch_size)
+        log_prob = _batch_log_prob(distribution, value, batch_size)
+        log_importance_weight = log_prob - _batch_log_prob(inflated_distribution, value, batch_size)  # To account for prior inflation
+    return Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, log_importance_weight=log_importance_weight, control=control, replace=replace, name=name)
 
 
 def tag(value, name=None, address=None):
-    global _current_trace
+    trace_state = _get_trace_state()
     if address is None:
-        address_base = _extract_address(_current_trace_root_function_name) + '__None'
+        address_base = _extract_address(trace_state.current_trace_root_function_name, trace_state.static_addresses) + '__None'
     else:
         address_base = address + '__None'
-    if _address_dictionary is not None:
-        address_base = _address_dictionary.address_to_id(address_base)
-    instance = _current_trace.last_instance(address_base) + 1
-    address = address_base + '__' + str(instance)
+    if trace_state.address_dictionary is not None:
+        address_base = trace_state.address_dictionary.address_to_id(address_base)
+    instance = trace_state.current_trace.last_instance(address_base) + 1
+    address = _address(address_base, instance)
 
     value = util.to_tensor(value)
 
     variable = Variable(distribution=None, value=value, address_base=address_base, address=address, instance=instance, log_prob=0., tagged=True, name=name)
-    _current_trace.add(variable)
+    trace_state.current_trace.add(variable)
 
 
 def observe(distribution, value=None, name=None, address=None):
-    global _current_trace
+    trace_state = _get_trace_state()
     if address is None:
-        address_base = _extract_address(_current_trace_root_function_name) + '__' + distribution._address_suffix
+        address_base = _extract_address(trace_state.current_trace_root_function_name, trace_state.static_addresses) + '__' + distribution._address_suffix
     else:
         address_base = address + '__' + distribution._address_suffix
-    if _address_dictionary is not None:
-        address_base = _address_dictionary.address_to_id(address_base)
-    instance = _current_trace.last_instance(address_base) + 1
-    address = address_base + '__' + str(instance)
+    if trace_state.address_dictionary is not None:
+        address_base = trace_state.address_dictionary.address_to_id(address_base)
+    instance = trace_state.current_trace.last_instance(address_base) + 1
+    address = _address(address_base, instance)
 
-    if name in _current_trace_observed_variables:
+    if name in trace_state.current_trace_observed_variables:
         # Override observed value
-        value = _current_trace_observed_variables[name]
+        value = trace_state.current_trace_observed_variables[name]
     elif value is not None:
         value = util.to_tensor(value)
     elif distribution is not None:
-        value = distribution.sample()
+        if trace_state.batch_size is None:
+            value = distribution.sample()
+        else:
+            value = _batch_sample(distribution, trace_state.batch_size)
 
-    log_prob = _likelihood_importance * distribution.log_prob(value, sum=True)
-    if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+    if trace_state.batch_size is None:
+        log_prob = trace_state.likelihood_importance * distribution.log_prob(value, sum=True)
+    else:
+        log_prob = trace_state.likelihood_importance * _batch_log_prob(distribution, value, trace_state.batch_size)
+    if trace_state.batch_size is not None:
+        log_importance_weight = log_prob
+    elif trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK or trace_state.inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
         log_importance_weight = float(log_prob)
     else:
         log_importance_weight = None  # TODO: Check the reason/behavior for this
 
     variable = Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, log_importance_weight=log_importance_weight, observed=True, name=name)
-    _current_trace.add(variable)
+    _add_variable(trace_state, variable)
+
+
+def _add_variable(trace_state, variable):
+    trace_state.current_trace.add(variable)
+    if trace_state.batch_size is None and variable.log_importance_weight is not None and not variable.replace:
+        trace_state.current_trace_log_importance_weight += variable.log_importance_weight
+    if variable.observed:
+        trace_state.current_trace_num_observed += 1
+        if trace_state.current_trace_num_observed == trace_state.sequential_monte_carlo_observe_stop:
+            raise _InterruptTrace()
+        if trace_state.trace_pruning_threshold is not None:
+            # The partial log importance weight at an observe is compared with the maximum of the partial log importance weights of the traces so far at the same observe
+            log_importance_weights_max = trace_state.trace_pruning_log_importance_weights_max
+            observe_index = trace_state.current_trace_num_observed - 1
+            log_importance_weight = float(trace_state.current_trace_log_importance_weight)
+            if observe_index == len(log_importance_weights_max):
+                log_importance_weights_max.append(log_importance_weight)
+            elif log_importance_weight > log_importance_weights_max[observe_index]:
+                log_importance_weights_max[observe_index] = log_importance_weight
+            elif log_importance_weight < log_importance_weights_max[observe_index] - trace_state.trace_pruning_threshold:
+                trace_state.current_trace_pruned = True
+                raise _InterruptTrace()
 
 
 def sample(distribution, control=True, replace=False, name=None, address=None):
-    global _current_trace
-    global _current_trace_previous_variable
-    global _current_trace_replaced_variable_proposal_distributions
+    trace_state = _get_trace_state()
 
     # Only replace if controlled
     if not control:
         replace = False
 
-    if _inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
+    if trace_state.inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or trace_state.inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS or trace_state.inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
         control = True
         replace = False
 
     if address is None:
-        address_base = _extract_address(_current_trace_root_function_name) + '__' + distribution._address_suffix
+        address_base = _extract_address(trace_state.current_trace_root_function_name, trace_state.static_addresses) + '__' + distribution._address_suffix
     else:
         address_base = address + '__' + distribution._address_suffix
-    if _address_dictionary is not None:
-        address_base = _address_dictionary.address_to_id(address_base)
+    if trace_state.address_dictionary is not None:
+        address_base = trace_state.address_dictionary.address_to_id(address_base)
+
+    instance = trace_state.current_trace.last_instance(address_base) + 1
 
-    instance = _current_trace.last_instance(address_base) + 1
+    if trace_state.batch_size is not None:
+        variable = _sample_batch(trace_state, distribution, address_base, instance, control, replace, name)
+        _add_variable(trace_state, variable)
+        return variable.value
 
-    if name in _current_trace_observed_variables:
+    if name in trace_state.current_trace_observed_variables:
         # Variable is observed
-        address = address_base + '__' + str(instance)
-        value = _current_trace_observed_variables[name]
-        log_prob = _likelihood_importance * distribution.log_prob(value, sum=True)
-        if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+        address = _address(address_base, instance)
+        value = trace_state.current_trace_observed_variables[name]
+        log_prob = trace_state.likelihood_importance * distribution.log_prob(value, sum=True)
+        if trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK or trace_state.inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
             log_importance_weight = float(log_prob)
         else:
             log_importance_weight = None  # TODO: Check the reason/behavior for this
@@ -175,10 +529,10 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
         # Variable is sampled
         reused = False
         observed = False
-        if _trace_mode == TraceMode.POSTERIOR:
-            if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING:
-                address = address_base + '__' + str(instance)
-                inflated_distribution = _inflate(distribution)
+        if trace_state.trace_mode == TraceMode.POSTERIOR:
+            if trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING:
+                address = _address(address_base, instance)
+                inflated_distribution = _inflate(distribution, trace_state.prior_inflation, address_base)
                 if inflated_distribution is None:
                     value = distribution.sample()
                     log_prob = distribution.log_prob(value, sum=True)
@@ -187,19 +541,19 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                     value = inflated_distribution.sample()
                     log_prob = distribution.log_prob(value, sum=True)
                     log_importance_weight = float(log_prob) - float(inflated_distribution.log_prob(value, sum=True))  # To account for prior inflation
-            elif _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
-                address = address_base + '__' + ('replaced' if replace else str(instance))
+            elif trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+                address = _address(address_base, 'replaced' if replace else instance)
                 if control:
                     variable = Variable(distribution=distribution, value=None, address_base=address_base, address=address, instance=instance, log_prob=0., control=control, replace=replace, name=name, observed=observed, reused=reused)
                     update_previous_variable = False
                     if replace:
-                        # TODO: address not in _current_trace_replaced_variable_proposal_distributions might not be sufficient to discover a new replace loop instance. Implement better.
-                        if address not in _current_trace_replaced_variable_proposal_distributions:
-                            _current_trace_replaced_variable_proposal_distributions[address] = _current_trace_inference_network._infer_step(variable, prev_variable=_current_trace_previous_variable, proposal_min_train_iterations=_current_trace_inference_network_proposal_min_train_iterations)
+                        # TODO: address not in trace_state.current_trace_replaced_variable_proposal_distributions might not be sufficient to discover a new replace loop instance. Implement better.
+                        if address not in trace_state.current_trace_replaced_variable_proposal_distributions:
+                            trace_state.current_trace_replaced_variable_proposal_distributions[address] = trace_state.current_trace_inference_network._infer_step(variable, prev_variable=trace_state.current_trace_previous_variable, proposal_min_train_iterations=trace_state.current_trace_inference_network_proposal_min_train_iterations)
                             update_previous_variable = True
-                        proposal_distribution = _current_trace_replaced_variable_proposal_distributions[address]
+                        proposal_distribution = trace_state.current_trace_replaced_variable_proposal_distributions[address]
                     else:
-                        proposal_distribution = _current_trace_inference_network._infer_step(variable, prev_variable=_current_trace_previous_variable, proposal_min_train_iterations=_current_trace_inference_network_proposal_min_train_iterations)
+                        proposal_distribution = trace_state.current_trace_inference_network._infer_step(variable, prev_variable=trace_state.current_trace_previous_variable, proposal_min_train_iterations=trace_state.current_trace_inference_network_proposal_min_train_iterations)
                         update_previous_variable = True
                     value = proposal_distribution.sample()
                     if value.dim() > 0:
@@ -219,24 +573,32 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                     log_importance_weight = float(log_prob) - float(proposal_log_prob)
                     if update_previous_variable:
                         variable = Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, log_importance_weight=log_importance_weight, control=control, replace=replace, name=name, observed=observed, reused=reused)
-                        _current_trace_previous_variable = variable
+                        trace_state.current_trace_previous_variable = variable
                         # print('prev_var address {}'.format(variable.address))
                 else:
                     value = distribution.sample()
                     log_prob = distribution.log_prob(value, sum=True)
                     log_importance_weight = None
-                address = address_base + '__' + str(instance)
-            else:  # _inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS
-                address = address_base + '__' + str(instance)
+                address = _address(address_base, instance)
+            elif trace_state.inference_engine == InferenceEngine.SEQUENTIAL_MONTE_CARLO:
+                address = _address(address_base, instance)
                 log_importance_weight = None
-                if _metropolis_hastings_trace is None:
+                if trace_state.sequential_monte_carlo_replay is not None and address in trace_state.sequential_monte_carlo_replay:
+                    value = trace_state.sequential_monte_carlo_replay[address]
+                    reused = True
+                else:
+                    value = distribution.sample()
+                log_prob = distribution.log_prob(value, sum=True)
+            else:  # trace_state.inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or trace_state.inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS
+                address = _address(address_base, instance)
+                log_importance_weight = None
+                if trace_state.metropolis_hastings_trace is None:
                     value = distribution.sample()
                     log_prob = distribution.log_prob(value, sum=True)
                 else:
-                    if address == _metropolis_hastings_site_address:
-                        global _metropolis_hastings_site_transition_log_prob
-                        _metropolis_hastings_site_transition_log_prob = util.to_tensor(0.)
-                        if _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
+                    if address == trace_state.metropolis_hastings_site_address:
+                        trace_state.metropolis_hastings_site_transition_log_prob = util.to_tensor(0.)
+                        if trace_state.inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
                             if isinstance(distribution, Normal):
                                 proposal_kernel_func = lambda x: Normal(x, distribution.stddev)
                             elif isinstance(distribution, Uniform):
@@ -245,8 +607,8 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                                 proposal_kernel_func = None
 
                             if proposal_kernel_func is not None:
-                                _metropolis_hastings_site_value = _metropolis_hastings_trace.variables_dict_address[address].value
-                                _metropolis_hastings_site_log_prob = _metropolis_hastings_trace.variables_dict_address[address].log_prob
+                                _metropolis_hastings_site_value = trace_state.metropolis_hastings_trace.variables_dict_address[address].value
+                                _metropolis_hastings_site_log_prob = trace_state.metropolis_hastings_trace.variables_dict_address[address].log_prob
                                 proposal_kernel_forward = proposal_kernel_func(_metropolis_hastings_site_value)
                                 alpha = 0.5
                                 if random.random() < alpha:
@@ -256,8 +618,8 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                                 log_prob = distribution.log_prob(value, sum=True)
                                 proposal_kernel_reverse = proposal_kernel_func(value)
 
-                                _metropolis_hastings_site_transition_log_prob = torch.log(alpha * torch.exp(proposal_kernel_reverse.log_prob(_metropolis_hastings_site_value, sum=True)) + (1 - alpha) * torch.exp(_metropolis_hastings_site_log_prob)) + log_prob
-                                _metropolis_hastings_site_transition_log_prob -= torch.log(alpha * torch.exp(proposal_kernel_forward.log_prob(value, sum=True)) + (1 - alpha) * torch.exp(log_prob)) + _metropolis_hastings_site_log_prob
+                                trace_state.metropolis_hastings_site_transition_log_prob = torch.log(alpha * torch.exp(proposal_kernel_reverse.log_prob(_metropolis_hastings_site_value, sum=True)) + (1 - alpha) * torch.exp(_metropolis_hastings_site_log_prob)) + log_prob
+                                trace_state.metropolis_hastings_site_transition_log_prob -= torch.log(alpha * torch.exp(proposal_kernel_forward.log_prob(value, sum=True)) + (1 - alpha) * torch.exp(log_prob)) + _metropolis_hastings_site_log_prob
                             else:
                                 value = distribution.sample()
                                 log_prob = distribution.log_prob(value, sum=True)
@@ -265,12 +627,12 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                             value = distribution.sample()
                             log_prob = distribution.log_prob(value, sum=True)
                         reused = False
-                    elif address not in _metropolis_hastings_trace.variables_dict_address:
+                    elif address not in trace_state.metropolis_hastings_trace.variables_dict_address:
                         value = distribution.sample()
                         log_prob = distribution.log_prob(value, sum=True)
                         reused = False
                     else:
-                        value = _metropolis_hastings_trace.variables_dict_address[address].value
+                        value = trace_state.metropolis_hastings_trace.variables_dict_address[address].value
                         reused = True
                         try:  # Takes care of issues such as changed distribution parameters (e.g., batch size) that prevent a rescoring of a reused value under this distribution.
                             log_prob = distribution.log_prob(value, sum=True)
@@ -279,12 +641,12 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
                             log_prob = distribution.log_prob(value, sum=True)
                             reused = False
 
-        else:  # _trace_mode == TraceMode.PRIOR or _trace_mode == TraceMode.PRIOR_FOR_INFERENCE_NETWORK:
-            if _trace_mode == TraceMode.PRIOR:
-                address = address_base + '__' + str(instance)
-            elif _trace_mode == TraceMode.PRIOR_FOR_INFERENCE_NETWORK:
-                address = address_base + '__' + ('replaced' if replace else str(instance))
-            inflated_distribution = _inflate(distribution)
+        else:  # trace_state.trace_mode == TraceMode.PRIOR or trace_state.trace_mode == TraceMode.PRIOR_FOR_INFERENCE_NETWORK:
+            if trace_state.trace_mode == TraceMode.PRIOR:
+                address = _address(address_base, instance)
+            elif trace_state.trace_mode == TraceMode.PRIOR_FOR_INFERENCE_NETWORK:
+                address = _address(address_base, 'replaced' if replace else instance)
+            inflated_distribution = _inflate(distribution, trace_state.prior_inflation, address_base)
             if inflated_distribution is None:
                 value = distribution.sample()
                 log_prob = distribution.log_prob(value, sum=True)
@@ -296,69 +658,85 @@ def sample(distribution, control=True, replace=False, name=None, address=None):
 
         variable = Variable(distribution=distribution, value=value, address_base=address_base, address=address, instance=instance, log_prob=log_prob, log_importance_weight=log_importance_weight, control=control, replace=replace, name=name, observed=observed, reused=reused)
 
-    _current_trace.add(variable)
+    _add_variable(trace_state, variable)
     return variable.value
 
 
-def _init_traces(func, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, address_dictionary=None, likelihood_importance=1.):
-    global _trace_mode
-    global _inference_engine
-    global _prior_inflation
-    global _likelihood_importance
-    _trace_mode = trace_mode
-    _inference_engine = inference_engine
-    _prior_inflation = prior_inflation
-    _likelihood_importance = likelihood_importance
-    global _current_trace_root_function_name
-    global _current_trace_inference_network
-    global _current_trace_inference_network_proposal_min_train_iterations
-    global _current_trace_observed_variables
-    global _address_dictionary
-    _address_dictionary = address_dictionary
-    _current_trace_root_function_name = func.__code__.co_name
+def _init_traces(func, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, observe=None, metropolis_hastings_trace=None, address_dictionary=None, likelihood_importance=1., static_addresses=None, batch_size=None, trace_recording=TraceRecording.FULL):
+    trace_state = _TraceState()
+    _set_trace_state(trace_state)
+    trace_state.trace_mode = trace_mode
+    trace_state.inference_engine = inference_engine
+    trace_state.prior_inflation = prior_inflation
+    trace_state.likelihood_importance = likelihood_importance
+    trace_state.address_dictionary = address_dictionary
+    trace_state.static_addresses = static_addresses
+    if batch_size is not None and not (inference_engine == InferenceEngine.IMPORTANCE_SAMPLING and trace_mode in [TraceMode.PRIOR, TraceMode.POSTERIOR]):
+        raise ValueError('Particle-batched execution is only supported for prior sampling and IMPORTANCE_SAMPLING.')
+    trace_state.batch_size = batch_size
+    if trace_recording != TraceRecording.FULL and (batch_size is not None or inference_engine not in [InferenceEngine.IMPORTANCE_SAMPLING, InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK]):
+        raise ValueError('Trace recording other than FULL is only supported for prior sampling and importance sampling without particle-batched execution.')
+    trace_state.trace_recording = trace_recording
+    trace_state.current_trace_root_function_name = func.__code__.co_name
     if observe is None:
-        _current_trace_observed_variables = {}
+        trace_state.current_trace_observed_variables = {}
     else:
-        _current_trace_observed_variables = observe
-    _current_trace_inference_network = inference_network
-    if _current_trace_inference_network is None:
-        if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+        trace_state.current_trace_observed_variables = observe
+    trace_state.current_trace_inference_network = inference_network
+    if trace_state.current_trace_inference_network is None:
+        if trace_state.inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
             raise ValueError('Cannot run trace with IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK without an inference network.')
     else:
-        _current_trace_inference_network.eval()
-        _current_trace_inference_network._infer_init(_current_trace_observed_variables)
-        # _current_trace_inference_network_proposal_min_train_iterations = int(_current_trace_inference_network._total_train_iterations / 10)
-        _current_trace_inference_network_proposal_min_train_iterations = None
-
-    if _inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
-        global _metropolis_hastings_trace
-        global _metropolis_hastings_site_transition_log_prob
-        _metropolis_hastings_trace = metropolis_hastings_trace
-        _metropolis_hastings_site_transition_log_prob = None
-        if _metropolis_hastings_trace is not None:
-            global _metropolis_hastings_site_address
-            variable = random.choice(_metropolis_hastings_trace.variables_controlled)
-            _metropolis_hastings_site_address = variable.address
-
-
-def _begin_trace(file_name=None, file_sync_timeout=100):
-    global _current_trace
-    global _current_trace_previous_variable
-    global _current_trace_replaced_variable_proposal_distributions
-    global _current_trace_execution_start
-    _current_trace_execution_start = time.time()
-    if file_name is not None:
-        #_current_trace = TraceShelve(file_name=file_name,
-        #                             file_sync_timeout=file_sync_timeout)
-        _current_trace = TraceHash(file_name=file_name)
+        trace_state.current_trace_inference_network.eval()
+        trace_state.current_trace_inference_network._infer_init(trace_state.current_trace_observed_variables)
+        # trace_state.current_trace_inference_network_proposal_min_train_iterations = int(trace_state.current_trace_inference_network._total_train_iterations / 10)
+        trace_state.current_trace_inference_network_proposal_min_train_iterations = None
+
+    if trace_state.inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or trace_state.inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
+        trace_state.metropolis_hastings_trace = metropolis_hastings_trace
+    return trace_state
+
+
+def _set_sequential_monte_carlo_particle(trace_state, replay, observe_stop):
+    # The values sampled so far by a particle (a dictionary from address to value) to be replayed, and the number of the observe to stop the next trace at
+    trace_state.sequential_monte_carlo_replay = replay
+    trace_state.sequential_monte_carlo_observe_stop = observe_stop
+
+
+def _set_trace_pruning_threshold(trace_state, threshold):
+    # The execution of the next traces stops at the first observe where their partial log importance weight is more than threshold below the maximum at that observe
+    trace_state.trace_pruning_threshold = threshold
+    trace_state.trace_pruning_log_importance_weights_max = []
+
+
+def _set_metropolis_hastings_trace(trace_state, metropolis_hastings_trace):
+    # The current trace of the Metropolis Hastings chain, which the next traces (i.e., candidates) will be proposed from
+    trace_state.metropolis_hastings_trace = metropolis_hastings_trace
+
 
+def _begin_trace():
+    trace_state = _get_trace_state()
+    trace_state.current_trace_execution_start = time.time()
+    if trace_state.trace_recording == TraceRecording.FULL:
+        trace_state.current_trace = Trace()
     else:
-        _current_trace = Trace()
-    _current_trace_previous_variable = None
-    _current_trace_replaced_variable_proposal_distributions = {}
+        trace_state.current_trace = LeanTrace(trace_state.trace_recording)
+    trace_state.current_trace_previous_variable = None
+    trace_state.current_trace_replaced_variable_proposal_distributions = {}
+    trace_state.current_trace_num_observed = 0
+    trace_state.current_trace_log_importance_weight = 0.
+    trace_state.current_trace_pruned = False
+    if trace_state.inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or trace_state.inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
+        trace_state.metropolis_hastings_site_transition_log_prob = None
+        if trace_state.metropolis_hastings_trace is not None:
+            variable = random.choice(trace_state.metropolis_hastings_trace.variables_controlled)
+            trace_state.metropolis_hastings_site_address = variable.address
 
 
 def _end_trace(result):
-    execution_time_sec = time.time() - _current_trace_execution_start
-    _current_trace.end(result, execution_time_sec)
-    return _current_trace
+    trace_state = _get_trace_state()
+    execution_time_sec = time.time() - trace_state.current_trace_execution_start
+    if trace_state.batch_size is not None:
+        return trace_state.current_trace.unbatch(trace_state.batch_size, result, execution_time_sec)
+    trace_state.current_trace.end(result, execution_time_sec)
+    return trace_state.current_trace
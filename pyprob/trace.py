@@ -1,26 +1,98 @@
 import torch
+import zlib
+import bz2
+import lzma
+import io
+import os
+import pickle
+import threading
 
 from . import util
+from .address_dictionary import address_table
+
+
+_CONTROL = 1
+_REPLACE = 2
+_OBSERVABLE = 4
+_OBSERVED = 8
+_REUSED = 16
+_TAGGED = 32
+_FLAG_BITS = {'control': _CONTROL, 'replace': _REPLACE, 'observable': _OBSERVABLE, 'observed': _OBSERVED, 'reused': _REUSED, 'tagged': _TAGGED}
+# Bits marking flags deleted when pruning traces for offline training datasets
+_DELETED_SHIFT = 8
+
+
+def _flag_property(name, bit):
+    def getter(self):
+        if self._flags & (bit << _DELETED_SHIFT):
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return bool(self._flags & bit)
+
+    def setter(self, value):
+        self._flags = (self._flags & ~(bit | (bit << _DELETED_SHIFT))) | (bit if value else 0)
+
+    def deleter(self):
+        self._flags = (self._flags & ~bit) | (bit << _DELETED_SHIFT)
+    return property(getter, setter, deleter)
+
+
+def _compact(value):
+    # Scalar tensors are kept as Python numbers until a tensor is needed, see Variable.value
+    if torch.is_tensor(value) and value.dim() == 0 and (not value.requires_grad) and value.device.type == 'cpu' and value.dtype == util._dtype:
+        return value.item()
+    return value
+
+
+def _expand(value):
+    if isinstance(value, float):
+        return util.to_tensor(value)
+    return value
+
+
+_FINGERPRINT_INIT = 0x345678
+_FINGERPRINT_MULTIPLIER = 1000003
+_FINGERPRINT_MASK = 0xFFFFFFFFFFFFFFFF
+_address_crc32 = {}
+
+
+def _fingerprint_update(fingerprint, address):
+    # Rolling hash of a sequence of addresses, updated with one address at a time
+    crc = _address_crc32.get(address)
+    if crc is None:
+        crc = zlib.crc32(address if isinstance(address, bytes) else address.encode())
+        _address_crc32[address] = crc
+    return ((fingerprint * _FINGERPRINT_MULTIPLIER) ^ crc) & _FINGERPRINT_MASK
+
+
+def _fingerprint(addresses):
+    fingerprint = _FINGERPRINT_INIT
+    for address in addresses:
+        fingerprint = _fingerprint_update(fingerprint, address)
+    return fingerprint
+
+
+def _slots(cls):
+    return [slot for c in reversed(cls.__mro__) for slot in getattr(c, '__slots__', ())]
 
 
 class Variable():
+    __slots__ = ('distribution', '_value', '_address_base_id', '_address_id', 'instance', '_log_prob', 'log_importance_weight', 'name', '_flags', 'hash_funcname')
+
     def __init__(self, distribution=None, value=None, address_base=None, address=None, instance=None, log_prob=None, log_importance_weight=None, control=False, replace=False, name=None, observed=False, reused=False, tagged=False):
         self.distribution = distribution
-        if value is None:
-            self.value = None
-        else:
-            self.value = util.to_tensor(value)
+        self.value = value
         self.address_base = address_base
         self.address = address
         self.instance = instance
-        if log_prob is None:
-            self.log_prob = None
-        else:
-            self.log_prob = util.to_tensor(log_prob)
+        self.log_prob = log_prob
         if log_importance_weight is None:
             self.log_importance_weight = None
+        elif torch.is_tensor(log_importance_weight) and log_importance_weight.dim() > 0:
+            # One weight per particle in particle-batched execution, see Trace.unbatch
+            self.log_importance_weight = log_importance_weight
         else:
             self.log_importance_weight = float(log_importance_weight)
+        self._flags = 0
         self.control = control
         self.replace = replace
         self.name = name
@@ -29,6 +101,121 @@ class Variable():
         self.reused = reused
         self.tagged = tagged
 
+    control = _flag_property('control', _CONTROL)
+    replace = _flag_property('replace', _REPLACE)
+    observable = _flag_property('observable', _OBSERVABLE)
+    observed = _flag_property('observed', _OBSERVED)
+    reused = _flag_property('reused', _REUSED)
+    tagged = _flag_property('tagged', _TAGGED)
+
+    # Addresses are interned in the process-wide address_table and stored as integer ids
+    @property
+    def address_base(self):
+        return None if self._address_base_id is None else address_table.address(self._address_base_id)
+
+    @address_base.setter
+    def address_base(self, value):
+        self._address_base_id = None if value is None else address_table.id(value)
+
+    @address_base.deleter
+    def address_base(self):
+        del self._address_base_id
+
+    @property
+    def address_base_id(self):
+        return self._address_base_id
+
+    @property
+    def address(self):
+        return None if self._address_id is None else address_table.address(self._address_id)
+
+    @address.setter
+    def address(self, value):
+        self._address_id = None if value is None else address_table.id(value)
+
+    @address.deleter
+    def address(self):
+        del self._address_id
+
+    @property
+    def address_id(self):
+        return self._address_id
+
+    @property
+    def value(self):
+        # A compacted value is turned into a tensor on first access and kept as that tensor, so that it is the same tensor on every access (e.g., for in-place updates)
+        value = self._value
+        if isinstance(value, float):
+            value = _expand(value)
+            self._value = value
+        return value
+
+    @value.setter
+    def value(self, value):
+        self._value = None if value is None else _compact(util.to_tensor(value))
+
+    @value.deleter
+    def value(self):
+        del self._value
+
+    @property
+    def log_prob(self):
+        log_prob = self._log_prob
+        if isinstance(log_prob, float):
+            log_prob = _expand(log_prob)
+            self._log_prob = log_prob
+        return log_prob
+
+    @log_prob.setter
+    def log_prob(self, value):
+        self._log_prob = None if value is None else _compact(util.to_tensor(value))
+
+    @log_prob.deleter
+    def log_prob(self):
+        del self._log_prob
+
+    def copy(self, distribution=True):
+        ret = Variable.__new__(Variable)
+        for slot in Variable.__slots__:
+            if hasattr(self, slot):
+                setattr(ret, slot, getattr(self, slot))
+        if not distribution:
+            ret.distribution = None
+        return ret
+
+    def __getstate__(self):
+        # Pickled as a dictionary of attributes, the format of traces saved before Variable had __slots__
+        state = {}
+        for slot in _slots(type(self)):
+            if slot == '_flags':
+                continue
+            if slot in ('_address_base_id', '_address_id'):
+                # Address ids are specific to a process, addresses are saved as strings
+                name = slot[1:-3]
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+            elif slot in ('_value', '_log_prob'):
+                # Saved as tensors, as before values were compacted
+                if hasattr(self, slot):
+                    state[slot[1:]] = _expand(getattr(self, slot))
+            elif hasattr(self, slot):
+                state[slot.lstrip('_')] = getattr(self, slot)
+        for name in ['control', 'replace', 'observable', 'observed', 'reused', 'tagged']:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        self._flags = 0
+        for name, value in state.items():
+            if name in ('value', 'log_prob'):
+                setattr(self, '_' + name, None if value is None else _compact(value))
+            else:
+                setattr(self, name, value)
+        for name in ['control', 'replace', 'observable', 'observed', 'reused', 'tagged']:
+            if name not in state:
+                delattr(self, name)
+
     def __repr__(self):
         # The 'Unknown' cases below are for handling pruned variables in offline training datasets
         return 'Variable(name:{}, control:{}, replace:{}, observable:{}, observed:{}, tagged:{}, address:{}, distribution:{}, value:{}: log_prob:{})'.format(
@@ -56,7 +243,103 @@ class Variable():
         return hash(self) == hash(other)
 
 
+def _particle_value(value, index, batch_size):
+    # Returns the value of particle index in a value of particle-batched execution, where values with a leading dimension of batch_size are batched and other values are shared by all particles
+    if torch.is_tensor(value):
+        if value.dim() > 0 and value.size(0) == batch_size:
+            return value[index]
+        else:
+            return value
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_particle_value(v, index, batch_size) for v in value)
+    elif isinstance(value, dict):
+        return {k: _particle_value(v, index, batch_size) for k, v in value.items()}
+    else:
+        return value
+
+
+def _sum_log_probs(log_probs):
+    # Sums a list of log_probs, stored as Python floats or as tensors of any shape (see Variable), with one concatenation instead of a Python sum over the individual tensors
+    if len(log_probs) == 0:
+        return 0.
+    ret = util.to_tensor(sum([log_prob for log_prob in log_probs if isinstance(log_prob, float)]))
+    tensors = [log_prob.reshape(-1) for log_prob in log_probs if not isinstance(log_prob, float)]
+    if len(tensors) > 0:
+        ret = ret + torch.cat(tensors).sum()
+    return ret
+
+
+class TraceColumns():
+    # Columnar view of the controlled variables of an ended trace: the values of all controlled variables flattened into one contiguous tensor per dtype, and one entry per controlled variable in log_probs, flags and addresses
+    __slots__ = ('values', 'value_columns', 'value_offsets', 'value_shapes', 'log_probs', 'flags', 'addresses', 'address_indices')
+
+    def __init__(self, variables):
+        # Values are not concatenated across dtypes, e.g., the int64 values of Categorical variables are kept apart from float values, without promotion
+        column_values = {}
+        column_lengths = {}
+        self.value_columns = []
+        self.value_offsets = []
+        self.value_shapes = []
+        for variable in variables:
+            value = variable._value
+            if isinstance(value, float):
+                dtype = util._dtype
+                shape = torch.Size()
+                length = 1
+            else:
+                dtype = value.dtype
+                shape = value.size()
+                length = value.nelement()
+            if dtype not in column_values:
+                column_values[dtype] = []
+                column_lengths[dtype] = 0
+            column_values[dtype].append(value)
+            self.value_columns.append(list(column_values).index(dtype))
+            self.value_offsets.append((column_lengths[dtype], column_lengths[dtype] + length))
+            self.value_shapes.append(shape)
+            column_lengths[dtype] += length
+        values = []
+        for dtype, column in column_values.items():
+            if all(isinstance(value, float) for value in column):
+                values.append(util.to_tensor(column).reshape(-1))
+            else:
+                values.append(torch.cat([util.to_tensor([value]) if isinstance(value, float) else value.reshape(-1) for value in column]))
+        self.values = tuple(values)
+        # log_probs are not available for the variables of pruned traces in offline training datasets
+        if all(hasattr(variable, '_log_prob') for variable in variables):
+            log_probs = [variable._log_prob for variable in variables]
+            self.log_probs = util.to_tensor([log_prob if isinstance(log_prob, float) else float(torch.sum(log_prob)) for log_prob in log_probs]).reshape(-1)
+        else:
+            self.log_probs = None
+        self.flags = torch.tensor([variable._flags for variable in variables], dtype=torch.int64)
+        self.addresses = [variable.address for variable in variables]
+        self.address_indices = {address: i for i, address in enumerate(self.addresses)}
+
+    def __len__(self):
+        return len(self.value_shapes)
+
+    def value(self, index):
+        start, end = self.value_offsets[index]
+        return self.values[self.value_columns[index]][start:end].view(self.value_shapes[index])
+
+    def mask(self, flag):
+        # flag is the name of a Variable flag, e.g., 'reused'
+        return (self.flags & _FLAG_BITS[flag]) != 0
+
+    @staticmethod
+    def stack(columns):
+        # Stacks the values of traces of the same type (same controlled addresses) into one [len(columns), num_values] tensor per dtype, to be indexed with batch_value
+        return tuple(torch.stack([c.values[i] for c in columns]) for i in range(len(columns[0].values)))
+
+    def batch_value(self, values, index):
+        start, end = self.value_offsets[index]
+        values = values[self.value_columns[index]]
+        return values[:, start:end].view((values.size(0),) + self.value_shapes[index])
+
+
 class Trace():
+    __slots__ = ('variables', 'variables_controlled', 'variables_uncontrolled', 'variables_replaced', 'variables_observed', 'variables_observable', 'variables_tagged', 'variables_dict_address', 'variables_dict_address_base', 'named_variables', 'result', 'log_prob', 'log_prob_observed', 'log_importance_weight', 'length', 'length_controlled', 'execution_time_sec', '_columns', '_fingerprint', '_fingerprint_base', '_type_id')
+
     def __init__(self):
         self.variables = []
         self.variables_controlled = []
@@ -75,6 +358,10 @@ class Trace():
         self.length = 0
         self.length_controlled = 0
         self.execution_time_sec = None
+        self._columns = None
+        self._fingerprint = _FINGERPRINT_INIT
+        self._fingerprint_base = _FINGERPRINT_INIT
+        self._type_id = None
 
     def __repr__(self):
         # The 'Unknown' cases below are for handling pruned traces in offline training datasets
@@ -93,40 +380,136 @@ class Trace():
         self.variables.append(variable)
         self.variables_dict_address[variable.address] = variable
         self.variables_dict_address_base[variable.address_base] = variable
+        self._fingerprint = _fingerprint_update(self._fingerprint, variable.address)
+        self._fingerprint_base = _fingerprint_update(self._fingerprint_base, variable.address_base)
 
     def end(self, result, execution_time_sec):
         self.result = result
         self.execution_time_sec = execution_time_sec
-        replaced_indices = []
-        for i in range(len(self.variables)):
-            variable = self.variables[i]
-            if variable.name is not None:
-                self.named_variables[variable.name] = variable
-            if variable.control and i not in replaced_indices:
-                if variable.replace:
-                    for j in range(i + 1, len(self.variables)):
-                        if self.variables[j].address_base == variable.address_base:
-                            self.variables_replaced.append(variable)
-                            variable = self.variables[j]
-                            replaced_indices.append(j)
-                self.variables_controlled.append(variable)
-        self.variables_uncontrolled = [v for v in self.variables if (not v.control) and (not v.observed) and (not v.tagged)]
-        self.variables_observed = [v for v in self.variables if v.observed]
-        self.variables_observable = [v for v in self.variables if v.observable]
-        self.variables_tagged = [v for v in self.variables if v.tagged]
-        self.log_prob = sum([torch.sum(v.log_prob) for v in self.variables if v.control or v.observed])
-        self.log_prob_observed = sum([torch.sum(v.log_prob) for v in self.variables_observed])
-        self.length = len(self.variables)
-        self.length_controlled = len(self.variables_controlled)
+        # Classifies the variables and accumulates log_probs and log_importance_weights in a single pass
+        # A controlled variable with replace=True takes a slot in variables_controlled that is overwritten by the later variables with the same address_base, the overwritten ones going to variables_replaced
+        variables_controlled = []
+        variables_uncontrolled = []
+        variables_replaced = []
+        variables_observed = []
+        variables_observable = []
+        variables_tagged = []
+        named_variables = {}
+        replace_slots = {}
+        log_probs = []
+        log_probs_observed = []
+        log_importance_weight = 0.
         replaced_log_importance_weights = {}
         for variable in self.variables:
+            if variable.name is not None:
+                named_variables[variable.name] = variable
+            address_base = variable.address_base
+            if address_base in replace_slots:
+                slot = replace_slots[address_base]
+                variables_replaced.append(variables_controlled[slot])
+                variables_controlled[slot] = variable
+            elif variable.control:
+                if variable.replace:
+                    replace_slots[address_base] = len(variables_controlled)
+                variables_controlled.append(variable)
+            if variable.observed:
+                variables_observed.append(variable)
+                log_probs.append(variable._log_prob)
+                log_probs_observed.append(variable._log_prob)
+            elif variable.control:
+                log_probs.append(variable._log_prob)
+            elif not variable.tagged:
+                variables_uncontrolled.append(variable)
+            if variable.observable:
+                variables_observable.append(variable)
+            if variable.tagged:
+                variables_tagged.append(variable)
             if variable.log_importance_weight is not None:
                 if variable.replace:
-                    replaced_log_importance_weights[variable.address_base] = variable.log_importance_weight
+                    replaced_log_importance_weights[address_base] = variable.log_importance_weight
                 else:
-                    self.log_importance_weight += variable.log_importance_weight
-        for _, log_importance_weight in replaced_log_importance_weights.items():
-            self.log_importance_weight += log_importance_weight
+                    log_importance_weight += variable.log_importance_weight
+        for w in replaced_log_importance_weights.values():
+            log_importance_weight += w
+        self.variables_controlled = variables_controlled
+        self.variables_uncontrolled = variables_uncontrolled
+        self.variables_replaced = variables_replaced
+        self.variables_observed = variables_observed
+        self.variables_observable = variables_observable
+        self.variables_tagged = variables_tagged
+        self.named_variables = named_variables
+        self.log_prob = _sum_log_probs(log_probs)
+        self.log_prob_observed = _sum_log_probs(log_probs_observed)
+        self.log_importance_weight = self.log_importance_weight + log_importance_weight
+        self.length = len(self.variables)
+        self.length_controlled = len(variables_controlled)
+        # From the final variables_controlled, a replacing variable can have an address (e.g., instance) other than the one of the variable it replaces
+        self._type_id = _fingerprint([variable.address for variable in variables_controlled])
+
+    @property
+    def fingerprint(self):
+        # Structural fingerprint, a hash of the sequence of addresses of all variables, computed incrementally in add
+        if not hasattr(self, '_fingerprint'):
+            self._fingerprint = _fingerprint([variable.address for variable in self.variables])
+        return self._fingerprint
+
+    @property
+    def fingerprint_base(self):
+        # Same as fingerprint, with the address_base of the variables
+        if not hasattr(self, '_fingerprint_base'):
+            self._fingerprint_base = _fingerprint([variable.address_base for variable in self.variables])
+        return self._fingerprint_base
+
+    @property
+    def type_id(self):
+        # Hash of the sequence of addresses of the controlled variables, shared by traces of the same type for inference network training, computed in end
+        if getattr(self, '_type_id', None) is None:
+            self._type_id = _fingerprint([variable.address for variable in self.variables_controlled])
+        return self._type_id
+
+    @property
+    def columns(self):
+        # Built once, on first access after the trace is ended
+        if getattr(self, '_columns', None) is None:
+            self._columns = TraceColumns(self.variables_controlled)
+        return self._columns
+
+    def retain(self, retention, addresses=None):
+        # Returns a trace with the variables kept by the retention policy (see util.TraceRetention), with the log_prob, log_importance_weight and length of this trace
+        if retention == util.TraceRetention.ALL:
+            return self
+        if retention == util.TraceRetention.VALUES:
+            variables = [variable.copy(distribution=False) for variable in self.variables]
+        elif retention == util.TraceRetention.NAMED_VARIABLES:
+            variables = [variable.copy() for variable in self.variables if variable.name is not None]
+        elif retention == util.TraceRetention.ADDRESSES:
+            if addresses is None:
+                raise ValueError('Expecting addresses to retain.')
+            addresses = set(addresses)
+            variables = [variable.copy() for variable in self.variables if variable.address in addresses or variable.address_base in addresses]
+        else:
+            raise ValueError('Unknown trace retention: {}'.format(retention))
+        trace = Trace()
+        for variable in variables:
+            trace.add(variable)
+        trace.end(self.result, self.execution_time_sec)
+        trace.log_prob = self.log_prob
+        trace.log_prob_observed = self.log_prob_observed
+        trace.log_importance_weight = self.log_importance_weight
+        trace.length = self.length
+        return trace
+
+    def unbatch(self, batch_size, result, execution_time_sec):
+        # Splits a trace recorded in particle-batched execution into batch_size traces, one per particle, and ends them
+        # The variables of the resulting traces share the (batched) distributions of the variables of this trace
+        traces = []
+        for i in range(batch_size):
+            trace = Trace()
+            for variable in self.variables:
+                trace.add(Variable(distribution=variable.distribution, value=_particle_value(variable.value, i, batch_size), address_base=variable.address_base, address=variable.address, instance=variable.instance, log_prob=_particle_value(variable.log_prob, i, batch_size), log_importance_weight=_particle_value(variable.log_importance_weight, i, batch_size), control=variable.control, replace=variable.replace, name=variable.name, observed=variable.observed, reused=variable.reused, tagged=variable.tagged))
+            trace.end(_particle_value(result, i, batch_size), execution_time_sec / batch_size)
+            traces.append(trace)
+        return traces
 
     def last_instance(self, address_base):
         if address_base in self.variables_dict_address_base:
@@ -134,6 +517,14 @@ class Trace():
         else:
             return 0
 
+    def __getstate__(self):
+        # Pickled as a dictionary of attributes, the format of traces saved before Trace had __slots__
+        return {slot: getattr(self, slot) for slot in _slots(type(self)) if slot != '_columns' and hasattr(self, slot)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def to(self, device):
         for variable in self.variables:
             variable.to(device)
@@ -146,6 +537,45 @@ class Trace():
         return hash(self) == hash(other)
 
 
+class LeanTrace(Trace):
+    # Trace that only keeps the variables needed by its consumer (see util.TraceRecording), while the instances of addresses and the log_importance_weight account for all variables
+    __slots__ = ('recording', '_instances', '_num_variables', '_log_importance_weight_sum', '_replaced_log_importance_weights')
+
+    def __init__(self, recording):
+        super().__init__()
+        self.recording = recording
+        self._instances = {}
+        self._num_variables = 0
+        self._log_importance_weight_sum = 0.
+        self._replaced_log_importance_weights = {}
+
+    def add(self, variable):
+        self._instances[variable.address_base] = variable.instance
+        self._num_variables += 1
+        if variable.log_importance_weight is not None:
+            if variable.replace:
+                self._replaced_log_importance_weights[variable.address_base] = variable.log_importance_weight
+            else:
+                self._log_importance_weight_sum += variable.log_importance_weight
+        if self.recording == util.TraceRecording.INFERENCE_NETWORK and (variable.control or variable.name is not None):
+            super().add(variable)
+
+    def last_instance(self, address_base):
+        return self._instances.get(address_base, 0)
+
+    def end(self, result, execution_time_sec):
+        super().end(result, execution_time_sec)
+        log_importance_weight = self._log_importance_weight_sum
+        for w in self._replaced_log_importance_weights.values():
+            log_importance_weight += w
+        self.log_importance_weight = log_importance_weight
+        self.length = self._num_variables
+        del self._instances
+        del self._num_variables
+        del self._log_importance_weight_sum
+        del self._replaced_log_importance_weights
+
+
 class HDFLogger():
 
     def __init__(self, path, name, logging_struct, T_per_file=500000):
@@ -250,137 +680,390 @@ class HDFLogger():
         return
 
 
+def _identity(data):
+    return bytes(data)
+
+
+_trace_hash_codecs = {}
+
+
+def register_trace_hash_codec(name, compress, decompress):
+    # compress and decompress are functions from bytes to bytes
+    _trace_hash_codecs[name] = (compress, decompress)
+
+
+register_trace_hash_codec('none', _identity, _identity)
+register_trace_hash_codec('zlib', zlib.compress, zlib.decompress)
+register_trace_hash_codec('bz2', bz2.compress, bz2.decompress)
+register_trace_hash_codec('lzma', lzma.compress, lzma.decompress)
+try:
+    import blosc
+    register_trace_hash_codec('blosc', blosc.compress, blosc.decompress)
+except ImportError:
+    pass
+
+
+class _TraceHashPickler(pickle.Pickler):
+    def __init__(self, file, address_ids):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._address_ids = address_ids
+
+    def persistent_id(self, obj):
+        if type(obj) is str:
+            return self._address_ids.get(obj)
+        return None
+
+
+class _TraceHashUnpickler(pickle.Unpickler):
+    def __init__(self, file, addresses):
+        super().__init__(file)
+        self._addresses = addresses
+
+    def persistent_load(self, pid):
+        return self._addresses[pid]
+
+
 class TraceHash():
     """
-    This storage class is designed for situations where the amount of trace data produced during a
-    single forward() call is too large to be stored in RAM without compression.
+    This storage class is designed for situations where the amount of trace data produced is too large
+    to be stored in RAM without compression.
 
     TraceHash uses a 2-stage compression process:
 
+        First, each trace is hashed: every address and address_base in the trace is replaced by an integer
+        from a dictionary of addresses that is built and updated online, so that each address string is
+        stored once per TraceHash instead of once per variable of every trace.
 
-        First, each trace is hashed using a nested approach. Associative access is preserved.
-        For EMOD, this alone yields a factor 22 memory compression with very little overhead.
-        To do this: A dictionary over function names is built and updated online.
-                    Each trace added is decomposed into individual function names and each function name is replaced by the
-                    corresponding counter from the dictionary.
-            Set :trace_hash_byte_len: to determine how many bytes
-                (2 is fine for EMOD, you probably never need more than 4 even for very large code
-                bases)
+        Secondly, each hashed trace is compressed with a codec.
+            Set :codec: to 'zlib', 'bz2', 'lzma', 'none', or 'blosc' if the blosc package is installed.
+                Other codecs can be added with register_trace_hash_codec.
+            Set :file_name: to determine the path under which compressed traces are spilled to disk. If set to <None>,
+                compressed traces stay in RAM.
+                NOTE: Compressed traces are kept in chunks of :chunk_size: bytes, a chunk is written to disk when full.
 
-        Secondly, each hashed trace is compressed using a general purpose compression algorithm.
-            Set :compression_mode: to "blosc"
-            Set :file_path: to determine the path under which the trace file is stored. If set to <None>,
-                traces are not stored on disk but stay in RAM.
-                NOTE: The traces generated are written to disk in chunks determined by :chunk_size: (byte)
+    Traces are accessed by key, with trace_hash[key] returning a Trace. add returns a HashedTrace, a Trace handle that
+    decompresses the trace on access and can be stored in place of the trace, e.g., in an Empirical.
+    A HashedTrace is pickled (e.g., into a file-backed Empirical) as the trace compressed with the codec, without
+    the dictionary of addresses, and it is unpickled as a Trace.
 
+    The TraceHash lives as long as the HashedTraces referring to it, and close is called, removing the file under
+    :file_name:, when it is garbage collected.
     """
-    def __init__(self, file_name):
-        self.variables = []
-        self.variables_controlled = []
-        self.variables_uncontrolled = []
-        self.variables_replaced = []
-        self.variables_observed = []
-        self.variables_observable = []
-        self.variables_tagged = []
-        self.variables_dict_address = {}
-        self.variables_dict_address_base = {}
-        self.named_variables = {}
-        self.result = None
-        self.log_prob = 0.
-        self.log_prob_observed = 0.
-        self.log_importance_weight = 0.
-        self.length = 0
-        self.length_controlled = 0
-        self.execution_time_sec = None
+    def __init__(self, file_name=None, codec='zlib', chunk_size=4 * 2**20):
+        if codec not in _trace_hash_codecs:
+            raise ValueError('Unknown codec: {}, expecting one of: {}'.format(codec, ', '.join(_trace_hash_codecs.keys())))
+        self._codec = codec
+        self._compress, self._decompress = _trace_hash_codecs[codec]
+        self._chunk_size = chunk_size
+        self._file_name = file_name
+        self._file = None
+        if file_name is not None:
+            self._file = open(file_name, 'w+b')
+        self._lock = threading.Lock()
+        self._address_ids = {}
+        self._addresses = []
+        self._index = {}
+        self._chunks = []  # Full chunks in memory or, with file_name, their positions in the file
+        self._chunk = bytearray()
+        self._hashed_bytes = 0
+        self._compressed_bytes = 0
+        self._last_key = None
+        self._last_trace = None
+        self._last_added_trace = None
+        self._last_added = None
 
-        self.trace_hash_byte_len = 1 # fixed for now
-        self.funcname_lookup = {} # contains the lookup table for the function names
-        self.file_name = file_name
-
-    def _hash_funcname(self, variable):
-        base, app = variable.address[1:].split("]")
-        _tmp = app.split("__")
-        base2 = "__".join(_tmp[:-1])
-        new_address_base = _tmp[-1]
-        base = base.split("; ") + [base2]
-        new_address = b""
-        for b in base:
-            if b not in self.funcname_lookup:
-                self.funcname_lookup[b] = (len(self.funcname_lookup) + 1).to_bytes(self.trace_hash_byte_len, "little") # avoid 0 as key
-            new_address += self.funcname_lookup[b]
-        return new_address, new_address_base
+    def __len__(self):
+        return len(self._index)
 
-    def __repr__(self):
-        return 'Trace(all:{:,}, controlled:{:,}, replaced:{:,}, observeable:{:,}, observed:{:,}, tagged:{:,}, uncontrolled:{:,}, log_prob:{}, log_importance_weight:{})'.format(
-            len(self.variables),
-            len(self.variables_controlled),
-            len(self.variables_replaced),
-            len(self.variables_observable),
-            len(self.variables_observed),
-            len(self.variables_tagged),
-            len(self.variables_uncontrolled),
-            str(self.log_prob),
-            str(self.log_importance_weight))
+    def __contains__(self, key):
+        return key in self._index
 
-    def add(self, variable):
-        new_address, new_address_base = self._hash_funcname(variable)
-        variable.address = new_address + bytes((new_address_base).encode("ascii"))
-        variable.address_base = new_address
-        variable.hash_funcname = self._hash_funcname
-        self.variables.append(variable)
-        self.variables_dict_address[variable.address] = variable
-        self.variables_dict_address_base[variable.address_base] = variable
+    def __iter__(self):
+        return iter(self._index)
 
-    def end(self, result, execution_time_sec):
-        self.result = result
-        self.execution_time_sec = execution_time_sec
-        replaced_indices = []
-        for i in range(len(self.variables)):
-            variable = self.variables[i]
-            if variable.name is not None:
-                self.named_variables[variable.name] = variable
-            if variable.control and i not in replaced_indices:
-                if variable.replace:
-                    for j in range(i + 1, len(self.variables)):
-                        if self.variables[j].address_base == variable.address_base:
-                            self.variables_replaced.append(variable)
-                            variable = self.variables[j]
-                            replaced_indices.append(j)
-                self.variables_controlled.append(variable)
-        self.variables_uncontrolled = [v for v in self.variables if (not v.control) and (not v.observed) and (not v.tagged)]
-        self.variables_observed = [v for v in self.variables if v.observed]
-        self.variables_observable = [v for v in self.variables if v.observable]
-        self.variables_tagged = [v for v in self.variables if v.tagged]
-        self.log_prob = sum([torch.sum(v.log_prob) for v in self.variables if v.control or v.observed])
-        self.log_prob_observed = sum([torch.sum(v.log_prob) for v in self.variables_observed])
-        self.length = len(self.variables)
-        self.length_controlled = len(self.variables_controlled)
-        replaced_log_importance_weights = {}
-        for variable in self.variables:
-            if variable.log_importance_weight is not None:
-                if variable.replace:
-                    replaced_log_importance_weights[variable.address_base] = variable.log_importance_weight
-                else:
-                    self.log_importance_weight += variable.log_importance_weight
-        for _, log_importance_weight in replaced_log_importance_weights.items():
-            self.log_importance_weight += log_importance_weight
+    def keys(self):
+        return self._index.keys()
 
-    def last_instance(self, address_base):
-        if address_base in self.variables_dict_address_base:
-            return self.variables_dict_address_base[address_base].instance
+    def _hash_address(self, address):
+        if address is not None and address not in self._address_ids:
+            self._address_ids[address] = len(self._addresses)
+            self._addresses.append(address)
+
+    def add(self, trace, key=None):
+        with self._lock:
+            if trace is self._last_added_trace and key is None:
+                # E.g., the same trace added again after a rejected Metropolis Hastings proposal
+                return self._last_added
+            if key is None:
+                key = len(self._index)
+            for variable in trace.variables:
+                self._hash_address(variable.address_base)
+                self._hash_address(variable.address)
+            data = io.BytesIO()
+            _TraceHashPickler(data, self._address_ids).dump(trace)
+            data = data.getvalue()
+            compressed = self._compress(data)
+            self._hashed_bytes += len(data)
+            self._compressed_bytes += len(compressed)
+            self._index[key] = (len(self._chunks), len(self._chunk), len(compressed))
+            self._chunk += compressed
+            if len(self._chunk) >= self._chunk_size:
+                self._flush_chunk()
+            self._last_added_trace = trace
+            self._last_added = HashedTrace(self, key)
+            # E.g., for pickling the trace just added into a file-backed Empirical
+            self._last_key = key
+            self._last_trace = trace
+            return self._last_added
+
+    def _flush_chunk(self):
+        if self._file is None:
+            self._chunks.append(bytes(self._chunk))
         else:
-            return 0
+            self._file.seek(0, os.SEEK_END)
+            self._chunks.append(self._file.tell())
+            self._file.write(self._chunk)
+        self._chunk = bytearray()
 
-    def to(self, device):
-        for variable in self.variables:
-            variable.to(device)
+    def _read(self, chunk, offset, length):
+        if chunk == len(self._chunks):
+            return bytes(self._chunk[offset:offset + length])
+        elif self._file is None:
+            return self._chunks[chunk][offset:offset + length]
+        else:
+            self._file.seek(self._chunks[chunk] + offset)
+            return self._file.read(length)
 
-    def __hash__(self):
-        h = [hash(variable) for variable in self.variables]
-        return hash(sum(h))
+    def __getitem__(self, key):
+        with self._lock:
+            if key == self._last_key:
+                return self._last_trace
+            compressed = self._read(*self._index[key])
+            trace = _TraceHashUnpickler(io.BytesIO(self._decompress(compressed)), self._addresses).load()
+            self._last_key = key
+            self._last_trace = trace
+            return trace
+
+    def compressed(self, key):
+        # The trace compressed with the codec, without the dictionary of addresses, see _load_compressed_trace
+        trace = self[key]
+        return self._codec, self._compress(pickle.dumps(trace, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def stats(self):
+        return {'traces': len(self._index), 'addresses': len(self._addresses), 'codec': self._codec, 'hashed_bytes': self._hashed_bytes, 'compressed_bytes': self._compressed_bytes, 'compression_ratio': self._hashed_bytes / max(1, self._compressed_bytes)}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._file_name)
+
+    def __del__(self):
+        if getattr(self, '_file', None) is not None:
+            self.close()
+
+
+def _load_compressed_trace(codec, data):
+    # The codec has to be registered (see register_trace_hash_codec) in the process loading the trace
+    _, decompress = _trace_hash_codecs[codec]
+    return pickle.loads(decompress(data))
+
+
+class HashedTrace(Trace):
+    # Handle of a trace in a TraceHash, attributes not set on the handle are read from the trace decompressed on access
+    __slots__ = ('_trace_hash', '_key')
+
+    def __init__(self, trace_hash, key):
+        self._trace_hash = trace_hash
+        self._key = key
+
+    @property
+    def key(self):
+        return self._key
+
+    def get(self):
+        return self._trace_hash[self._key]
+
+    def __getattr__(self, name):
+        if name in ('_trace_hash', '_key'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return repr(self.get())
+
+    def __reduce_ex__(self, protocol):
+        # Pickled as the compressed trace, unpickled as a Trace
+        return (_load_compressed_trace, self._trace_hash.compressed(self._key))
+
+
+_TRACE_LIST_SLOTS = ('variables', 'variables_controlled', 'variables_uncontrolled', 'variables_replaced', 'variables_observed', 'variables_observable', 'variables_tagged')
+_TRACE_DICT_SLOTS = ('variables_dict_address', 'variables_dict_address_base', 'named_variables')
+# Variable attributes that are part of the skeleton of a trace, the others are packed per trace
+_VARIABLE_SKELETON_ATTRIBUTES = ('address_base', 'address', 'instance', 'name', '_flags', 'hash_funcname')
+_VARIABLE_PACKED_ATTRIBUTES = ('_value', '_log_prob', 'log_importance_weight', 'distribution')
+
+
+class TraceSkeletons():
+    # Skeletons shared by packed traces, a skeleton being the structure of a trace (its ordered variables with their addresses, distribution families and flags), stored once for all traces with the same structure
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._skeletons = []
+        self._ids = {}
+        self._last_packed = None
+        self._last_trace = None
+
+    def __len__(self):
+        return len(self._skeletons)
+
+    def __getitem__(self, skeleton_id):
+        return self._skeletons[skeleton_id]
+
+    def _id(self, skeleton):
+        with self._lock:
+            skeleton_id = self._ids.get(skeleton)
+            if skeleton_id is None:
+                skeleton_id = len(self._skeletons)
+                self._ids[skeleton] = skeleton_id
+                self._skeletons.append(skeleton)
+            return skeleton_id
+
+    def pack(self, trace):
+        if isinstance(trace, PackedTrace) and trace._skeletons is self:
+            return trace
+        if isinstance(trace, (PackedTrace, HashedTrace)):
+            trace = trace.get()
+        variables = []
+        variable_indices = {}
+
+        def index(variable):
+            i = variable_indices.get(id(variable))
+            if i is None:
+                i = len(variables)
+                variable_indices[id(variable)] = i
+                variables.append(variable)
+            return i
+
+        trace_skeleton = []
+        trace_data = []
+        for slot in _slots(type(trace)):
+            if slot == '_columns' or not hasattr(trace, slot):
+                continue
+            value = getattr(trace, slot)
+            if slot in _TRACE_LIST_SLOTS:
+                trace_skeleton.append((slot, tuple(index(variable) for variable in value)))
+            elif slot in _TRACE_DICT_SLOTS:
+                trace_skeleton.append((slot, tuple((key, index(variable)) for key, variable in value.items())))
+            else:
+                trace_skeleton.append((slot, None))
+                trace_data.append(value)
+        variables_skeleton = []
+        for variable in variables:
+            attributes = tuple((name, getattr(variable, name)) for name in _VARIABLE_SKELETON_ATTRIBUTES if hasattr(variable, name))
+            packed_attributes = tuple(name for name in _VARIABLE_PACKED_ATTRIBUTES if hasattr(variable, name))
+            distribution_type = None
+            for name in packed_attributes:
+                value = getattr(variable, name)
+                if name == 'distribution' and hasattr(value, '_constructor_parameters'):
+                    # Only the constructor parameters are packed, the distribution is rebuilt from them and its type in the skeleton
+                    parameters = value._constructor_parameters()
+                    if parameters is not None:
+                        distribution_type = type(value)
+                        value = parameters
+                trace_data.append(value)
+            variables_skeleton.append((attributes, packed_attributes, distribution_type))
+        skeleton = (type(trace), tuple(trace_skeleton), tuple(variables_skeleton))
+        return PackedTrace(self, self._id(skeleton), tuple(trace_data))
+
+    def unpack(self, record):
+        return PackedTrace(self, record.skeleton_id, record.data)
+
+    def get(self, packed):
+        # The last trace rebuilt is kept, attributes of a PackedTrace are typically read a few at a time
+        if packed is self._last_packed:
+            return self._last_trace
+        trace_class, trace_skeleton, variables_skeleton = self._skeletons[packed._skeleton_id]
+        data = iter(packed._data)
+        trace = trace_class.__new__(trace_class)
+        for slot, structure in trace_skeleton:
+            if structure is None:
+                setattr(trace, slot, next(data))
+        variables = []
+        for attributes, packed_attributes, distribution_type in variables_skeleton:
+            variable = Variable.__new__(Variable)
+            for name, value in attributes:
+                setattr(variable, name, value)
+            for name in packed_attributes:
+                value = next(data)
+                if name == 'distribution' and distribution_type is not None:
+                    value = distribution_type(*value)
+                setattr(variable, name, value)
+            variables.append(variable)
+        for slot, structure in trace_skeleton:
+            if slot in _TRACE_LIST_SLOTS:
+                setattr(trace, slot, [variables[i] for i in structure])
+            elif slot in _TRACE_DICT_SLOTS:
+                setattr(trace, slot, {key: variables[i] for key, i in structure})
+        self._last_packed = packed
+        self._last_trace = trace
+        return trace
+
+    def __getstate__(self):
+        return {'skeletons': self._skeletons}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._skeletons = state['skeletons']
+        self._ids = {skeleton: i for i, skeleton in enumerate(self._skeletons)}
+
+
+class PackedTraceRecord():
+    # Contents of a PackedTrace without its skeleton, for stores that save the TraceSkeletons once
+    __slots__ = ('skeleton_id', 'data')
+
+    def __init__(self, skeleton_id, data):
+        self.skeleton_id = skeleton_id
+        self.data = data
+
+    def __getstate__(self):
+        return (self.skeleton_id, self.data)
+
+    def __setstate__(self, state):
+        self.skeleton_id, self.data = state
+
+
+class PackedTrace(Trace):
+    # Trace stored as the id of its skeleton in a TraceSkeletons and its packed values, log_probs and distribution constructor parameters, attributes are read from the trace rebuilt on access
+    __slots__ = ('_skeletons', '_skeleton_id', '_data')
+
+    def __init__(self, skeletons, skeleton_id, data):
+        self._skeletons = skeletons
+        self._skeleton_id = skeleton_id
+        self._data = data
+
+    @property
+    def skeleton_id(self):
+        return self._skeleton_id
+
+    @property
+    def record(self):
+        return PackedTraceRecord(self._skeleton_id, self._data)
+
+    def get(self):
+        return self._skeletons.get(self)
+
+    def __getattr__(self, name):
+        if name in ('_skeletons', '_skeleton_id', '_data'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return repr(self.get())
+
+    def __reduce_ex__(self, protocol):
+        # Pickled as the trace itself
+        return self.get().__reduce_ex__(protocol)
 
-    def __eq__(self, other):
-        return hash(self) == hash(other)
 
 # import shelve
 #
@@ -43,6 +43,33 @@ class InferenceEngine(enum.Enum):
     IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK = 1  # Type: IS; Importance sampling with proposals from inference network
     LIGHTWEIGHT_METROPOLIS_HASTINGS = 2  # Type: MCMC; Lightweight (single-site) Metropolis Hastings sampling, http://proceedings.mlr.press/v15/wingate11a/wingate11a.pdf and https://arxiv.org/abs/1507.00996
     RANDOM_WALK_METROPOLIS_HASTINGS = 3  # Type: MCMC; Lightweight Metropolis Hastings with single-site proposal kernels that depend on the value of the site
+    SEQUENTIAL_MONTE_CARLO = 4  # Type: SMC; Sequential Monte Carlo with proposals from prior and resampling at observe sites, by re-execution with replay of the values sampled so far
+
+
+class TracePruning(enum.Enum):
+    DISABLED = 0
+    ZERO_WEIGHT = 1  # Traces pruned during importance sampling are recorded with zero weight
+    DISCARD = 2  # Traces pruned during importance sampling are discarded
+
+
+class TraceRecording(enum.Enum):
+    FULL = 0
+    INFERENCE_NETWORK = 1  # Only the controlled and named variables, for inference network training
+    RESULT_AND_WEIGHT = 2  # Only the result and the log_importance_weight, for posterior summaries
+
+
+class TraceRetention(enum.Enum):
+    ALL = 0
+    VALUES = 1  # All variables, without their distributions
+    NAMED_VARIABLES = 2  # Only the named variables
+    ADDRESSES = 3  # Only the variables at selected addresses or address_bases
+
+
+class Resampling(enum.Enum):
+    MULTINOMIAL = 0
+    SYSTEMATIC = 1  # One uniform offset shared by num_samples evenly spaced points
+    STRATIFIED = 2  # One uniform in each of num_samples equal strata
+    RESIDUAL = 3  # The integer part of each expected count, then multinomial resampling of the remainder
 
 
 class InferenceNetwork(enum.Enum):
@@ -394,3 +421,221 @@ def get_source(obj):
         return inspect.getsource(obj)
     except:
         return obj.__name__
+
+
+class LogWeightStatistics():
+    # Running statistics of a stream of log-weights, kept relative to the running maximum log-weight for numerical stability
+    def __init__(self):
+        self.length = 0
+        self.max = -math.inf
+        self._sum_weights = 0.
+        self._sum_weights_squared = 0.
+
+    def add(self, log_weight):
+        log_weight = float(log_weight)
+        self.length += 1
+        if log_weight == -math.inf or math.isnan(log_weight):
+            return
+        if log_weight > self.max:
+            scale = math.exp(self.max - log_weight)
+            self._sum_weights *= scale
+            self._sum_weights_squared *= scale * scale
+            self.max = log_weight
+        weight = math.exp(log_weight - self.max)
+        self._sum_weights += weight
+        self._sum_weights_squared += weight * weight
+
+    def update(self, statistics):
+        # Adds the log-weights of other statistics, e.g., of concatenated Empiricals
+        self.length += statistics.length
+        if statistics.max == -math.inf or math.isnan(statistics.max):
+            return
+        if statistics.max > self.max:
+            scale = math.exp(self.max - statistics.max)
+            self._sum_weights *= scale
+            self._sum_weights_squared *= scale * scale
+            self.max = statistics.max
+        scale = math.exp(statistics.max - self.max)
+        self._sum_weights += statistics._sum_weights * scale
+        self._sum_weights_squared += statistics._sum_weights_squared * scale * scale
+
+    @property
+    def effective_sample_size(self):
+        if self._sum_weights_squared == 0.:
+            return 0.
+        return self._sum_weights * self._sum_weights / self._sum_weights_squared
+
+    @property
+    def log_sum_weights(self):
+        if self._sum_weights == 0.:
+            return -math.inf
+        return self.max + math.log(self._sum_weights)
+
+    @property
+    def log_evidence(self):
+        # Log of the mean of the weights
+        if self.length == 0:
+            return -math.inf
+        return self.log_sum_weights - math.log(self.length)
+
+
+class WeightedRunningMoments():
+    # Running weighted mean and variance of a stream of values with log-weights (West, 1979), kept relative to the running maximum log-weight for numerical stability
+    def __init__(self, dtype=_dtype):
+        self.length = 0
+        self.max = -math.inf
+        self._dtype = dtype
+        self._sum_weights = 0.
+        self._mean = None
+        self._m2 = None
+
+    def add(self, value, log_weight=0.):
+        # Values with zero weight are counted in length and not read
+        log_weight = float(log_weight)
+        if log_weight == -math.inf or math.isnan(log_weight):
+            self.length += 1
+            return
+        value = to_tensor(value, dtype=self._dtype)
+        if self._mean is not None and value.shape != self._mean.shape:
+            raise ValueError('Expecting values of shape {}, received: {}'.format(self._mean.shape, value.shape))
+        self.length += 1
+        if log_weight > self.max:
+            scale = math.exp(self.max - log_weight)
+            self._sum_weights *= scale
+            if self._m2 is not None:
+                self._m2 = self._m2 * scale
+            self.max = log_weight
+        weight = math.exp(log_weight - self.max)
+        self._sum_weights += weight
+        if self._mean is None:
+            self._mean = value.clone()
+            self._m2 = torch.zeros_like(value)
+        else:
+            delta = value - self._mean
+            self._mean = self._mean + (weight / self._sum_weights) * delta
+            self._m2 = self._m2 + weight * delta * (value - self._mean)
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            raise RuntimeError('No values with nonzero weight.')
+        return self._mean
+
+    @property
+    def variance(self):
+        if self._m2 is None:
+            raise RuntimeError('No values with nonzero weight.')
+        return self._m2 / self._sum_weights
+
+    @property
+    def stddev(self):
+        return self.variance.sqrt()
+
+
+class WeightedQuantileSketch():
+    # Approximate quantiles of a stream of scalar values with log-weights, a merging t-digest (Dunning and Ertl, 2019) with the weights kept relative to the running maximum log-weight for numerical stability
+    # The minimum and maximum of the values with nonzero weight are exact
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.length = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._max_log_weight = -math.inf
+        self._centroids = []  # (mean, weight) pairs sorted by mean
+        self._buffer = []
+
+    def add(self, value, log_weight=0.):
+        # Values with zero weight are counted in length and not read
+        log_weight = float(log_weight)
+        self.length += 1
+        if log_weight == -math.inf or math.isnan(log_weight):
+            return
+        value = float(value)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if log_weight > self._max_log_weight:
+            scale = math.exp(self._max_log_weight - log_weight)
+            self._centroids = [(mean, weight * scale) for mean, weight in self._centroids]
+            self._buffer = [(mean, weight * scale) for mean, weight in self._buffer]
+            self._max_log_weight = log_weight
+        self._buffer.append((value, math.exp(log_weight - self._max_log_weight)))
+        if len(self._buffer) >= 5 * self.compression:
+            self._merge()
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        return (math.sin(min(k, self.compression / 4) * 2 * math.pi / self.compression) + 1) / 2
+
+    def _merge(self):
+        points = sorted(self._centroids + self._buffer)
+        self._buffer = []
+        if len(points) == 0:
+            return
+        total_weight = sum(weight for _, weight in points)
+        centroids = []
+        mean, weight = points[0]
+        weight_before = 0.
+        q_limit = self._q(self._k(0.) + 1)
+        for point_mean, point_weight in points[1:]:
+            if (weight_before + weight + point_weight) / total_weight <= q_limit:
+                weight += point_weight
+                mean += (point_mean - mean) * point_weight / weight
+            else:
+                centroids.append((mean, weight))
+                weight_before += weight
+                q_limit = self._q(self._k(weight_before / total_weight) + 1)
+                mean, weight = point_mean, point_weight
+        centroids.append((mean, weight))
+        self._centroids = centroids
+
+    def quantile(self, q):
+        self._merge()
+        centroids = [(mean, weight) for mean, weight in self._centroids if weight > 0.]
+        if len(centroids) == 0:
+            raise RuntimeError('No values with nonzero weight.')
+        if len(centroids) == 1:
+            return centroids[0][0]
+        # Interpolates between the centers of centroids, and between the extreme centroids and the minimum and maximum values
+        target = q * sum(weight for _, weight in centroids)
+        weight_before = 0.
+        previous_mean, previous_center = self.min, 0.
+        for mean, weight in centroids:
+            center = weight_before + weight / 2
+            if target < center:
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+            previous_mean, previous_center = mean, center
+            weight_before += weight
+        if weight_before == previous_center:
+            return self.max
+        return previous_mean + (self.max - previous_mean) * (target - previous_center) / (weight_before - previous_center)
+
+
+def resample_indices(weights, num_samples, resampling=Resampling.MULTINOMIAL):
+    # Draws num_samples indices in proportion to the (not necessarily normalized) weights in one vectorized pass, returned in ascending order
+    weights = to_numpy(weights).astype(np.float64).reshape(-1)
+    sum_weights = weights.sum()
+    if not sum_weights > 0.:
+        raise ValueError('Expecting weights with a positive and finite sum.')
+    if resampling == Resampling.RESIDUAL:
+        expected_counts = weights * (num_samples / sum_weights)
+        counts = np.floor(expected_counts).astype(np.int64)
+        num_residual = num_samples - int(counts.sum())
+        if num_residual > 0:
+            counts += np.bincount(resample_indices(expected_counts - counts, num_residual, Resampling.MULTINOMIAL), minlength=len(weights))
+        return np.repeat(np.arange(len(weights)), counts)
+    if resampling == Resampling.MULTINOMIAL:
+        # Sorted uniforms from the normalized partial sums of exponentials, no sort needed
+        uniforms = np.cumsum(np.random.exponential(size=num_samples + 1))
+        uniforms = uniforms[:-1] / uniforms[-1]
+    elif resampling == Resampling.SYSTEMATIC:
+        uniforms = (np.random.uniform() + np.arange(num_samples)) / num_samples
+    elif resampling == Resampling.STRATIFIED:
+        uniforms = (np.random.uniform(size=num_samples) + np.arange(num_samples)) / num_samples
+    else:
+        raise ValueError('Unknown resampling: {}'.format(resampling))
+    cumulative_weights = np.cumsum(weights / sum_weights)
+    return np.minimum(np.searchsorted(cumulative_weights, uniforms, side='right'), len(weights) - 1)
@@ -0,0 +1,54 @@
+import torch
+import time
+import pickle
+
+import pyprob
+from pyprob import Model
+from pyprob.trace import TraceHash, _trace_hash_codecs
+from pyprob.distributions import Normal, Uniform
+
+
+class BranchingModel(Model):
+    def __init__(self, num_steps=500, *args, **kwargs):
+        self.num_steps = num_steps
+        super().__init__('Branching model', *args, **kwargs)
+
+    def step(self, x):
+        if float(pyprob.sample(Uniform(0, 1))) < 0.5:
+            return x + pyprob.sample(Normal(0, 1))
+        else:
+            return x - pyprob.sample(Normal(1, 2))
+
+    def forward(self):
+        x = pyprob.sample(Normal(0, 1))
+        for i in range(self.num_steps):
+            x = self.step(x)
+        pyprob.observe(Normal(x, 1), 0., name='obs')
+        return x
+
+
+def benchmark(num_traces=200, num_steps=500):
+    model = BranchingModel(num_steps=num_steps)
+    traces = model.prior_traces(num_traces).get_values()
+    pickle_bytes = sum(len(pickle.dumps(trace)) for trace in traces)
+    print('Traces: {:,}, variables per trace: {:,}, pickle: {:,} bytes per trace'.format(num_traces, traces[0].length, pickle_bytes // num_traces))
+    print('Codec\tBytes per trace\tRatio to pickle\tAdd (ms/trace)\tGet (ms/trace)')
+    for codec in _trace_hash_codecs:
+        trace_hash = TraceHash(codec=codec)
+        time_start = time.time()
+        for trace in traces:
+            trace_hash.add(trace)
+        time_add = (time.time() - time_start) / num_traces
+        time_start = time.time()
+        for i in range(num_traces):
+            trace_hash[i]
+        time_get = (time.time() - time_start) / num_traces
+        stats = trace_hash.stats()
+        print('{}\t{:,}\t{:.2f}\t{:.3f}\t{:.3f}'.format(codec, stats['compressed_bytes'] // num_traces, pickle_bytes / stats['compressed_bytes'], 1000 * time_add, 1000 * time_get))
+        trace_hash.close()
+
+
+if __name__ == '__main__':
+    pyprob.set_random_seed(1)
+    torch.set_num_threads(1)
+    benchmark()
@@ -8,7 +8,7 @@ import tempfile
 
 import pyprob
 from pyprob import util
-from pyprob.distributions import Empirical, Normal, Categorical, Uniform, Poisson, Beta, Mixture, TruncatedNormal
+from pyprob.distributions import Empirical, EmpiricalStorage, Normal, Categorical, Uniform, Poisson, Beta, Mixture, TruncatedNormal
 
 
 empirical_samples = 20000
@@ -171,6 +171,141 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.1))
         self.assertEqual(dist_empirical_length, dist_empirical_length_correct)
 
+    def test_dist_empirical_moments_vectorized(self):
+        values = [torch.randn(3) for i in range(100)]
+        log_weights = torch.randn(100)
+        probs = torch.softmax(log_weights.double(), dim=0)
+        dist_mean_correct = util.to_numpy(sum(probs[i] * values[i].double() for i in range(100)))
+        dist_variance_correct = util.to_numpy(sum(probs[i] * (values[i].double() - util.to_tensor(dist_mean_correct, dtype=torch.float64))**2 for i in range(100)))
+        dist_expectation_correct = float(sum(probs[i] * values[i].double().sum() for i in range(100)))
+
+        dist = Empirical(values=values, log_weights=log_weights)
+        dist_mean = util.to_numpy(dist.mean)
+        dist_variance = util.to_numpy(dist.variance)
+        dist_stacked_shape = list(dist._stacked_values().shape)
+        dist_stacked_shape_correct = [100, 3]
+        dist_expectation = float(dist.expectation(lambda x: x.sum()))
+        dist_dict = Empirical(values=[{'x': v} for v in values], log_weights=log_weights)
+        dist_dict_expectation = float(dist_dict.expectation(lambda x: x['x'].sum()))
+        dist_dict_stacked = dist_dict._stacked_values()
+
+        util.eval_print('dist_mean', 'dist_mean_correct', 'dist_variance', 'dist_variance_correct', 'dist_stacked_shape', 'dist_stacked_shape_correct', 'dist_expectation', 'dist_expectation_correct', 'dist_dict_expectation')
+
+        self.assertTrue(np.allclose(dist_mean, dist_mean_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_variance, dist_variance_correct, atol=1e-5))
+        self.assertEqual(dist_stacked_shape, dist_stacked_shape_correct)
+        self.assertAlmostEqual(dist_expectation, dist_expectation_correct, places=4)
+        self.assertAlmostEqual(dist_dict_expectation, dist_expectation_correct, places=4)
+        self.assertIsNone(dist_dict_stacked)
+
+    def test_dist_empirical_expectation_chunks(self):
+        values = [torch.randn(3) for i in range(100)]
+        log_weights = torch.randn(100)
+        log_weights[10] = -math.inf
+        probs = torch.softmax(log_weights.double(), dim=0)
+        dist_expectation_correct = util.to_numpy(sum(probs[i] * values[i].double() for i in range(100) if i != 10))
+
+        dist = Empirical(values=values, log_weights=log_weights)
+        dist._expectation_chunk_size = 7
+        dist_expectation = util.to_numpy(dist.expectation(lambda x: x))
+        dist_dict = Empirical(values=[{'x': v} for v in values], log_weights=log_weights)
+        dist_dict._expectation_chunk_size = 7
+        dist_dict_expectation = util.to_numpy(dist_dict.expectation(lambda x: x['x'] if x['x'][0] > 0 else x['x'].view(1, 3)))
+
+        util.eval_print('dist_expectation', 'dist_expectation_correct', 'dist_dict_expectation')
+
+        self.assertTrue(np.allclose(dist_expectation, dist_expectation_correct, atol=1e-5))
+        self.assertTrue(np.allclose(dist_dict_expectation, dist_expectation_correct, atol=1e-5))
+
+    def test_dist_empirical_weights(self):
+        log_weights = [float(w) for w in torch.randn(1000)]
+        dist = Empirical(values=list(range(1000)), log_weights=log_weights)
+        dist_categorical_built = dist._categorical_cache is not None
+        dist_ess = float(dist.effective_sample_size)
+        dist_ess_correct = float(1. / torch.distributions.Categorical(logits=util.to_tensor(log_weights, dtype=torch.float64)).probs.pow(2).sum())
+        dist_log_weights = list(dist._log_weights)
+        dist_log_weights_correct = log_weights
+        dist_uniform_weights = dist._uniform_weights
+        dist_uniform = Empirical(values=list(range(1000)))
+        dist_uniform_uniform_weights = dist_uniform._uniform_weights
+
+        util.eval_print('dist_categorical_built', 'dist_ess', 'dist_ess_correct', 'dist_uniform_weights', 'dist_uniform_uniform_weights')
+
+        self.assertFalse(dist_categorical_built)
+        self.assertAlmostEqual(dist_ess, dist_ess_correct, places=6)
+        self.assertEqual(dist_log_weights, dist_log_weights_correct)
+        self.assertFalse(dist_uniform_weights)
+        self.assertTrue(dist_uniform_uniform_weights)
+
+    def test_dist_empirical_streaming_statistics(self):
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+        values = [float(v) for v in torch.randn(2000)]
+        log_weights = [float(w) for w in torch.randn(2000)]
+        dist_exact = Empirical(values=values, log_weights=log_weights)
+        dist_mean_correct = float(dist_exact.mean)
+        dist_variance_correct = float(dist_exact.variance)
+        dist_ess_correct = float(dist_exact.effective_sample_size)
+        dist_min_correct = min(values)
+        dist_max_correct = max(values)
+        dist_median_correct = dist_exact.quantile(0.5)
+
+        dist = Empirical(file_name=file_name, streaming_statistics=True)
+        dist.add_sequence(values, log_weights=log_weights)
+        dist.finalize()
+        dist.close()
+        dist = Empirical(file_name=file_name, file_read_only=True)
+        dist_streaming = dist._streaming_moments() is not None and dist._streaming_quantile_sketch() is not None
+        dist_mean = float(dist.mean)
+        dist_variance = float(dist.variance)
+        dist_ess = float(dist.effective_sample_size)
+        dist_min = dist.min
+        dist_max = dist.max
+        dist_median = dist.quantile(0.5)
+        dist_stacked = dist._stacked_values_cache
+        dist_non_numeric = Empirical(values=['a', 'b'], streaming_statistics=True)
+        dist_non_numeric_streaming = dist_non_numeric._running_moments
+
+        util.eval_print('dist_streaming', 'dist_mean', 'dist_mean_correct', 'dist_variance', 'dist_variance_correct', 'dist_ess', 'dist_ess_correct', 'dist_min', 'dist_min_correct', 'dist_max', 'dist_max_correct', 'dist_median', 'dist_median_correct')
+
+        self.assertTrue(dist_streaming)
+        self.assertIsNone(dist_stacked)
+        self.assertAlmostEqual(dist_mean, dist_mean_correct, places=5)
+        self.assertAlmostEqual(dist_variance, dist_variance_correct, places=5)
+        self.assertAlmostEqual(dist_ess, dist_ess_correct, places=3)
+        self.assertEqual(dist_min, dist_min_correct)
+        self.assertEqual(dist_max, dist_max_correct)
+        self.assertAlmostEqual(dist_median, dist_median_correct, delta=0.1)
+        self.assertIsNone(dist_non_numeric_streaming)
+
+    def test_dist_empirical_record_log(self):
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+        values = [1., 2., 3., 4.]
+        log_weights = [-1., -2., -3., -4.]
+        dist_length_correct = 8
+        dist_mean_correct = float(Empirical(values=values * 2, log_weights=log_weights * 2).mean)
+
+        dist_on_file = Empirical(values=values, log_weights=log_weights, file_name=file_name, file_storage=EmpiricalStorage.RECORD_LOG)
+        dist_on_file.close()
+        dist_on_file_2 = Empirical(file_name=file_name, file_sync_timeout=3)
+        dist_on_file_2.add_sequence(values, log_weights=log_weights)
+        dist_on_file_2.finalize()
+        dist = Empirical(file_name=file_name, file_read_only=True)
+        dist_length = dist.length
+        dist_values = [float(v) for v in dist.get_values()]
+        dist_values_correct = values * 2
+        dist_log_weights = [float(w) for w in dist._log_weights]
+        dist_log_weights_correct = log_weights * 2
+        dist_mean = float(dist.mean)
+        dist_on_file_2.close()
+
+        util.eval_print('file_name', 'dist_length', 'dist_length_correct', 'dist_values', 'dist_values_correct', 'dist_log_weights', 'dist_log_weights_correct', 'dist_mean', 'dist_mean_correct')
+
+        self.assertEqual(dist._file_storage, EmpiricalStorage.RECORD_LOG)
+        self.assertEqual(dist_length, dist_length_correct)
+        self.assertEqual(dist_values, dist_values_correct)
+        self.assertEqual(dist_log_weights, dist_log_weights_correct)
+        self.assertAlmostEqual(dist_mean, dist_mean_correct, places=5)
+
     def test_dist_empirical_combine_duplicates(self):
         values = [1, 2, 2, 3, 3, 3]
         values_combined_correct = [1, 2, 3]
@@ -229,6 +364,36 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertTrue(np.allclose(dist_means_empirical, dist_means_correct, atol=0.25))
         self.assertTrue(np.allclose(dist_stddevs_empirical, dist_stddevs_correct, atol=0.25))
 
+    def test_dist_empirical_resample_indices(self):
+        values = [1., 2., 3., 4.]
+        log_weights = [math.log(0.1), -math.inf, math.log(0.5), math.log(0.4)]
+        dist_mean_correct = 0.1 * 1. + 0.5 * 3. + 0.4 * 4.
+
+        dist = Empirical(values, log_weights=log_weights)
+        for resampling in pyprob.Resampling:
+            dist_indices = dist.resample_indices(10000, resampling).tolist()
+            dist_resampled = dist.resample(10000, resampling=resampling)
+            dist_resampled_mean = float(dist_resampled.mean)
+
+            util.eval_print('resampling', 'dist_resampled_mean', 'dist_mean_correct')
+
+            self.assertEqual(dist_indices, sorted(dist_indices))
+            self.assertNotIn(1, dist_indices)
+            self.assertEqual(dist_resampled.length, 10000)
+            self.assertAlmostEqual(dist_resampled_mean, dist_mean_correct, delta=0.1)
+
+    def test_dist_empirical_resample_empty(self):
+        dist = Empirical([1., 2., 3., 4.])
+        dist_empty = Empirical()
+        dist_empty.finalize()
+
+        with self.assertRaisesRegex(ValueError, 'Empirical is empty'):
+            dist.resample_indices(10, min_index=2, max_index=2)
+        with self.assertRaisesRegex(ValueError, 'Empirical is empty'):
+            dist.resample(10, min_index=3, max_index=1)
+        with self.assertRaisesRegex(ValueError, 'Empirical is empty'):
+            dist_empty.resample(10)
+
     def test_dist_empirical_thin(self):
         values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
         dist_thinned_values_correct = [1, 4, 7, 10]
@@ -514,6 +679,52 @@ class DistributionsTestCase(unittest.TestCase):
         self.assertAlmostEqual(concat_emp_stddev, stddev_correct, places=1)
         self.assertAlmostEqual(concat_emp_ess, ess_correct, places=1)
 
+    def test_dist_empirical_concat_weights_not_copied(self):
+        values_correct = [0., 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        log_weights_correct = [-10, -15, -200, -2, -3, -22, -100, 1, 2, -0.3]
+        ess_correct = float(Empirical(values=values_correct, log_weights=log_weights_correct).effective_sample_size)
+
+        empiricals = [Empirical(values=values_correct[i:i + 5], log_weights=log_weights_correct[i:i + 5]) for i in [0, 5]]
+        concat_emp = Empirical(concat_empiricals=empiricals)
+        concat_emp_ess = float(concat_emp.effective_sample_size)
+        concat_emp_log_weights = [float(concat_emp._log_weights[i]) for i in range(10)]
+        weights_copied = concat_emp._log_weights._values is not None
+        concat_emp_log_weights_values = concat_emp._log_weights.values.tolist()
+
+        util.eval_print('concat_emp_ess', 'ess_correct', 'concat_emp_log_weights', 'log_weights_correct', 'weights_copied')
+
+        self.assertAlmostEqual(concat_emp_ess, ess_correct, places=5)
+        self.assertEqual(concat_emp_log_weights, log_weights_correct)
+        self.assertEqual(concat_emp_log_weights_values, log_weights_correct)
+        self.assertFalse(weights_copied)
+
+    def test_dist_empirical_finalize_incremental(self):
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+        values = [1., 2., 3., 4., 5., 6., 7.]
+        log_weights = [-1., -2., -3., -4., -5., -6., -7.]
+
+        dist_on_file = Empirical(file_name=file_name, file_sync_timeout=2)
+        dist_on_file.add_sequence(values[:2], log_weights=log_weights[:2])
+        num_metadata_correct = len(dist_on_file.metadata)
+        dist_on_file.add_sequence(values[2:], log_weights=log_weights[2:])
+        dist_on_file.finalize()
+        dist_on_file.finalize()
+        num_chunks = dist_on_file._shelf['log_weights_chunks']
+        num_chunks_correct = 4
+        num_metadata = len(dist_on_file.metadata)
+        dist_on_file.close()
+        dist = Empirical(file_name=file_name, file_read_only=True)
+        dist_log_weights = [float(w) for w in dist._log_weights]
+        dist_values = [float(v) for v in dist.get_values()]
+        dist.close()
+
+        util.eval_print('num_chunks', 'num_chunks_correct', 'num_metadata', 'num_metadata_correct', 'dist_log_weights', 'log_weights', 'dist_values', 'values')
+
+        self.assertEqual(num_chunks, num_chunks_correct)
+        self.assertEqual(num_metadata, num_metadata_correct)
+        self.assertEqual(dist_log_weights, log_weights)
+        self.assertEqual(dist_values, values)
+
     def test_dist_empirical_concat_file_to_mem(self):
         values_correct = [0., 1, 2, 3, 4, 5, 6, 7, 8, 9]
         log_weights_correct = [-10, -15, -200, -2, -3, -22, -100, 1, 2, -0.3]
@@ -30,6 +30,8 @@ importance_sampling_with_inference_network_lstm_duration = 0
 importance_sampling_with_inference_network_lstm_training_traces = 50000
 importance_sampling_with_inference_network_lstm_prior_inflation = PriorInflation.ENABLED
 
+sequential_monte_carlo_samples = 1000
+
 lightweight_metropolis_hastings_samples = 5000
 lightweight_metropolis_hastings_burn_in = 500
 lightweight_metropolis_hastings_kl_divergence = 0
@@ -141,6 +143,30 @@ class GaussianWithUnknownMeanTestCase(unittest.TestCase):
         self.assertGreater(posterior_effective_sample_size, posterior_effective_sample_size_min)
         self.assertLess(kl_divergence, 0.25)
 
+    def test_inference_gum_posterior_importance_sampling_batched(self):
+        samples = importance_sampling_samples
+        batch_size = 500
+        true_posterior = Normal(7.25, math.sqrt(1/1.2))
+        posterior_mean_correct = float(true_posterior.mean)
+        posterior_stddev_correct = float(true_posterior.stddev)
+        posterior_effective_sample_size_min = samples * 0.005
+
+        posterior = self._model.posterior_distribution(samples, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs0': 8, 'obs1': 9}, batch_size=batch_size)
+
+        posterior_length = posterior.length
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        posterior_effective_sample_size = float(posterior.effective_sample_size)
+        kl_divergence = float(pyprob.distributions.Distribution.kl_divergence(true_posterior, Normal(posterior.mean, posterior.stddev)))
+
+        util.eval_print('samples', 'batch_size', 'posterior_length', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct', 'posterior_effective_sample_size', 'posterior_effective_sample_size_min', 'kl_divergence')
+
+        self.assertEqual(posterior_length, samples)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.75)
+        self.assertGreater(posterior_effective_sample_size, posterior_effective_sample_size_min)
+        self.assertLess(kl_divergence, 0.25)
+
     def test_inference_gum_posterior_importance_sampling_with_inference_network_ff(self):
         samples = importance_sampling_samples
         true_posterior = Normal(7.25, math.sqrt(1/1.2))
@@ -479,6 +505,25 @@ class HiddenMarkovModelTestCase(unittest.TestCase):
         self.assertLess(l2_distance, 3)
         self.assertLess(kl_divergence, 1)
 
+    def test_inference_hmm_posterior_sequential_monte_carlo(self):
+        samples = sequential_monte_carlo_samples
+        observation = {'obs{}'.format(i): self._observation[i] for i in range(len(self._observation))}
+        posterior_mean_correct = self._posterior_mean_correct
+        posterior_effective_sample_size_min = samples * 0.1
+
+        posterior = self._model.posterior_distribution(samples, inference_engine=InferenceEngine.SEQUENTIAL_MONTE_CARLO, observe=observation)
+        posterior_mean = posterior.mean
+        posterior_effective_sample_size = float(posterior.effective_sample_size)
+
+        l2_distance = float(F.pairwise_distance(posterior_mean, posterior_mean_correct).sum())
+        kl_divergence = float(sum([pyprob.distributions.Distribution.kl_divergence(Categorical(i + util._epsilon), Categorical(j + util._epsilon)) for (i, j) in zip(posterior_mean, posterior_mean_correct)]))
+
+        util.eval_print('samples', 'posterior_mean', 'posterior_mean_correct', 'posterior_effective_sample_size', 'posterior_effective_sample_size_min', 'l2_distance', 'kl_divergence')
+
+        self.assertGreater(posterior_effective_sample_size, posterior_effective_sample_size_min)
+        self.assertLess(l2_distance, 3)
+        self.assertLess(kl_divergence, 1)
+
     def test_inference_hmm_posterior_importance_sampling_with_inference_network_ff(self):
         samples = importance_sampling_with_inference_network_ff_samples
         observation = {'obs{}'.format(i): self._observation[i] for i in range(len(self._observation))}
@@ -6,8 +6,9 @@ import tempfile
 import uuid
 
 import pyprob
-from pyprob import util, Model, InferenceEngine
+from pyprob import util, Model, InferenceEngine, TracePruning
 from pyprob.distributions import Normal, Uniform, Empirical
+from pyprob.trace import HashedTrace
 
 
 importance_sampling_samples = 5000
@@ -75,6 +76,121 @@ class ModelTestCase(unittest.TestCase):
         self.assertAlmostEqual(prior_stddev, prior_stddev_correct, places=0)
         self.assertEqual(prior_length, prior_length_correct)
 
+    def test_model_prior_parallel(self):
+        num_traces = 5000
+        num_workers = 2
+        prior_mean_correct = 1
+        prior_stddev_correct = math.sqrt(5)
+        prior_length_correct = num_traces
+
+        prior = self._model.prior_distribution(num_traces, num_workers=num_workers)
+        prior_length = prior.length
+        prior_mean = float(prior.mean)
+        prior_stddev = float(prior.stddev)
+        util.eval_print('num_traces', 'num_workers', 'prior_mean', 'prior_mean_correct', 'prior_stddev', 'prior_stddev_correct', 'prior_length', 'prior_length_correct')
+
+        self.assertAlmostEqual(prior_mean, prior_mean_correct, places=0)
+        self.assertAlmostEqual(prior_stddev, prior_stddev_correct, places=0)
+        self.assertEqual(prior_length, prior_length_correct)
+
+    def test_model_posterior_target_effective_sample_size(self):
+        target_effective_sample_size = 50
+        num_traces_max = 100000
+
+        posterior = self._model.posterior_distribution(num_traces=num_traces_max, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs0': 8, 'obs1': 9}, target_effective_sample_size=target_effective_sample_size)
+        posterior_length = posterior.length
+        posterior_effective_sample_size = float(posterior.effective_sample_size)
+        posterior_effective_sample_size_recomputed = float(1. / posterior._categorical.probs.pow(2).sum())
+        util.eval_print('target_effective_sample_size', 'num_traces_max', 'posterior_length', 'posterior_effective_sample_size', 'posterior_effective_sample_size_recomputed')
+
+        self.assertGreaterEqual(posterior_effective_sample_size, target_effective_sample_size)
+        self.assertLess(posterior_length, num_traces_max)
+        self.assertAlmostEqual(posterior_effective_sample_size, posterior_effective_sample_size_recomputed, places=1)
+
+    def test_model_posterior_trace_pruning(self):
+        num_traces = 5000
+        trace_pruning_threshold = 5.
+        true_posterior = Normal(7.25, math.sqrt(1/1.2))
+        posterior_mean_correct = float(true_posterior.mean)
+        posterior_stddev_correct = float(true_posterior.stddev)
+
+        posterior = self._model.posterior_distribution(num_traces=num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs0': 8, 'obs1': 9}, trace_pruning=TracePruning.DISCARD, trace_pruning_threshold=trace_pruning_threshold)
+        posterior_length = posterior.length
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        util.eval_print('num_traces', 'trace_pruning_threshold', 'posterior_length', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct')
+
+        self.assertLess(posterior_length, num_traces)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.75)
+
+    def test_model_posterior_trace_pruning_zero_weight(self):
+        num_traces = 5000
+        trace_pruning_threshold = 5.
+        true_posterior = Normal(7.25, math.sqrt(1/1.2))
+        posterior_mean_correct = float(true_posterior.mean)
+        posterior_stddev_correct = float(true_posterior.stddev)
+
+        posterior = self._model.posterior_distribution(num_traces=num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs0': 8, 'obs1': 9}, trace_pruning=TracePruning.ZERO_WEIGHT, trace_pruning_threshold=trace_pruning_threshold)
+        posterior_length = posterior.length
+        posterior_num_pruned = sum(1 for log_weight in posterior._log_weights if log_weight == -math.inf)
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        util.eval_print('num_traces', 'trace_pruning_threshold', 'posterior_length', 'posterior_num_pruned', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct')
+
+        self.assertEqual(posterior_length, num_traces)
+        self.assertGreater(posterior_num_pruned, 0)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.75)
+
+    def test_model_posterior_trace_pruning_parallel(self):
+        num_traces = 1000
+        num_workers = 2
+        trace_pruning_threshold = 5.
+
+        posterior = self._model.posterior_distribution(num_traces=num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, observe={'obs0': 8, 'obs1': 9}, num_workers=num_workers, trace_pruning=TracePruning.DISCARD, trace_pruning_threshold=trace_pruning_threshold)
+        posterior_length = posterior.length
+        trace_pruning_metadata = [metadata for metadata in posterior.metadata.values() if metadata.get('op') == 'trace_pruning']
+        num_traces_pruned = trace_pruning_metadata[-1]['num_traces_pruned']
+        num_traces_pruned_correct = num_traces - posterior_length
+        util.eval_print('num_traces', 'num_workers', 'posterior_length', 'num_traces_pruned', 'num_traces_pruned_correct')
+
+        self.assertEqual(len(trace_pruning_metadata), 1)
+        self.assertEqual(num_traces_pruned, num_traces_pruned_correct)
+
+    def test_model_posterior_stream(self):
+        target_effective_sample_size = 100
+        num_traces_max = 100000
+        true_posterior = Normal(7.25, math.sqrt(1/1.2))
+        posterior_mean_correct = float(true_posterior.mean)
+        posterior_stddev_correct = float(true_posterior.stddev)
+
+        stream = self._model.posterior_stream(num_traces=num_traces_max, observe={'obs0': 8, 'obs1': 9})
+        values = []
+        log_weights = []
+        for value, log_weight in stream:
+            values.append(value)
+            log_weights.append(log_weight)
+            if stream.effective_sample_size >= target_effective_sample_size:
+                break
+        stream.close()
+        stream_length = stream.length
+        stream_mean = float(stream.mean)
+        stream_stddev = float(stream.stddev)
+        stream_effective_sample_size = stream.effective_sample_size
+        posterior = Empirical(values=values, log_weights=log_weights)
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        util.eval_print('target_effective_sample_size', 'stream_length', 'stream_effective_sample_size', 'stream_mean', 'posterior_mean', 'posterior_mean_correct', 'stream_stddev', 'posterior_stddev', 'posterior_stddev_correct')
+
+        self.assertEqual(stream_length, len(values))
+        self.assertLess(stream_length, num_traces_max)
+        self.assertGreaterEqual(stream_effective_sample_size, target_effective_sample_size)
+        self.assertAlmostEqual(stream_mean, posterior_mean, places=3)
+        self.assertAlmostEqual(stream_stddev, posterior_stddev, places=3)
+        self.assertAlmostEqual(stream_mean, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(stream_stddev, posterior_stddev_correct, delta=0.75)
+
     def test_model_trace_length_statistics(self):
         num_traces = 2000
         trace_length_mean_correct = 2.5630438327789307
@@ -94,6 +210,63 @@ class ModelTestCase(unittest.TestCase):
         self.assertAlmostEqual(trace_length_stddev, trace_length_stddev_correct, places=0)
         self.assertAlmostEqual(trace_length_min, trace_length_min_correct, places=0)
 
+    def test_model_lmh_posterior_multiple_chains(self):
+        num_chains = 2
+        num_traces = 2000
+        true_posterior = Normal(7.25, math.sqrt(1/1.2))
+        posterior_mean_correct = float(true_posterior.mean)
+        posterior_stddev_correct = float(true_posterior.stddev)
+        posterior_length_correct = num_chains * num_traces
+
+        posteriors = self._model.posterior_traces(num_traces=num_traces, inference_engine=InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, observe={'obs0': 8, 'obs1': 9}, num_chains=num_chains, combine_chains=False)
+        chain_lengths = [posterior.length for posterior in posteriors]
+        chain_lengths_correct = [num_traces] * num_chains
+        posterior = Empirical(concat_empiricals=posteriors).map(lambda trace: trace.result)
+        posterior_length = posterior.length
+        posterior_mean = float(posterior.mean)
+        posterior_stddev = float(posterior.stddev)
+        util.eval_print('num_chains', 'num_traces', 'chain_lengths', 'chain_lengths_correct', 'posterior_length', 'posterior_length_correct', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev', 'posterior_stddev_correct')
+
+        self.assertEqual(chain_lengths, chain_lengths_correct)
+        self.assertEqual(posterior_length, posterior_length_correct)
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, delta=0.75)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, delta=0.75)
+
+    def test_model_lmh_posterior_num_workers_single_chain(self):
+        for num_chains in [None, 1]:
+            with self.assertRaises(ValueError):
+                self._model.posterior_traces(num_traces=10, inference_engine=InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, observe={'obs0': 8, 'obs1': 9}, num_chains=num_chains, num_workers=2)
+
+    def test_model_lmh_posterior_columns_not_cached(self):
+        posterior = self._model.posterior_traces(num_traces=50, inference_engine=InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, observe={'obs0': 8, 'obs1': 9})
+        columns_cached = any(getattr(trace, '_columns', None) is not None for trace in posterior)
+        util.eval_print('columns_cached')
+
+        self.assertFalse(columns_cached)
+
+    def test_model_lmh_posterior_multiple_chains_stored_values(self):
+        class TestModel(Model):
+            def __init__(self):
+                super().__init__('Test model', use_trace_hash=True)
+
+            def forward(self):
+                mu = pyprob.sample(Normal(0, 1), name='mu')
+                pyprob.sample(Normal(mu, 1))
+                pyprob.observe(Normal(mu, 1), name='obs')
+                return mu
+
+        num_chains = 2
+        num_traces = 20
+        model = TestModel()
+        posterior = model.posterior_traces(num_traces=num_traces, inference_engine=InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS, observe={'obs': 1}, num_chains=num_chains, trace_retention=pyprob.TraceRetention.NAMED_VARIABLES)
+        hashed = all(isinstance(trace, HashedTrace) for trace in posterior)
+        trace_lengths = set(trace.length for trace in posterior)
+        trace_lengths_correct = {2}
+        util.eval_print('num_chains', 'num_traces', 'hashed', 'trace_lengths', 'trace_lengths_correct')
+
+        self.assertTrue(hashed)
+        self.assertEqual(trace_lengths, trace_lengths_correct)
+
     def test_model_lmh_posterior_with_stop_and_resume(self):
         posterior_num_runs = 100
         posterior_num_traces_each_run = 20
@@ -1,4 +1,6 @@
 import unittest
+import threading
+import time
 
 import pyprob
 from pyprob import util, state, Model
@@ -20,6 +22,155 @@ class StateTestCase(unittest.TestCase):
         util.eval_print('address', 'address_correct')
         self.assertEqual(address, address_correct)
 
+    def test_address_cache(self):
+        state.set_address_cache(False)
+        addresses = []
+        for i in range(4):
+            if i == 1:
+                state.set_address_cache(True)
+            address = self._sample_address()
+            addresses.append(address)
+        address_cache_stats = state.address_cache_stats()
+        address_cache_hits = address_cache_stats['hits']
+        address_cache_hits_correct = 2
+        address_cache_misses = address_cache_stats['misses']
+        address_cache_misses_correct = 1
+        util.eval_print('addresses', 'address_cache_hits', 'address_cache_hits_correct', 'address_cache_misses', 'address_cache_misses_correct')
+
+        self.assertEqual(addresses, [addresses[0]] * 4)
+        self.assertEqual(address_cache_hits, address_cache_hits_correct)
+        self.assertEqual(address_cache_misses, address_cache_misses_correct)
+
+    def test_address_cache_threads(self):
+        num_threads = 4
+        num_addresses = 1000
+        state.set_address_cache(True)
+
+        def run():
+            for i in range(num_addresses):
+                self._sample_address()
+
+        threads = [threading.Thread(target=run) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        address_cache_stats = state.address_cache_stats()
+        address_cache_lookups = address_cache_stats['hits'] + address_cache_stats['misses']
+        address_cache_lookups_correct = num_threads * num_addresses
+        util.eval_print('num_threads', 'num_addresses', 'address_cache_lookups', 'address_cache_lookups_correct')
+
+        self.assertEqual(address_cache_lookups, address_cache_lookups_correct)
+
+
+class StaticAddressTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class TestModel(Model):
+            def __init__(self, use_static_addresses):
+                super().__init__('Test model', use_static_addresses=use_static_addresses)
+
+            def helper(self):
+                z = pyprob.sample(Normal(0, 1))
+                return z
+
+            def forward(self):
+                x = pyprob.sample(Normal(0, 1))
+                y = self.helper()
+                ws = [pyprob.sample(Normal(0, 1)) for i in range(2)]
+                pyprob.observe(Normal(x + y + sum(ws), 1), name='obs')
+                return x
+
+        class CallableModel(Model):
+            def __init__(self, use_static_addresses):
+                super().__init__('Callable model', use_static_addresses=use_static_addresses)
+
+            def helper(self):
+                z = pyprob.sample(Normal(0, 1))
+                return z
+
+            def inner(self):
+                y = self.helper()
+                return y
+
+            def call(self, func):
+                # Calls func in a way the static pass does not see
+                w = func()
+                return w
+
+            def forward(self):
+                x = self.inner()
+                v = self.call(self.inner)
+                pyprob.observe(Normal(x + v, 1), name='obs')
+                return x
+
+        self._model = TestModel(use_static_addresses=False)
+        self._model_static = TestModel(use_static_addresses=True)
+        self._callable_model = CallableModel(use_static_addresses=False)
+        self._callable_model_static = CallableModel(use_static_addresses=True)
+        super().__init__(*args, **kwargs)
+
+    def test_static_addresses(self):
+        addresses_correct = [variable.address for variable in self._model.get_trace().variables]
+        addresses = [variable.address for variable in self._model_static.get_trace().variables]
+        static_addresses = len(self._model_static._static_addresses)
+        util.eval_print('addresses', 'addresses_correct', 'static_addresses')
+
+        self.assertEqual(addresses, addresses_correct)
+        self.assertGreater(static_addresses, 0)
+
+    def test_static_addresses_call_paths(self):
+        # The sample in helper is reached from forward through inner, and from forward through call and inner
+        addresses_correct = [variable.address for variable in self._callable_model.get_trace().variables]
+        addresses = [variable.address for variable in self._callable_model_static.get_trace().variables]
+        num_addresses = len(set(addresses))
+        num_addresses_correct = 3
+        util.eval_print('addresses', 'addresses_correct', 'num_addresses', 'num_addresses_correct')
+
+        self.assertEqual(addresses, addresses_correct)
+        self.assertEqual(num_addresses, num_addresses_correct)
+
+
+class ConcurrentTracesTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class TestModel(Model):
+            def __init__(self):
+                super().__init__('Test model')
+
+            def forward(self):
+                x = pyprob.sample(Normal(0, 1))
+                time.sleep(0.001)
+                y = pyprob.sample(Normal(x, 1))
+                time.sleep(0.001)
+                pyprob.observe(Normal(y, 1), 0.5)
+                return x
+
+        self._model = TestModel()
+        super().__init__(*args, **kwargs)
+
+    def test_concurrent_traces(self):
+        num_threads = 4
+        num_traces = 20
+        results = [None] * num_threads
+
+        def run(i):
+            results[i] = self._model.posterior_traces(num_traces)
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        traces = [trace for posterior in results for trace in posterior.get_values()]
+        trace_lengths = set(trace.length for trace in traces)
+        trace_lengths_correct = {3}
+        traces_observed = set(len(trace.variables_observed) for trace in traces)
+        traces_observed_correct = {1}
+        util.eval_print('num_threads', 'num_traces', 'trace_lengths', 'trace_lengths_correct', 'traces_observed', 'traces_observed_correct')
+
+        self.assertEqual(len(traces), num_threads * num_traces)
+        self.assertEqual(trace_lengths, trace_lengths_correct)
+        self.assertEqual(traces_observed, traces_observed_correct)
+
 
 class PriorInflationTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -74,6 +225,28 @@ class PriorInflationTestCase(unittest.TestCase):
         self.assertAlmostEqual(normal_prior_inflated_mean, normal_prior_inflated_mean_correct, places=0)
         self.assertAlmostEqual(normal_prior_inflated_stddev, normal_prior_inflated_stddev_correct, places=0)
 
+    def test_prior_inflation_cache(self):
+        samples = 100
+        state.set_inflation_cache(False)
+        pyprob.set_random_seed(1)
+        prior = self._model.prior_traces(samples, prior_inflation=pyprob.PriorInflation.ENABLED)
+        state.set_inflation_cache(True)
+        pyprob.set_random_seed(1)
+        prior_cached = self._model.prior_traces(samples, prior_inflation=pyprob.PriorInflation.ENABLED)
+        inflation_cache_stats = state.inflation_cache_stats()
+        inflation_cache_hits = inflation_cache_stats['hits']
+        inflation_cache_hits_correct = 2 * (samples - 1)
+        inflation_cache_misses = inflation_cache_stats['misses']
+        inflation_cache_misses_correct = 2
+        log_weights = [float(trace.log_importance_weight) for trace in prior_cached.get_values()]
+        log_weights_correct = [float(trace.log_importance_weight) for trace in prior.get_values()]
+
+        util.eval_print('samples', 'inflation_cache_hits', 'inflation_cache_hits_correct', 'inflation_cache_misses', 'inflation_cache_misses_correct')
+
+        self.assertEqual(inflation_cache_hits, inflation_cache_hits_correct)
+        self.assertEqual(inflation_cache_misses, inflation_cache_misses_correct)
+        self.assertEqual(log_weights, log_weights_correct)
+
 
 if __name__ == '__main__':
     pyprob.set_random_seed(123)
@@ -1,8 +1,15 @@
 import unittest
+import pickle
+import copyreg
+import torch
+import tempfile
+import os
 
 import pyprob
-from pyprob import util, Model, InferenceEngine
-from pyprob.distributions import Uniform, Normal
+from pyprob import util, Model, InferenceEngine, TraceRecording, TraceRetention
+from pyprob.trace import Variable, Trace, TraceColumns, TraceHash, TraceSkeletons, PackedTrace
+from pyprob.address_dictionary import address_table
+from pyprob.distributions import Distribution, Empirical, EmpiricalStorage, Uniform, Normal, Categorical
 from pyprob.nn import OnlineDataset
 
 
@@ -47,6 +54,432 @@ class TraceTestCase(unittest.TestCase):
         self.assertEqual(observed, observed_correct)
         self.assertTrue(tagged_val)
 
+    def test_trace_replaced(self):
+        uniform = Uniform(0, 1)
+        trace = Trace()
+        trace.add(Variable(distribution=uniform, value=0.1, address_base='a', address='a__1', instance=1, log_prob=0., log_importance_weight=1., control=True, replace=True))
+        trace.add(Variable(distribution=uniform, value=0.2, address_base='b', address='b__1', instance=1, log_prob=0., log_importance_weight=1., control=True))
+        trace.add(Variable(distribution=uniform, value=0.3, address_base='a', address='a__2', instance=2, log_prob=0., log_importance_weight=2., control=True, replace=True))
+        trace.add(Variable(distribution=uniform, value=0.4, address_base='a', address='a__3', instance=3, log_prob=0., log_importance_weight=3., control=True, replace=True))
+        trace.add(Variable(distribution=uniform, value=0.5, address_base='c', address='c__1', instance=1, log_prob=-1., observed=True))
+        trace.end(None, 0.)
+        controlled = [round(float(v.value), 2) for v in trace.variables_controlled]
+        controlled_correct = [0.4, 0.2]
+        replaced = [round(float(v.value), 2) for v in trace.variables_replaced]
+        replaced_correct = [0.1, 0.3]
+        log_prob = float(trace.log_prob)
+        log_prob_correct = -1.
+        log_importance_weight = float(trace.log_importance_weight)
+        log_importance_weight_correct = 4.
+
+        util.eval_print('controlled', 'controlled_correct', 'replaced', 'replaced_correct', 'log_prob', 'log_prob_correct', 'log_importance_weight', 'log_importance_weight_correct')
+
+        self.assertEqual(controlled, controlled_correct)
+        self.assertEqual(replaced, replaced_correct)
+        self.assertAlmostEqual(log_prob, log_prob_correct, places=5)
+        self.assertAlmostEqual(log_importance_weight, log_importance_weight_correct, places=5)
+
+    def test_trace_pickle(self):
+        trace = self._model._traces(1)[0]
+        del(trace.variables_controlled[0].control)
+        trace_loaded = pickle.loads(pickle.dumps(trace))
+        values = [float(v.value) for v in trace_loaded.variables_controlled]
+        values_correct = [float(v.value) for v in trace.variables_controlled]
+        observed = [v.observed for v in trace_loaded.variables]
+        observed_correct = [v.observed for v in trace.variables]
+        log_prob = float(trace_loaded.log_prob)
+        log_prob_correct = float(trace.log_prob)
+        control_deleted = not hasattr(trace_loaded.variables_controlled[0], 'control')
+
+        util.eval_print('values', 'values_correct', 'observed', 'observed_correct', 'log_prob', 'log_prob_correct', 'control_deleted')
+
+        self.assertEqual(values, values_correct)
+        self.assertEqual(observed, observed_correct)
+        self.assertAlmostEqual(log_prob, log_prob_correct, places=5)
+        self.assertTrue(control_deleted)
+        self.assertFalse(hasattr(trace_loaded, '__dict__'))
+
+    def test_variable_value(self):
+        variable = Variable(value=1., log_prob=-0.5, address_base='x', address='x__1', instance=1)
+        value = variable.value
+        value.add_(1.)
+        value_same = variable.value is value
+        value_updated = float(variable.value)
+        value_updated_correct = 2.
+
+        util.eval_print('value_same', 'value_updated', 'value_updated_correct')
+
+        self.assertTrue(value_same)
+        self.assertEqual(value_updated, value_updated_correct)
+
+    def test_variable_pickle_baseline(self):
+        class BaselineVariable():
+            # Pickles as a Variable saved before Variable had __slots__, i.e., with the dictionary of its attributes as state
+            def __init__(self, state):
+                self.state = state
+
+            def __reduce_ex__(self, protocol):
+                return (copyreg.__newobj__, (Variable,), self.state)
+
+        state = {'distribution': None, 'value': util.to_tensor(0.25), 'address_base': 'x', 'address': 'x__1', 'instance': 1, 'log_prob': util.to_tensor(-1.5), 'log_importance_weight': None, 'control': True, 'replace': False, 'name': 'x', 'observable': True, 'observed': False, 'reused': False, 'tagged': False}
+        variable = pickle.loads(pickle.dumps(BaselineVariable(state)))
+        value = float(variable.value)
+        value_correct = 0.25
+        log_prob = float(variable.log_prob)
+        log_prob_correct = -1.5
+        address = variable.address
+        address_correct = 'x__1'
+        control = variable.control
+        control_correct = True
+        state_saved = variable.__getstate__()
+        state_saved_keys = set(state_saved.keys())
+        state_saved_keys_correct = set(state.keys())
+        state_saved_value_tensor = torch.is_tensor(state_saved['value']) and torch.is_tensor(state_saved['log_prob'])
+
+        util.eval_print('value', 'value_correct', 'log_prob', 'log_prob_correct', 'address', 'address_correct', 'control', 'control_correct', 'state_saved_keys', 'state_saved_keys_correct', 'state_saved_value_tensor')
+
+        self.assertEqual(value, value_correct)
+        self.assertEqual(log_prob, log_prob_correct)
+        self.assertEqual(address, address_correct)
+        self.assertEqual(control, control_correct)
+        self.assertEqual(state_saved_keys, state_saved_keys_correct)
+        self.assertTrue(state_saved_value_tensor)
+
+    def test_trace_columns(self):
+        traces = self._model._traces(2)
+        columns = traces[0].columns
+        values = [float(columns.value(i)) for i in range(len(columns))]
+        values_correct = [float(v.value) for v in traces[0].variables_controlled]
+        log_probs = columns.log_probs.tolist()
+        log_probs_correct = [float(v.log_prob) for v in traces[0].variables_controlled]
+        batch_values = TraceColumns.stack([trace.columns for trace in traces])
+        batch_value = columns.batch_value(batch_values, 1).tolist()
+        batch_value_correct = [float(trace.variables_controlled[1].value) for trace in traces]
+        controlled = columns.mask('control').tolist()
+        controlled_correct = [True, True]
+
+        util.eval_print('values', 'values_correct', 'log_probs', 'log_probs_correct', 'batch_value', 'batch_value_correct', 'controlled', 'controlled_correct')
+
+        self.assertEqual(values, values_correct)
+        self.assertEqual(log_probs, log_probs_correct)
+        self.assertEqual(batch_value, batch_value_correct)
+        self.assertEqual(controlled, controlled_correct)
+
+    def test_trace_columns_dtypes(self):
+        class MixedModel(Model):
+            def __init__(self):
+                super().__init__('Mixed')
+
+            def forward(self):
+                n = pyprob.sample(Categorical([0.25, 0.25, 0.5]))
+                x = pyprob.sample(Normal(0, 1))
+                m = pyprob.sample(Categorical([0.5, 0.5]))
+                return n, x, m
+
+        traces = MixedModel()._traces(2)
+        columns = traces[0].columns
+        dtypes = [columns.value(i).dtype for i in range(len(columns))]
+        dtypes_correct = [v.value.dtype for v in traces[0].variables_controlled]
+        values = [columns.value(i).tolist() for i in range(len(columns))]
+        values_correct = [v.value.tolist() for v in traces[0].variables_controlled]
+        batch_values = TraceColumns.stack([trace.columns for trace in traces])
+        batch_value = columns.batch_value(batch_values, 2)
+        batch_value_dtype = batch_value.dtype
+        batch_value_dtype_correct = traces[0].variables_controlled[2].value.dtype
+        batch_value = batch_value.tolist()
+        batch_value_correct = [trace.variables_controlled[2].value.tolist() for trace in traces]
+
+        util.eval_print('dtypes', 'dtypes_correct', 'values', 'values_correct', 'batch_value', 'batch_value_correct', 'batch_value_dtype', 'batch_value_dtype_correct')
+
+        self.assertEqual(dtypes, dtypes_correct)
+        self.assertEqual(values, values_correct)
+        self.assertEqual(batch_value, batch_value_correct)
+        self.assertEqual(batch_value_dtype, batch_value_dtype_correct)
+
+    def test_trace_type_id(self):
+        def make_trace(addresses):
+            trace = Trace()
+            for address in addresses:
+                trace.add(Variable(distribution=Uniform(0, 1), value=0.5, address_base=address, address=address + '__1', instance=1, log_prob=0., control=True))
+            trace.end(None, 0.)
+            return trace
+
+        traces = self._model._traces(2)
+        type_ids_equal = traces[0].type_id == traces[1].type_id
+        fingerprints_equal = traces[0].fingerprint == traces[1].fingerprint
+        type_ids_ab = make_trace(['a', 'b']).type_id == make_trace(['a', 'b']).type_id
+        type_ids_ab_ba = make_trace(['a', 'b']).type_id == make_trace(['b', 'a']).type_id
+
+        util.eval_print('type_ids_equal', 'fingerprints_equal', 'type_ids_ab', 'type_ids_ab_ba')
+
+        self.assertTrue(type_ids_equal)
+        self.assertTrue(fingerprints_equal)
+        self.assertTrue(type_ids_ab)
+        self.assertFalse(type_ids_ab_ba)
+
+    def test_trace_address_ids(self):
+        traces = self._model._traces(2)
+        address_ids = [v.address_id for v in traces[0].variables]
+        address_ids_correct = [v.address_id for v in traces[1].variables]
+        addresses = [address_table.address(address_id) for address_id in address_ids]
+        addresses_correct = [v.address for v in traces[0].variables]
+        variable_state = traces[0].variables[0].__getstate__()
+        state_address = variable_state['address']
+        state_address_correct = addresses_correct[0]
+
+        util.eval_print('address_ids', 'address_ids_correct', 'addresses', 'addresses_correct', 'state_address', 'state_address_correct')
+
+        self.assertEqual(address_ids, address_ids_correct)
+        self.assertEqual(addresses, addresses_correct)
+        self.assertEqual(state_address, state_address_correct)
+        self.assertNotIn('address_id', variable_state)
+
+    def test_trace_recording(self):
+        pyprob.set_random_seed(1)
+        traces = self._model._traces(5, trace_mode=pyprob.TraceMode.POSTERIOR).get_values()
+        pyprob.set_random_seed(1)
+        traces_result_and_weight = self._model._traces(5, trace_mode=pyprob.TraceMode.POSTERIOR, trace_recording=TraceRecording.RESULT_AND_WEIGHT).get_values()
+        pyprob.set_random_seed(1)
+        traces_inference_network = self._model._traces(5, trace_mode=pyprob.TraceMode.POSTERIOR, trace_recording=TraceRecording.INFERENCE_NETWORK).get_values()
+
+        log_importance_weights = [float(trace.log_importance_weight) for trace in traces_result_and_weight]
+        log_importance_weights_correct = [float(trace.log_importance_weight) for trace in traces]
+        results = [float(trace.result) for trace in traces_result_and_weight]
+        results_correct = [float(trace.result) for trace in traces]
+        variables = [len(trace.variables) for trace in traces_result_and_weight]
+        variables_correct = [0] * 5
+        controlled = [[float(v.value) for v in trace.variables_controlled] for trace in traces_inference_network]
+        controlled_correct = [[float(v.value) for v in trace.variables_controlled] for trace in traces]
+        named = [sorted(trace.named_variables.keys()) for trace in traces_inference_network]
+        named_correct = [sorted(trace.named_variables.keys()) for trace in traces]
+        uncontrolled = [len(trace.variables_uncontrolled) for trace in traces_inference_network]
+        uncontrolled_correct = [0] * 5
+
+        util.eval_print('log_importance_weights', 'log_importance_weights_correct', 'results', 'results_correct', 'variables', 'variables_correct', 'controlled', 'controlled_correct', 'named', 'named_correct', 'uncontrolled', 'uncontrolled_correct')
+
+        self.assertEqual(log_importance_weights, log_importance_weights_correct)
+        self.assertEqual(results, results_correct)
+        self.assertEqual(variables, variables_correct)
+        self.assertEqual(controlled, controlled_correct)
+        self.assertEqual(named, named_correct)
+        self.assertEqual(uncontrolled, uncontrolled_correct)
+
+    def test_trace_retention(self):
+        pyprob.set_random_seed(1)
+        traces = self._model.posterior_traces(5).get_values()
+        pyprob.set_random_seed(1)
+        traces_values = self._model.posterior_traces(5, trace_retention=TraceRetention.VALUES).get_values()
+        pyprob.set_random_seed(1)
+        traces_named = self._model.posterior_traces(5, trace_retention=TraceRetention.NAMED_VARIABLES).get_values()
+        pyprob.set_random_seed(1)
+        traces_addresses = self._model.posterior_traces(5, trace_retention=TraceRetention.ADDRESSES, trace_retention_addresses=[traces[0].variables_controlled[0].address]).get_values()
+
+        log_importance_weights = [float(trace.log_importance_weight) for trace in traces_named]
+        log_importance_weights_correct = [float(trace.log_importance_weight) for trace in traces]
+        lengths = [trace.length for trace in traces_named]
+        lengths_correct = [trace.length for trace in traces]
+        values = [[float(v.value) for v in trace.variables] for trace in traces_values]
+        values_correct = [[float(v.value) for v in trace.variables] for trace in traces]
+        distributions = set(v.distribution for trace in traces_values for v in trace.variables)
+        distributions_correct = {None}
+        named = [list(trace.named_variables.keys()) for trace in traces_named]
+        named_correct = [['val']] * 5
+        variables_named = [len(trace.variables) for trace in traces_named]
+        variables_named_correct = [1] * 5
+        variables_addresses = [len(trace.variables) for trace in traces_addresses]
+        variables_addresses_correct = [1] * 5
+
+        util.eval_print('log_importance_weights', 'log_importance_weights_correct', 'lengths', 'lengths_correct', 'values', 'values_correct', 'distributions', 'distributions_correct', 'named', 'named_correct', 'variables_named', 'variables_named_correct', 'variables_addresses', 'variables_addresses_correct')
+
+        self.assertEqual(log_importance_weights, log_importance_weights_correct)
+        self.assertEqual(lengths, lengths_correct)
+        self.assertEqual(values, values_correct)
+        self.assertEqual(distributions, distributions_correct)
+        self.assertEqual(named, named_correct)
+        self.assertEqual(variables_named, variables_named_correct)
+        self.assertEqual(variables_addresses, variables_addresses_correct)
+
+
+class TraceHashTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class TestModel(Model):
+            def __init__(self, *args, **kwargs):
+                super().__init__('Test', *args, **kwargs)
+
+            def forward(self):
+                x = pyprob.sample(Normal(0, 1))
+                ys = [pyprob.sample(Normal(x, 1)) for i in range(10)]
+                pyprob.observe(Normal(sum(ys), 1), 0.5, name='obs')
+                return x
+
+        self._model = TestModel()
+        self._model_trace_hash = TestModel(use_trace_hash=True)
+        super().__init__(*args, **kwargs)
+
+    def test_trace_hash(self):
+        traces = self._model._traces(10).get_values()
+        trace_hash_file_name = os.path.join(tempfile.mkdtemp(), 'traces')
+        for codec in ['zlib', 'lzma']:
+            trace_hash = TraceHash(file_name=trace_hash_file_name, codec=codec, chunk_size=1024)
+            for trace in traces:
+                trace_hash.add(trace)
+            values = [float(trace_hash[i].result) for i in reversed(range(len(traces)))]
+            values_correct = [float(trace.result) for trace in reversed(traces)]
+            addresses = [v.address for v in trace_hash[3].variables]
+            addresses_correct = [v.address for v in traces[3].variables]
+            compression_ratio = trace_hash.stats()['compression_ratio']
+            trace_hash.close()
+
+            util.eval_print('codec', 'values', 'values_correct', 'addresses', 'addresses_correct', 'compression_ratio')
+
+            self.assertEqual(values, values_correct)
+            self.assertEqual(addresses, addresses_correct)
+            self.assertGreater(compression_ratio, 1)
+
+    def test_trace_hash_model(self):
+        posterior = self._model_trace_hash.posterior_traces(20)
+        trace = posterior.sample()
+        trace_loaded = pickle.loads(pickle.dumps(trace))
+        lengths = [trace.length, len(trace.variables), trace_loaded.length]
+        lengths_correct = [12, 12, 12]
+        obs = 'obs' in trace.named_variables
+        trace_hash_length = len(trace._trace_hash)
+        trace_hash_separate = self._model_trace_hash.posterior_traces(20).sample()._trace_hash is not trace._trace_hash
+        pickled_size = len(pickle.dumps(trace))
+        pickled_size_trace = len(pickle.dumps(trace.get()))
+
+        util.eval_print('lengths', 'lengths_correct', 'obs', 'trace_hash_length', 'trace_hash_separate', 'pickled_size', 'pickled_size_trace')
+
+        self.assertEqual(lengths, lengths_correct)
+        self.assertTrue(obs)
+        self.assertEqual(trace_hash_length, 20)
+        self.assertTrue(trace_hash_separate)
+        self.assertLess(pickled_size, pickled_size_trace)
+        self.assertEqual(type(trace_loaded), Trace)
+
+    def test_trace_hash_model_file(self):
+        file_name = os.path.join(tempfile.mkdtemp(), 'posterior')
+        posterior = self._model_trace_hash.posterior_traces(20, file_name=file_name)
+        values = [float(trace.result) for trace in posterior.get_values()]
+        posterior.close()
+        posterior_loaded = Empirical(file_name=file_name, file_read_only=True)
+        values_loaded = [float(trace.result) for trace in posterior_loaded.get_values()]
+        types_loaded = set(type(trace) for trace in posterior_loaded.get_values())
+        posterior_loaded.close()
+
+        util.eval_print('values', 'values_loaded', 'types_loaded')
+
+        self.assertEqual(values, values_loaded)
+        self.assertEqual(types_loaded, {Trace})
+
+
+class PackedTraceTestCase(unittest.TestCase):
+    def __init__(self, *args, **kwargs):
+        class TestModel(Model):
+            def __init__(self, *args, **kwargs):
+                super().__init__('Test', *args, **kwargs)
+
+            def forward(self):
+                n = int(pyprob.sample(Categorical([0.5, 0.5]))) + 1
+                ys = [pyprob.sample(Normal(0, 1)) for i in range(n)]
+                pyprob.observe(Normal(sum(ys), 1), 0.5, name='obs')
+                return n
+
+        self._model = TestModel()
+        self._model_pack_traces = TestModel(pack_traces=True)
+        super().__init__(*args, **kwargs)
+
+    def test_trace_pack(self):
+        traces = self._model.prior_traces(20).get_values()
+        trace_skeletons = TraceSkeletons()
+        traces_packed = [trace_skeletons.pack(trace) for trace in traces]
+        trace_skeletons_loaded = pickle.loads(pickle.dumps(trace_skeletons))
+        traces_loaded = [trace_skeletons_loaded.unpack(pickle.loads(pickle.dumps(trace.record))) for trace in traces_packed]
+
+        skeletons = len(trace_skeletons)
+        skeletons_correct = len(set(trace.fingerprint for trace in traces))
+        values = [[float(v.value) for v in trace.variables] for trace in traces_loaded]
+        values_correct = [[float(v.value) for v in trace.variables] for trace in traces]
+        addresses = [[v.address for v in trace.variables_controlled] for trace in traces_loaded]
+        addresses_correct = [[v.address for v in trace.variables_controlled] for trace in traces]
+        log_probs = [float(trace.log_prob) for trace in traces_loaded]
+        log_probs_correct = [float(trace.log_prob) for trace in traces]
+        distributions = [[repr(v.distribution) for v in trace.variables] for trace in traces_loaded]
+        distributions_correct = [[repr(v.distribution) for v in trace.variables] for trace in traces]
+        named = [trace.named_variables['obs'] is trace.variables_observed[0] for trace in traces_packed]
+        named_correct = [True] * 20
+        packed_distributions = any(isinstance(value, (Distribution, torch.distributions.Distribution)) for trace in traces_packed for value in trace.record.data)
+        packed_distributions_correct = False
+
+        util.eval_print('skeletons', 'skeletons_correct', 'values', 'values_correct', 'addresses', 'addresses_correct', 'log_probs', 'log_probs_correct', 'distributions', 'distributions_correct', 'named', 'named_correct', 'packed_distributions', 'packed_distributions_correct')
+
+        self.assertEqual(skeletons, skeletons_correct)
+        self.assertEqual(values, values_correct)
+        self.assertEqual(addresses, addresses_correct)
+        self.assertEqual(log_probs, log_probs_correct)
+        self.assertEqual(distributions, distributions_correct)
+        self.assertEqual(named, named_correct)
+        self.assertEqual(packed_distributions, packed_distributions_correct)
+        self.assertEqual(type(pickle.loads(pickle.dumps(traces_packed[0]))), Trace)
+
+    def test_trace_pack_pruned(self):
+        trace = OnlineDataset(model=self._model).__getitem__(0)
+        OnlineDataset._prune_trace(trace)
+        trace_packed = TraceSkeletons().pack(trace)
+
+        controlled = [float(v.value) for v in trace_packed.variables_controlled]
+        controlled_correct = [float(v.value) for v in trace.variables_controlled]
+        has_variables = hasattr(trace_packed, 'variables')
+        has_variables_correct = False
+        has_instance = hasattr(trace_packed.variables_controlled[0], 'instance')
+        has_instance_correct = False
+
+        util.eval_print('controlled', 'controlled_correct', 'has_variables', 'has_variables_correct', 'has_instance', 'has_instance_correct')
+
+        self.assertEqual(controlled, controlled_correct)
+        self.assertEqual(has_variables, has_variables_correct)
+        self.assertEqual(has_instance, has_instance_correct)
+
+    def test_trace_pack_empirical(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'empirical')
+            posterior = self._model_pack_traces.posterior_traces(20, file_name=file_name)
+            posterior.close()
+            posterior_loaded = Empirical(file_name=file_name, file_read_only=True)
+            traces = posterior_loaded.get_values()
+
+            types = set(type(trace) for trace in traces)
+            types_correct = {PackedTrace}
+            results = [trace.result for trace in traces]
+            results_correct = [trace.variables_controlled[0].value + 1 for trace in traces]
+            skeletons = len(posterior_loaded._trace_skeletons)
+            skeletons_correct = 2
+
+            util.eval_print('types', 'types_correct', 'results', 'results_correct', 'skeletons', 'skeletons_correct')
+
+            self.assertEqual(types, types_correct)
+            self.assertEqual([int(r) for r in results], [int(r) for r in results_correct])
+            self.assertLessEqual(skeletons, skeletons_correct)
+            posterior_loaded.close()
+
+    def test_trace_pack_empirical_record_log_not_finalized(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'empirical')
+            traces = self._model.prior_traces(20).get_values()
+            empirical = Empirical(file_name=file_name, file_sync_timeout=1, pack_traces=True, file_storage=EmpiricalStorage.RECORD_LOG)
+            for trace in traces:
+                empirical.add(trace)
+            # Read before the Empirical is finalized, as after a crash of the writer
+            empirical_loaded = Empirical(file_name=file_name, file_read_only=True)
+            results = [int(trace.result) for trace in empirical_loaded.get_values()]
+            results_correct = [int(trace.result) for trace in traces]
+
+            util.eval_print('results', 'results_correct')
+
+            self.assertEqual(results, results_correct)
+            empirical_loaded.close()
+            empirical.close()
+
 
 class RejectionSamplingTraceTestCase(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -67,7 +500,20 @@ class RejectionSamplingTraceTestCase(unittest.TestCase):
                 pyprob.observe(likelihood, name='obs1')
                 return s
 
+        class RejectionSamplingIterations(Model):
+            def __init__(self):
+                super().__init__('RejectionSamplingIterations')
+                self.iterations = 1
+
+            def forward(self):
+                uniform = Uniform(-1, 1)
+                for i in range(self.iterations):
+                    x = pyprob.sample(uniform, replace=True)
+                pyprob.observe(Normal(x, 0.1), name='obs')
+                return x
+
         self._model = RejectionSampling()
+        self._model_iterations = RejectionSamplingIterations()
         super().__init__(*args, **kwargs)
 
     def test_prior(self):
@@ -84,6 +530,22 @@ class RejectionSamplingTraceTestCase(unittest.TestCase):
         self.assertEqual(trace_addresses_controlled, trace_addresses_controlled_correct)
         self.assertEqual(trace_addresses, trace_addresses_correct)
 
+    def test_prior_type_id(self):
+        traces = []
+        for iterations in [1, 2]:
+            self._model_iterations.iterations = iterations
+            traces.append(self._model_iterations.prior_traces(1)[0])
+        type_ids_equal = traces[0].type_id == traces[1].type_id
+        type_ids = [trace.type_id for trace in traces]
+        for trace in traces:
+            trace._type_id = None
+        type_ids_correct = [trace.type_id for trace in traces]
+
+        util.eval_print('type_ids_equal', 'type_ids', 'type_ids_correct')
+
+        self.assertFalse(type_ids_equal)
+        self.assertEqual(type_ids, type_ids_correct)
+
     def test_prior_for_inference_network(self):
         trace_addresses_controlled_correct = ['34__forward__x__Uniform__replaced', '48__forward__y__Uniform__replaced']
         trace_addresses_correct = ['34__forward__x__Uniform__replaced', '48__forward__y__Uniform__replaced', '34__forward__x__Uniform__replaced', '48__forward__y__Uniform__replaced', '92__forward__?__Normal__1', '106__forward__?__Normal__1']
@@ -1,4 +1,5 @@
 import unittest
+import math
 
 import pyprob
 from pyprob import util
@@ -29,6 +30,39 @@ class UtilTestCase(unittest.TestCase):
         self.assertTrue(not all(sample == stochastic_samples[0] for sample in stochastic_samples))
         self.assertTrue(all(sample == deterministic_samples[0] for sample in deterministic_samples))
 
+    def test_log_weight_statistics(self):
+        log_weights = [-3.2, 0.5, -1000., 2.1, -0.7, float('-inf'), 1.3]
+        weights = [math.exp(log_weight) for log_weight in log_weights]
+        effective_sample_size_correct = sum(weights) ** 2 / sum([weight * weight for weight in weights])
+        log_evidence_correct = math.log(sum(weights) / len(weights))
+
+        log_weight_statistics = util.LogWeightStatistics()
+        for log_weight in log_weights:
+            log_weight_statistics.add(log_weight)
+        effective_sample_size = log_weight_statistics.effective_sample_size
+        log_evidence = log_weight_statistics.log_evidence
+        util.eval_print('log_weights', 'effective_sample_size', 'effective_sample_size_correct', 'log_evidence', 'log_evidence_correct')
+
+        self.assertEqual(log_weight_statistics.length, len(log_weights))
+        self.assertAlmostEqual(effective_sample_size, effective_sample_size_correct, places=6)
+        self.assertAlmostEqual(log_evidence, log_evidence_correct, places=6)
+
+
+    def test_resample_indices(self):
+        num_samples = 10000
+        weights = [0.1, 0., 0.5, 0.4]
+        frequencies_correct = weights
+
+        for resampling in util.Resampling:
+            indices = util.resample_indices(weights, num_samples, resampling).tolist()
+            frequencies = [indices.count(i) / num_samples for i in range(len(weights))]
+            util.eval_print('resampling', 'frequencies', 'frequencies_correct')
+
+            self.assertEqual(len(indices), num_samples)
+            self.assertEqual(indices, sorted(indices))
+            for frequency, frequency_correct in zip(frequencies, frequencies_correct):
+                self.assertAlmostEqual(frequency, frequency_correct, delta=0.03)
+
 
 if __name__ == '__main__':
     pyprob.set_random_seed(123)